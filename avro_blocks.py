@@ -0,0 +1,324 @@
+"""
+Low level access to the data blocks of an Avro container file.
+An Avro file is a header followed by blocks, each one containing a number of records and terminated
+by the sync marker of the file. Blocks can be decoded independently, so the corpus can be split
+in ranges of blocks and processed in different processes without reading it sequentially.
+"""
+import bz2
+import functools
+import io
+import lzma
+from multiprocessing import Pool
+import os
+import zlib
+
+import avro.schema
+from avro.io import BinaryDecoder, BinaryEncoder, DatumReader, DatumWriter
+
+MAGIC = b'Obj\x01'
+SYNC_SIZE = 16
+# the codecs of the Avro specification available in the standard library
+CODECS = ['null', 'deflate', 'bzip2', 'xz']
+
+
+def read_long(f):
+    """
+    Read a zig-zag encoded variable length long from a file-like object, None at the end of the file
+    """
+    b = f.read(1)
+    if len(b) == 0:
+        return None
+    b = b[0]
+    n = b & 0x7F
+    shift = 7
+    while (b & 0x80) != 0:
+        b = f.read(1)[0]
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1)
+
+
+def read_bytes(f):
+    """
+    Read a length-prefixed sequence of bytes
+    """
+    return f.read(read_long(f))
+
+
+def write_long(buffer, n):
+    """
+    Append a long to a bytearray with the zig-zag variable length encoding
+    """
+    n = (n << 1) ^ (n >> 63)
+    while n & ~0x7F:
+        buffer.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buffer.append(n)
+
+
+def write_bytes(buffer, data):
+    """
+    Append a length-prefixed sequence of bytes to a bytearray
+    """
+    write_long(buffer, len(data))
+    buffer += data
+
+
+class AvroHeader(object):
+    """
+    The header of an Avro container file: metadata, schema, codec and sync marker
+    """
+    def __init__(self, metadata, sync_marker, data_start):
+        self.metadata = metadata
+        self.sync_marker = sync_marker
+        self.data_start = data_start
+        self.codec = metadata.get('avro.codec', b'null').decode('utf-8')
+        self.schema_json = metadata['avro.schema'].decode('utf-8')
+        self.schema = avro.schema.Parse(self.schema_json)
+
+
+def read_header(f):
+    """
+    Read the header of an Avro file, leaving the file positioned at the first block
+    """
+    f.seek(0)
+    if f.read(4) != MAGIC:
+        raise ValueError('not an Avro container file')
+    metadata = {}
+    count = read_long(f)
+    while count != 0:
+        if count < 0:
+            # a negative count is followed by the size of the map block in bytes
+            count = -count
+            read_long(f)
+        for _ in range(count):
+            key = read_bytes(f).decode('utf-8')
+            metadata[key] = read_bytes(f)
+        count = read_long(f)
+    sync_marker = f.read(SYNC_SIZE)
+    return AvroHeader(metadata, sync_marker, f.tell())
+
+
+def iterate_blocks(f, header, start=None, end=None, read_data=True):
+    """
+    Generate (offset, record_count, data) for each block starting at an offset in [start, end)
+    The data is None when read_data is False, the block content is then skipped with a seek
+    """
+    position = header.data_start if start is None else start
+    f.seek(position)
+    while end is None or position < end:
+        record_count = read_long(f)
+        if record_count is None:
+            return
+        size = read_long(f)
+        if read_data:
+            data = f.read(size)
+        else:
+            data = None
+            f.seek(size, io.SEEK_CUR)
+        if f.read(SYNC_SIZE) != header.sync_marker:
+            raise ValueError('sync marker not found after the block at offset {0}'.format(position))
+        yield position, record_count, data
+        position = f.tell()
+
+
+def decompress_block(header, data):
+    """
+    Decompress the content of a block according to the codec of the file
+    """
+    if header.codec == 'null':
+        return data
+    if header.codec == 'deflate':
+        return zlib.decompress(data, -15)
+    if header.codec == 'bzip2':
+        return bz2.decompress(data)
+    if header.codec == 'xz':
+        return lzma.decompress(data)
+    raise ValueError('unsupported codec {0}'.format(header.codec))
+
+
+def compress_block(codec, data):
+    """
+    Compress the content of a block with a codec, the inverse of decompress_block
+    """
+    if codec == 'null':
+        return bytes(data)
+    if codec == 'deflate':
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+    if codec == 'bzip2':
+        return bz2.compress(data)
+    if codec == 'xz':
+        return lzma.compress(data)
+    raise ValueError('unsupported codec {0}'.format(codec))
+
+
+class BlockWriter(object):
+    """
+    Writes an Avro container file from blocks of records already encoded, for the writers that encode their
+    records directly instead of using a DatumWriter
+    """
+    def __init__(self, f, schema_json, codec='deflate', metadata=None):
+        self.f = f
+        self.codec = codec
+        self.sync_marker = os.urandom(SYNC_SIZE)
+        header = bytearray(MAGIC)
+        metadata = dict(metadata or {})
+        metadata['avro.schema'] = schema_json.encode('utf-8')
+        metadata['avro.codec'] = codec.encode('utf-8')
+        write_long(header, len(metadata))
+        for key, value in metadata.items():
+            write_bytes(header, key.encode('utf-8'))
+            write_bytes(header, value)
+        write_long(header, 0)
+        header += self.sync_marker
+        f.write(header)
+
+    def write_block(self, data, record_count):
+        """
+        Write a block with the given encoded records
+        """
+        if record_count == 0:
+            return
+        data = compress_block(self.codec, data)
+        prefix = bytearray()
+        write_long(prefix, record_count)
+        write_long(prefix, len(data))
+        self.f.write(prefix)
+        self.f.write(data)
+        self.f.write(self.sync_marker)
+
+
+class RecordWriter(object):
+    """
+    Writes an Avro container file record by record like the DataFileWriter, with any of the CODECS and blocks
+    of about block_size bytes before compression
+    """
+    def __init__(self, f, schema_json, codec='deflate', block_size=65536, metadata=None):
+        self.block_writer = BlockWriter(f, schema_json, codec=codec, metadata=metadata)
+        self.block_size = block_size
+        self.datum_writer = DatumWriter(avro.schema.Parse(schema_json))
+        self.buffer = io.BytesIO()
+        self.encoder = BinaryEncoder(self.buffer)
+        self.record_count = 0
+
+    def append(self, record):
+        self.datum_writer.write(record, self.encoder)
+        self.record_count += 1
+        if self.buffer.tell() >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the records appended so far as a block
+        """
+        self.block_writer.write_block(self.buffer.getvalue(), self.record_count)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.record_count = 0
+        self.block_writer.f.flush()
+
+    def close(self):
+        self.flush()
+        self.block_writer.f.close()
+
+
+def decode_block(header, data, record_count, datum_reader=None):
+    """
+    Decode the records of a block, returning them as a list
+    """
+    if datum_reader is None:
+        datum_reader = DatumReader(header.schema)
+    decoder = BinaryDecoder(io.BytesIO(decompress_block(header, data)))
+    return [datum_reader.read(decoder) for _ in range(record_count)]
+
+
+def iterate_records(path, start=None, end=None):
+    """
+    Generate the records of the blocks starting at an offset in [start, end)
+    """
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        datum_reader = DatumReader(header.schema)
+        for _, record_count, data in iterate_blocks(f, header, start, end):
+            for record in decode_block(header, data, record_count, datum_reader):
+                yield record
+
+
+def list_blocks(path):
+    """
+    List the (offset, record_count) of each block of the file, without decoding them
+    """
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        return [(offset, record_count) for offset, record_count, _ in iterate_blocks(f, header, read_data=False)]
+
+
+def locate_record(path, index):
+    """
+    The offset of the block containing the record with the given index, counting from 0, and the index of the
+    record in that block. Only the block headers are read. Past the last record, the offset is the end of the file
+    """
+    records = 0
+    for offset, record_count in list_blocks(path):
+        if index < records + record_count:
+            return offset, index - records
+        records += record_count
+    return os.path.getsize(path), 0
+
+
+def split_blocks(path, parts):
+    """
+    Split the file in at most the given number of contiguous block ranges with a similar number of records.
+    Returns a list of (start, end, first_record_index), end is the offset of the first block not in the range
+    """
+    blocks = list_blocks(path)
+    if len(blocks) == 0:
+        return []
+    total_records = sum(record_count for _, record_count in blocks)
+    per_part = max(1, total_records / parts)
+    ranges = []
+    start = blocks[0][0]
+    first_record_index = 0
+    records = 0
+    for offset, record_count in blocks:
+        if records >= per_part * (len(ranges) + 1) and offset != start:
+            ranges.append((start, offset, first_record_index))
+            start = offset
+            first_record_index = records
+        records += record_count
+    ranges.append((start, os.path.getsize(path), first_record_index))
+    return ranges
+
+
+def split_for_workers(path, workers):
+    """
+    Split the file in block ranges for a pool of workers, see split_blocks
+    """
+    # more ranges than workers, so that a slow range doesn't leave the other processes idle
+    return split_blocks(path, workers * 4)
+
+
+def map_block_ranges(function, block_ranges, workers=1, ordered=True):
+    """
+    Generate the results of function called on each (start, end, first_record_index) of block_ranges, like the
+    ones of split_blocks, in a pool of processes when workers > 1. The results are in the order of the ranges,
+    or in the order they are ready when ordered is False. The function must be defined at the top level of a
+    module, so that the processes can find it
+    """
+    if workers <= 1:
+        yield from map(function, block_ranges)
+        return
+    with Pool(workers) as pool:
+        if ordered:
+            yield from pool.imap(function, block_ranges)
+        else:
+            yield from pool.imap_unordered(function, block_ranges)
+
+
+def reduce_block_ranges(function, combine, initial, block_ranges, workers=1):
+    """
+    The results of function on each block range, see map_block_ranges, reduced in the order of the ranges with
+    combine(accumulated, result) starting from initial
+    """
+    return functools.reduce(combine, map_block_ranges(function, block_ranges, workers), initial)
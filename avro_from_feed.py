@@ -6,9 +6,7 @@ from html.parser import HTMLParser
 import time
 from datetime import datetime
 
-import avro
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+import corpus_writer
 
 import argparse
 
@@ -96,12 +94,12 @@ feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--detect-rss', dest='direct_feed', action='store_false', help="wether the given URL is a site page (default) from which to extract the feed address, or directly the RSS feed URL")
 feature_parser.add_argument('--no-detect-rss', dest='direct_feed', action='store_true', help="wether the given URL is a site page (default) from which to extract the feed address, or directly the RSS feed URL")
 parser.set_defaults(direct_feed=True)
+corpus_writer.add_arguments(parser)
 
 
 args = parser.parse_args()
 
-schema = avro.schema.Parse(open("corpus_utterance.avsc", "rb").read().decode('utf-8'))
-writer = DataFileWriter(open(args.output_file, "wb"), DatumWriter(), schema)
+writer = corpus_writer.open_writer(args.output_file, codec=args.codec, block_size=args.block_size)
 url = args.url
 
 print('will try to retrieve feed URL and related articles from {0} and save them in {1}'.format(url, args.output_file))
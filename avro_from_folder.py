@@ -1,9 +1,7 @@
 
 import time
 from os import listdir, path
-import avro
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+import corpus_writer
 
 import argparse
 
@@ -12,11 +10,11 @@ parser = argparse.ArgumentParser(description="store utterances from a folder con
 parser.add_argument("-folder", type=str, help="the folder path", default='.')
 parser.add_argument("-output_file", type=str, help="the avro serialized file", default="utterances.avro")
 parser.add_argument("-extension", type=str, help="if specified, load only files with this extension")
+corpus_writer.add_arguments(parser)
 
 args = parser.parse_args()
 
-schema = avro.schema.Parse(open("corpus_utterance.avsc", "rb").read().decode('utf-8'))
-writer = DataFileWriter(open(args.output_file, "wb"), DatumWriter(), schema)
+writer = corpus_writer.open_writer(args.output_file, codec=args.codec, block_size=args.block_size)
 
 start_time = time.time()
 tot = 0
@@ -1,19 +1,17 @@
 import requests
 from bs4 import BeautifulSoup
 
-import avro
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+import corpus_writer
 
 import argparse
 
 parser = argparse.ArgumentParser(description="download articles from HackerNews")
 parser.add_argument("-output_file", type=str, help="the avro serialized file", default="hackernews_utterances.avro")
+corpus_writer.add_arguments(parser)
 
 args = parser.parse_args()
 
-schema = avro.schema.Parse(open("corpus_utterance.avsc", "rb").read().decode('utf-8'))
-writer = DataFileWriter(open(args.output_file, "wb"), DatumWriter(), schema)
+writer = corpus_writer.open_writer(args.output_file, codec=args.codec, block_size=args.block_size)
 
 response = requests.request("GET", "https://news.ycombinator.com/")
 soup = BeautifulSoup(response.text, 'html.parser')
@@ -1,8 +1,6 @@
 import time
 import mailbox
-import avro
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+import corpus_writer
 from html.parser import HTMLParser
 from datetime import datetime
 
@@ -69,11 +67,11 @@ parser = argparse.ArgumentParser(
     description="store utterances from a mailbox file, like the one from gmail (google takeout)")
 parser.add_argument("i", type=str, help="the input file")
 parser.add_argument("-output_file", type=str, help="the avro serialized file", default="mail_utterances.avro")
+corpus_writer.add_arguments(parser)
 
 args = parser.parse_args()
 
-schema = avro.schema.Parse(open("corpus_utterance.avsc", "rb").read().decode('utf-8'))
-writer = DataFileWriter(open(args.output_file, "wb"), DatumWriter(), schema)
+writer = corpus_writer.open_writer(args.output_file, codec=args.codec, block_size=args.block_size)
 mbox = mailbox.mbox(args.i)
 start_time = time.time()
 tot = 0
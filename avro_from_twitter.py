@@ -2,9 +2,7 @@
 # encoding: utf-8
 
 import tweepy
-import avro
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+import corpus_writer
 import argparse
 import sys
 import signal
@@ -50,11 +48,11 @@ parser.add_argument("-languages", type=str, help="the languages of the tweets, c
 parser.add_argument("-track", type=str, help="the keywords to search", default=None)
 
 parser.add_argument("-output_file", type=str, help="the avro serialized file", default="twitter_utterances.avro")
+corpus_writer.add_arguments(parser)
 
 args = parser.parse_args()
 
-schema = avro.schema.Parse(open("corpus_utterance.avsc", "rb").read().decode('utf-8'))
-writer = DataFileWriter(open(args.output_file, "wb"), DatumWriter(), schema)
+writer = corpus_writer.open_writer(args.output_file, codec=args.codec, block_size=args.block_size)
 
 auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
 auth.set_access_token(access_token, access_token_secret)
@@ -3,20 +3,18 @@ import xml.sax
 import mwparserfromhell
 import argparse
 
-import avro
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+import corpus_writer
 
 
 parser = argparse.ArgumentParser(description="extract quotes from a Wikiquote dump")
 parser.add_argument("dump_path", type=str, help="the path of the Wikiquote dump, compressed")
 parser.add_argument("-output_file", type=str, help="the avro serialized file", default="utterances.avro")
+corpus_writer.add_arguments(parser)
 
 args = parser.parse_args()
 bz_file = bz2.BZ2File(args.dump_path)
 
-schema = avro.schema.Parse(open("corpus_utterance.avsc", "rb").read().decode('utf-8'))
-writer = DataFileWriter(open(args.output_file, "wb"), DatumWriter(), schema)
+writer = corpus_writer.open_writer(args.output_file, codec=args.codec, block_size=args.block_size)
 
 
 class WikiDumpHandler(xml.sax.ContentHandler):
@@ -0,0 +1,64 @@
+"""
+Report of the Avro codecs on a corpus: rewrites it with each codec and block size, then reports the size, the
+compression ratio to the uncompressed file with the same block size, the write time and the read throughput of
+the utterance decoder
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import avro_blocks
+import corpus_writer
+import utterance_decoder
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def write_corpus(path, records, codec, block_size):
+    writer = corpus_writer.open_writer(path, codec=codec, block_size=block_size)
+    for record in records:
+        writer.append(record)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compare the size and the read speed of a corpus with each codec")
+    parser.add_argument("-input_file", type=str, help="the input avro file",
+                        default="hackernews_utterances.avro.example")
+    parser.add_argument("-codecs", type=str, help="comma separated codecs to compare",
+                        default=','.join(avro_blocks.CODECS))
+    parser.add_argument("-block_sizes", type=str, help="comma separated block sizes in bytes to compare",
+                        default='16000,65536,262144')
+    parser.add_argument("-repeat", type=int, help="how many times each file is read, the best time is kept",
+                        default=3)
+    args = parser.parse_args()
+
+    records = list(utterance_decoder.iterate_utterances(args.input_file))
+    print('rewriting the {0} utterances of {1}'.format(len(records), args.input_file))
+    directory = tempfile.mkdtemp()
+    try:
+        print('{0:>7} {1:>10} {2:>12} {3:>6} {4:>10} {5:>18}'
+              .format('codec', 'block size', 'bytes', 'ratio', 'write s', 'read records/s'))
+        for codec in filter(lambda x: x != '', args.codecs.split(',')):
+            for block_size in map(int, filter(lambda x: x != '', args.block_sizes.split(','))):
+                path = os.path.join(directory, '{0}_{1}.avro'.format(codec, block_size))
+                write_corpus(path, records, 'null', block_size)
+                null_size = os.path.getsize(path)
+                write_elapsed = best_time(lambda: write_corpus(path, records, codec, block_size), 1)
+                size = os.path.getsize(path)
+                read_elapsed = best_time(lambda: list(utterance_decoder.iterate_utterances(path)), args.repeat)
+                print('{0:>7} {1:>10} {2:>12} {3:>6.2f} {4:>10.3f} {5:>18.0f}'
+                      .format(codec, block_size, size, null_size / size, write_elapsed, len(records) / read_elapsed))
+                os.remove(path)
+    finally:
+        shutil.rmtree(directory)
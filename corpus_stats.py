@@ -1,79 +1,116 @@
-from avro.datafile import DataFileReader
-from avro.io import DatumReader
 import time
 import argparse
+import functools
 import operator
 
-# parameters from CLI
-parser = argparse.ArgumentParser(description="shows statistics about a corpus file")
-parser.add_argument("-input_file", type=str, help="the input avro file", default="utterances.avro")
-parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
-                    choices=['split', 'char'])
-
-args = parser.parse_args()
-
-# pick the joiner and splitter functions, mapping plain text to sequences markov states labels
-splitter = None
-joiner = None
-
-if args.tokenizer == 'char':
-
-    def splitter(x): return list(x)
-
-    def joiner(x): return ''.join(x)
-
-if args.tokenizer == 'split':
-    def splitter(x): return x.split(' ')
-
-    def joiner(x): return ' '.join(x)
-
-
-input_file = args.input_file
-
-print('will import file {0}'.format(input_file))
-
-reader = DataFileReader(open(input_file, "rb"), DatumReader())
-start_time = time.time()
-
-utterances_count = 0
-max_tokens = 0
-longest_description = ''
-tags_counter = {}
-total_length_chars = 0
-total_length_tokens = 0
-
-for utterance in reader:
-    utterances_count += 1
-    if utterance['tags'] is not None:
-        for t in utterance['tags']:
-            if t in tags_counter.keys():
-                tags_counter[t] += 1
-            else:
-                tags_counter[t] = 1
-    tokens = splitter(utterance['text'])
-    total_length_tokens += len(tokens)
-    total_length_chars += len(utterance['text'])
-    if utterances_count % 1000 == 0:
-        elapsed = time.time() - start_time
-        print('so far, processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
-              .format(utterances_count, total_length_tokens, elapsed, utterances_count / elapsed))
-    if len(utterance['text']) > max_tokens:
-        max_tokens = len(utterance['text'])
-        if len(utterance['text']) > 320:
-            longest_description = utterance['text'][:160] + ' ...[truncated]... ' + utterance['text'][-160:]
-reader.close()
-
-elapsed = time.time() - start_time
-print('processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
-      .format(utterances_count, total_length_tokens, elapsed, utterances_count/elapsed))
-print('average tokens per sentence: {0}'.format(total_length_tokens/utterances_count))
-print('average characters per sentence: {0}'.format(total_length_chars/utterances_count))
-print('the longest utterance had {0} characters, it was:\n{1}\n'.format(max_tokens, longest_description))
-print('found {0} types of tags'.format(len(tags_counter.keys())))
-
-max_rank = 30
-print('{0} most common tags'.format(max_rank))
-sorted_tags = sorted(tags_counter.items(), key=operator.itemgetter(1), reverse=True)[:max_rank]
-for k, v in sorted_tags:
-    print('{0}: {1}'.format(k, v))
-
+import avro_blocks
+import tag_index
+import tokenizers
+
+
+def empty_stats():
+    return {'utterances_count': 0, 'total_length_tokens': 0, 'total_length_chars': 0, 'max_tokens': 0,
+            'longest_description': '', 'tags_counter': {}}
+
+
+def read_stats(args, tags, index, start_time, block_range):
+    """
+    The statistics of the utterances in a range of Avro blocks, of the whole file for (None, None, 0)
+    """
+    # pick the joiner and splitter functions, mapping plain text to sequences markov states labels
+    splitter, joiner = tokenizers.get_tokenizer(args.tokenizer)
+    start, end, _ = block_range
+    stats = empty_stats()
+    tags_counter = stats['tags_counter']
+    for utterance in tag_index.iterate_records(args.input_file, tags, start, end, index=index,
+                                               fields=('text', 'tags')):
+        stats['utterances_count'] += 1
+        if utterance['tags'] is not None:
+            for t in utterance['tags']:
+                if t in tags_counter.keys():
+                    tags_counter[t] += 1
+                else:
+                    tags_counter[t] = 1
+        tokens = splitter(utterance['text'])
+        stats['total_length_tokens'] += len(tokens)
+        stats['total_length_chars'] += len(utterance['text'])
+        if args.workers == 1 and stats['utterances_count'] % 1000 == 0:
+            elapsed = time.time() - start_time
+            print('so far, processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
+                  .format(stats['utterances_count'], stats['total_length_tokens'], elapsed,
+                          stats['utterances_count'] / elapsed))
+        if len(utterance['text']) > stats['max_tokens']:
+            stats['max_tokens'] = len(utterance['text'])
+            if len(utterance['text']) > 320:
+                stats['longest_description'] = utterance['text'][:160] + ' ...[truncated]... ' + utterance['text'][-160:]
+    return stats
+
+
+def combine_stats(stats, following):
+    """
+    Add the statistics of the following block range, giving the same result as reading the ranges sequentially
+    """
+    stats['utterances_count'] += following['utterances_count']
+    stats['total_length_tokens'] += following['total_length_tokens']
+    stats['total_length_chars'] += following['total_length_chars']
+    if following['max_tokens'] > stats['max_tokens']:
+        stats['max_tokens'] = following['max_tokens']
+        stats['longest_description'] = following['longest_description']
+    for t, count in following['tags_counter'].items():
+        stats['tags_counter'][t] = stats['tags_counter'].get(t, 0) + count
+    return stats
+
+
+def main():
+    # parameters from CLI
+    parser = argparse.ArgumentParser(description="shows statistics about a corpus file")
+    parser.add_argument("-input_file", type=str, help="the input avro file", default="utterances.avro")
+    parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
+                        choices=tokenizers.NAMES)
+    parser.add_argument("-tags", type=str, default='',
+                        help="comma separated tags, to only read the utterances having at least one of them")
+    parser.add_argument("-workers", type=int, default=1,
+                        help="the number of processes reading the corpus, each one on a different range of Avro blocks")
+
+    args = parser.parse_args()
+
+    input_file = args.input_file
+
+    print('will import file {0}'.format(input_file))
+
+    tags = list(filter(lambda x: x != '',  args.tags.split(',')))
+    # with a tag index only the blocks containing the tags are read
+    index = tag_index.load_index(input_file) if len(tags) > 0 else None
+    start_time = time.time()
+
+    if args.workers > 1:
+        # the workers get the settings with the function, they don't run main()
+        stats = avro_blocks.reduce_block_ranges(functools.partial(read_stats, args, tags, index, start_time),
+                                                combine_stats, empty_stats(),
+                                                avro_blocks.split_for_workers(input_file, args.workers), args.workers)
+    else:
+        stats = read_stats(args, tags, index, start_time, (None, None, 0))
+    utterances_count = stats['utterances_count']
+    total_length_tokens = stats['total_length_tokens']
+    total_length_chars = stats['total_length_chars']
+    max_tokens = stats['max_tokens']
+    longest_description = stats['longest_description']
+    tags_counter = stats['tags_counter']
+
+    elapsed = time.time() - start_time
+    print('processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
+          .format(utterances_count, total_length_tokens, elapsed, utterances_count/elapsed))
+    print('average tokens per sentence: {0}'.format(total_length_tokens/utterances_count))
+    print('average characters per sentence: {0}'.format(total_length_chars/utterances_count))
+    print('the longest utterance had {0} characters, it was:\n{1}\n'.format(max_tokens, longest_description))
+    print('found {0} types of tags'.format(len(tags_counter.keys())))
+
+    max_rank = 30
+    print('{0} most common tags'.format(max_rank))
+    sorted_tags = sorted(tags_counter.items(), key=operator.itemgetter(1), reverse=True)[:max_rank]
+    for k, v in sorted_tags:
+        print('{0}: {1}'.format(k, v))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+The writer of the corpus files used by the avro_from_* scripts, with the codec and the block size given on the
+command line. Every reader of the project decodes the blocks with avro_blocks, so it reads all the CODECS
+"""
+import os
+
+import avro_blocks
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus_utterance.avsc')
+
+
+def add_arguments(parser):
+    parser.add_argument("-codec", type=str, default='deflate', choices=avro_blocks.CODECS,
+                        help="the compression of the Avro blocks, see compression_report.py to compare them")
+    parser.add_argument("-block_size", type=int, default=65536,
+                        help="the size in bytes of the Avro blocks before compression, larger blocks compress "
+                             "better while smaller ones let filtered and parallel reads skip more")
+
+
+def open_writer(path, codec='deflate', block_size=65536):
+    """
+    A writer of utterance records to a new corpus file, with append and close like the DataFileWriter
+    """
+    with open(SCHEMA_PATH, 'rb') as f:
+        schema_json = f.read().decode('utf-8')
+    return avro_blocks.RecordWriter(open(path, 'wb'), schema_json, codec=codec, block_size=block_size)
@@ -1,16 +1,17 @@
-from avro.datafile import DataFileReader
-from avro.io import DatumReader
 import time
 import argparse
 import sqlite3
 
+import avro_blocks
+import tokenizers
+
 print("currently not working, it's incredibly slow and rows are duplicated, could be better to use Redis or Postgres or some other tool")
 exit()
 # parameters from CLI
 parser = argparse.ArgumentParser(description="calculate a tag/token co-occurrency table from a corpus file")
 parser.add_argument("-input_file", type=str, help="the input avro file")
 parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
-                    choices=['split', 'char', 'nltk'])
+                    choices=tokenizers.NAMES)
 parser.add_argument("-case_insensitive", type=str, help="lowercase the tokens with the system locale", default='yes',
                     choices=['yes', 'no'])
 parser.add_argument('-sqlite_db_file', default='tag_token_counters.db', help='name of the SQLite file to create or add to')
@@ -18,29 +19,7 @@ parser.add_argument('-sqlite_db_file', default='tag_token_counters.db', help='na
 args = parser.parse_args()
 
 # pick the joiner and splitter functions, mapping plain text to token sequences
-splitter = None
-joiner = None
-
-if args.tokenizer == 'char':
-
-    def splitter(x): return list(x)
-
-    def joiner(x): return ''.join(x)
-
-if args.tokenizer == 'split':
-    def splitter(x): return x.split(' ')
-
-    def joiner(x): return ' '.join(x)
-
-
-if args.tokenizer == 'nltk':
-    from nltk.tokenize import RegexpTokenizer
-    tokenizer = RegexpTokenizer('\w+|\$[\d\.]+|\S+')
-
-    def splitter(x): return tokenizer.tokenize(x)
-
-
-    def joiner(x): return ' '.join(x)
+splitter, joiner = tokenizers.get_tokenizer(args.tokenizer)
 
 
 conn = sqlite3.connect(args.sqlite_db_file)
@@ -65,7 +44,7 @@ else:
     print('the tokens will be counted as they are (case sensitive)')
 
 
-reader = DataFileReader(open(input_file, "rb"), DatumReader())
+reader = avro_blocks.iterate_records(input_file)
 start_time = time.time()
 
 
@@ -115,7 +94,5 @@ for utterance in reader:
         pending_token_tag_count = {}
 
 
-reader.close()
-
 elapsed = time.time() - start_time
 print('processed {0} utterances, it took {1} seconds [{2} utterances per second]'.format(utterances_count, elapsed, utterances_count/elapsed))
\ No newline at end of file
@@ -1,102 +1,203 @@
-from avro.datafile import DataFileReader
-from avro.io import DatumReader
 import time
 import argparse
+import functools
+import heapq
 import operator
 import json
-# parameters from CLI
-parser = argparse.ArgumentParser(description="builds a frequency table from a corpus file")
-parser.add_argument("-input_file", type=str, help="the input avro file")
-parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
-                    choices=['split', 'char', 'nltk'])
-parser.add_argument("-case_insensitive", type=str, help="lowercase the tokens with the system locale", default='yes',
-                    choices=['yes', 'no'])
-parser.add_argument("-output_format", type=str, help="the output format for the frequency table", default=None,
-                    choices=['tsv', 'jsons'])
-args = parser.parse_args()
 
-# pick the joiner and splitter functions, mapping plain text to token sequences
-splitter = None
-joiner = None
-
-if args.tokenizer == 'char':
-
-    def splitter(x): return list(x)
-
-    def joiner(x): return ''.join(x)
-
-if args.tokenizer == 'split':
-    def splitter(x): return x.split(' ')
-
-    def joiner(x): return ' '.join(x)
-
-
-if args.tokenizer == 'nltk':
-    from nltk.tokenize import RegexpTokenizer
-    tokenizer = RegexpTokenizer('\w+|\$[\d\.]+|\S+')
-
-    def splitter(x): return tokenizer.tokenize(x)
-
-
-    def joiner(x): return ' '.join(x)
-
-input_file = args.input_file
-output_format = args.output_format
-case_insensitive = (args.case_insensitive == 'yes')
-if output_format is None:
-    if case_insensitive:
-        print('the tokens will be lowercased using the system locale')
-    else:
-        print('the tokens will be counted as they are (case sensitive)')
-
-    print('will build frequency list from file {0}'.format(input_file))
-
-reader = DataFileReader(open(input_file, "rb"), DatumReader())
-start_time = time.time()
-
-token_count = {}
-
-utterances_count = 0
-max_tokens = 0
-longest_description = ''
-tags_counter = {}
-total_length_chars = 0
-total_length_tokens = 0
-
-for utterance in reader:
-    utterances_count += 1
-    tokens = splitter(utterance['text'])
-    total_length_tokens += len(tokens)
-    for ct in tokens:
+import avro_blocks
+import sketches
+import tag_index
+import tokenizers
+
+# the utterances are tokenized in batches, spread over the processes of the pool if any
+BATCH_SIZE = 10000
+
+
+def count_tokens(texts, counts, args, pool=None):
+    # in approximate mode only the tokens of the batch are counted exactly, then added to the sketch
+    token_count = {} if args.approximate else counts['token_count']
+    for tokens in tokenizers.tokenize_batch(texts, args.tokenizer, pool=pool, processes=args.tokenizer_processes):
+        counts['total_length_tokens'] += len(tokens)
+        for ct in tokens:
+            if args.case_insensitive == 'yes':
+                t = ct.lower()
+            else:
+                t = ct
+            token_count[t] = token_count.get(t, 0) + 1
+    if args.approximate:
+        counts['sketch'].add_counts(token_count)
+
+
+def empty_counts(args):
+    if args.approximate:
+        return {'utterances_count': 0, 'total_length_tokens': 0,
+                'sketch': sketches.FrequencySketch(args.sketch_width, args.sketch_depth, args.heavy_hitters)}
+    return {'utterances_count': 0, 'total_length_tokens': 0, 'token_count': {}}
+
+
+def count_block_range(args, tags, index, block_range, pool=None):
+    """
+    Count the tokens of the utterances in a range of Avro blocks, of the whole file for (None, None, 0)
+    """
+    start, end, _ = block_range
+    counts = empty_counts(args)
+    batch = []
+    for utterance in tag_index.iterate_records(args.input_file, tags, start, end, index=index, fields=('text',)):
+        counts['utterances_count'] += 1
+        batch.append(utterance['text'])
+        if len(batch) >= BATCH_SIZE:
+            count_tokens(batch, counts, args, pool)
+            batch = []
+    count_tokens(batch, counts, args, pool)
+    return counts
+
+
+def combine_counts(args, counts, following):
+    """
+    Add the counts of the following block range, the tokens are in the order they were first seen like when
+    reading the ranges sequentially, so the ties are ranked the same way
+    """
+    counts['utterances_count'] += following['utterances_count']
+    counts['total_length_tokens'] += following['total_length_tokens']
+    if args.approximate:
+        counts['sketch'].merge(following['sketch'])
+        return counts
+    token_count = counts['token_count']
+    for t, count in following['token_count'].items():
+        token_count[t] = token_count.get(t, 0) + count
+    return counts
+
+
+def main():
+    # parameters from CLI
+    parser = argparse.ArgumentParser(description="builds a frequency table from a corpus file")
+    parser.add_argument("-input_file", type=str, help="the input avro file")
+    parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
+                        choices=tokenizers.NAMES)
+    parser.add_argument("-case_insensitive", type=str, help="lowercase the tokens with the system locale",
+                        default='yes', choices=['yes', 'no'])
+    parser.add_argument("-output_format", type=str, help="the output format for the frequency table", default=None,
+                        choices=['tsv', 'jsons'])
+    parser.add_argument("-tokenizer_processes", type=int, default=1,
+                        help="the number of processes tokenizing the utterances, for costly tokenizers")
+    parser.add_argument("-tags", type=str, default='',
+                        help="comma separated tags, to only count the utterances having at least one of them")
+    parser.add_argument("-workers", type=int, default=1,
+                        help="the number of processes reading the corpus, each one on a different range of Avro "
+                             "blocks")
+    parser.add_argument("-top", type=int, default=5000, help="how many of the most frequent tokens to output")
+    parser.add_argument("-approximate", action='store_true',
+                        help="count in a fixed memory with a count-min sketch and the Space-Saving heavy hitters, "
+                             "giving the bounds of the counts of the most frequent tokens")
+    parser.add_argument("-sketch_width", type=int, default=262144,
+                        help="the counters in each row of the count-min sketch, the counts are overestimated by at "
+                             "most e / width of the tokens")
+    parser.add_argument("-sketch_depth", type=int, default=4,
+                        help="the rows of the count-min sketch, the bound holds with probability 1 - e^-depth")
+    parser.add_argument("-heavy_hitters", type=int, default=20000,
+                        help="how many tokens the Space-Saving summary keeps, larger than -top to rank it reliably")
+    parser.add_argument("-sketch_file", type=str, help="where to save the sketch of the approximate counts")
+    parser.add_argument("-merge_sketches", type=str,
+                        help="comma separated sketches saved by other runs, to add to the approximate counts")
+    args = parser.parse_args()
+    if args.workers > 1 and args.tokenizer_processes > 1:
+        parser.error('the workers tokenize their own utterances, use either -workers or -tokenizer_processes')
+    if not args.approximate and (args.sketch_file is not None or args.merge_sketches is not None):
+        parser.error('the sketches are used only in the -approximate mode')
+    if args.input_file is None and args.merge_sketches is None:
+        parser.error('give the corpus with -input_file, or the sketches to merge with -merge_sketches')
+
+    # pick the joiner and splitter functions, mapping plain text to token sequences
+    splitter, joiner = tokenizers.get_tokenizer(args.tokenizer)
+
+    input_file = args.input_file
+    output_format = args.output_format
+    case_insensitive = (args.case_insensitive == 'yes')
+    if output_format is None:
         if case_insensitive:
-            t = ct.lower()
+            print('the tokens will be lowercased using the system locale')
         else:
-            t = ct
-        if t in token_count.keys():
-            token_count[t] += 1
-        else:
-            token_count[t] = 1
+            print('the tokens will be counted as they are (case sensitive)')
+
+        if input_file is not None:
+            print('will build frequency list from file {0}'.format(input_file))
+
+    tags = list(filter(lambda x: x != '',  args.tags.split(',')))
+    # with a tag index only the blocks containing the tags are read
+    index = tag_index.load_index(input_file) if len(tags) > 0 and input_file is not None else None
+    start_time = time.time()
+
+    max_tokens = 0
+    longest_description = ''
+    total_length_chars = 0
+
+    pool = tokenizers.make_pool(args.tokenizer_processes)
+
+    if input_file is None:
+        counts = empty_counts(args)
+    elif args.workers > 1:
+        # the workers get the settings with the function, they don't run main()
+        counts = avro_blocks.reduce_block_ranges(functools.partial(count_block_range, args, tags, index),
+                                                 functools.partial(combine_counts, args), empty_counts(args),
+                                                 avro_blocks.split_for_workers(input_file, args.workers),
+                                                 args.workers)
+    else:
+        counts = count_block_range(args, tags, index, (None, None, 0), pool=pool)
+    if pool is not None:
+        pool.close()
+    utterances_count = counts['utterances_count']
+    total_length_tokens = counts['total_length_tokens']
+    if args.approximate:
+        # without a corpus, the sketches to merge give the sizes
+        sketch = counts['sketch'] if input_file is not None else None
+        for sketch_file in filter(lambda x: x != '', (args.merge_sketches or '').split(',')):
+            loaded = sketches.FrequencySketch.load(sketch_file)
+            if sketch is None:
+                sketch = loaded
+            else:
+                sketch.merge(loaded)
+        if args.sketch_file is not None:
+            sketch.save(args.sketch_file)
+    else:
+        token_count = counts['token_count']
 
-reader.close()
+    elapsed = time.time() - start_time
+    if output_format is None and utterances_count > 0:
+        print('processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
+              .format(utterances_count, total_length_tokens, elapsed, utterances_count/elapsed))
+        print('average tokens per sentence: {0}'.format(total_length_tokens/utterances_count))
+        print('average characters per sentence: {0}'.format(total_length_chars/utterances_count))
+        print('the longest utterance had {0} characters, it was:\n{1}\n'.format(max_tokens, longest_description))
 
-elapsed = time.time() - start_time
-if output_format is None:
-    print('processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
-          .format(utterances_count, total_length_tokens, elapsed, utterances_count/elapsed))
-    print('average tokens per sentence: {0}'.format(total_length_tokens/utterances_count))
-    print('average characters per sentence: {0}'.format(total_length_chars/utterances_count))
-    print('the longest utterance had {0} characters, it was:\n{1}\n'.format(max_tokens, longest_description))
+    max_rank = args.top
+    if output_format is None:
+        print('{0} most common tags'.format(max_rank))
+
+    if args.approximate:
+        if output_format is None:
+            error, probability = sketch.count_min.error_bound()
+            print('the counts of {0} tokens are approximated: each one is between the two bounds, and overestimated '
+                  'by at most {1:.1f} with probability {2:.3f}'.format(sketch.count_min.total, error, probability))
+        for k, lower, upper in sketch.top(max_rank):
+            if output_format is None:
+                print('{0}: {1} (at least {2})'.format(k, upper, lower))
+            if output_format == 'tsv':
+                print('{0}\t{1}\t{2}'.format(k, upper, lower))
+            if output_format == 'jsons':
+                print(json.dumps({'token': k, 'count': upper, 'lower_bound': lower}))
+    else:
+        # the same order as sorting all the counts, without sorting them
+        sorted_tokens = heapq.nlargest(max_rank, token_count.items(), key=operator.itemgetter(1))
 
-max_rank = 5000
-if output_format is None:
-    print('{0} most common tags'.format(max_rank))
-sorted_tokens = sorted(token_count.items(), key=operator.itemgetter(1), reverse=True)[:max_rank]
+        for k, v in sorted_tokens:
+            if output_format is None:
+                print('{0}: {1}'.format(k, v))
+            if output_format == 'tsv':
+                print('{0}\t{1}'.format(k, v))
+            if output_format == 'jsons':
+                print(json.dumps({'token': k, 'count': v}))
 
-for k, v in sorted_tokens:
-    if output_format is None:
-        print('{0}: {1}'.format(k, v))
-    if output_format == 'tsv':
-        print('{0}\t{1}'.format(k, v))
-    if output_format == 'jsons':
-        print(json.dumps({'token': k, 'count': v}))
 
+if __name__ == '__main__':
+    main()
@@ -4,56 +4,2114 @@ sentences based on completion frequency.
 The original code is here: https://github.com/wieden-kennedy/python-markov
 This is a rewrite to make it simpler, use UTF-8, run under Python 3 and use a while instead of recursion
 """
+from array import array
+import bisect
+import hashlib
+import itertools
+import pickle
 import random
+from collections import OrderedDict
+import struct
+import sys
+import time
+import zlib
 import redis
 
 PREFIX = 'markov'
 SEPARATOR = '§'
 STOP = '\x02'
+# marks the tokens not in the vocabulary of an interned model
+UNKNOWN = '\x03'
+# keyspaces parallel to the models, for the frozen completions and the metadata of each model
+FROZEN_PREFIX = 'markov-frozen'
+META_PREFIX = 'markov-meta'
+
+# the whole generation walk executed on the Redis server, see generate_server_side
+GENERATE_SCRIPT = """
+local stop = '\\2'
+local prefix = ARGV[1]
+-- between the tokens of the keys and completions, empty for a packed model
+local separator = ARGV[2]
+local key_length = tonumber(ARGV[3])
+local max_words = tonumber(ARGV[4])
+math.randomseed(tonumber(ARGV[5]))
+local partial = {}
+for i = 6, #ARGV do
+    partial[#partial + 1] = ARGV[i]
+end
+
+local function char_width(byte)
+    if byte >= 240 then
+        return 4
+    elseif byte >= 224 then
+        return 3
+    elseif byte >= 192 then
+        return 2
+    end
+    return 1
+end
+
+local function split(value)
+    local parts = {}
+    local start = 1
+    if separator == '' then
+        -- the ids are one character, two when the first one is a lead from U+100000, encoded from byte F4
+        while start <= #value do
+            local width = char_width(string.byte(value, start))
+            if string.byte(value, start) == 244 then
+                width = width + char_width(string.byte(value, start + width))
+            end
+            parts[#parts + 1] = string.sub(value, start, start + width - 1)
+            start = start + width
+        end
+        return parts
+    end
+    while true do
+        local found_start, found_end = string.find(value, separator, start, true)
+        if not found_start then
+            parts[#parts + 1] = string.sub(value, start)
+            return parts
+        end
+        parts[#parts + 1] = string.sub(value, start, found_start - 1)
+        start = found_end + 1
+    end
+end
+
+local function remove_stop(tokens)
+    for i = 1, #tokens do
+        if tokens[i] == stop then
+            table.remove(tokens, i)
+            return
+        end
+    end
+end
+
+while true do
+    local key = table.concat(partial, separator, math.max(1, #partial - key_length + 1), #partial)
+    if prefix ~= '' then
+        key = prefix .. '§' .. key
+    end
+    local completions = redis.call('ZREVRANGE', key, 0, -1, 'WITHSCORES')
+    if #completions == 0 then
+        remove_stop(partial)
+        return partial
+    end
+    local total = 0
+    for i = 2, #completions, 2 do
+        total = total + tonumber(completions[i])
+    end
+    local remaining = math.random() * total
+    local completion = completions[#completions - 1]
+    for i = 2, #completions, 2 do
+        remaining = remaining - tonumber(completions[i])
+        if remaining <= 0 then
+            completion = completions[i - 1]
+            break
+        end
+    end
+    completion = split(completion)
+    if #partial + #completion > max_words then
+        remove_stop(partial)
+        return partial
+    end
+    local complete = #partial + #completion == max_words
+    if complete then
+        remove_stop(completion)
+    end
+    for i = 1, #completion do
+        partial[#partial + 1] = completion[i]
+    end
+    if complete then
+        return partial
+    end
+end
+"""
+
+# allocates the numbers of the tokens of an interned model atomically, so concurrent builds agree on them.
+# A token is found by its field in one of the vocabulary hashes, and by its number in the list of tokens
+INTERN_SCRIPT = """
+local numbers = {}
+for i = 1, #ARGV / 2 do
+    local bucket = KEYS[i + 2]
+    local field = ARGV[2 * i - 1]
+    local number = redis.call('HGET', bucket, field)
+    if not number then
+        number = redis.call('INCR', KEYS[1]) - 1
+        redis.call('HSET', bucket, field, number)
+        redis.call('RPUSH', KEYS[2], ARGV[2 * i])
+    end
+    numbers[i] = tonumber(number)
+end
+return numbers
+"""
+# the vocabulary of an interned model is split in hashes small enough to keep the compact encoding of Redis,
+# up to about 60000 tokens
+VOCABULARY_BUCKETS = 128
+
+
+class Backend(object):
+    """
+    The storage of a model: for each key, the completions and their weights.
+    The keys and completions are strings built by make_key
+    """
+    def increment(self, key, completion, amount=1):
+        raise NotImplementedError()
+
+    def increment_many(self, increments, values=None, additions=None, counters=None):
+        """
+        Apply a dictionary of {(key, completion): amount} increments, and with them add the {set key: members}
+        additions, increment the counters (see increment_value) and store the {key: bytes} values
+        """
+        for (key, completion), amount in increments.items():
+            self.increment(key, completion, amount)
+        if additions:
+            self.add_to_sets(additions)
+        for key in counters or ():
+            self.increment_value(key)
+        if values:
+            self.set_values(values)
+
+    def completions(self, key):
+        """
+        The list of (completion, weight) for a key, by decreasing weight
+        """
+        raise NotImplementedError()
+
+    def completions_many(self, keys):
+        """
+        The completions of each of the keys, as a list in the same order
+        """
+        return [self.completions(key) for key in keys]
+
+    def sample_completion(self, key):
+        """
+        A random completion for the key, with probability proportional to its weight. None if there are none
+        """
+        return pick_weighted(self.completions(key))
+
+    def distributions_many(self, keys):
+        """
+        The completions of each of the keys compiled for sampling, as a list of FrozenCompletions
+        """
+        return [FrozenCompletions.from_completions(completions) for completions in self.completions_many(keys)]
+
+    def score(self, key, completion):
+        """
+        The weight of a completion for the key, None if not present
+        """
+        raise NotImplementedError()
+
+    def score_many(self, pairs):
+        """
+        The weights of a list of (key, completion), None for the ones not present
+        """
+        return [self.score(key, completion) for key, completion in pairs]
+
+    def max_score(self, key):
+        raise NotImplementedError()
+
+    def max_score_many(self, keys):
+        return [self.max_score(key) for key in keys]
+
+    def min_score(self, key):
+        raise NotImplementedError()
+
+    def random_key(self, prefix=None):
+        """
+        A random key of the model with the given prefix, None if there are none
+        """
+        raise NotImplementedError()
+
+    def find_keys(self, term, prefix=None):
+        """
+        The keys with the given prefix containing the term
+        """
+        raise NotImplementedError()
+
+    def iterate_keys(self, prefix):
+        """
+        Generate all the keys of the model with the given prefix
+        """
+        raise NotImplementedError()
+
+    def flush(self, prefix, batch_size=1000, progress=None):
+        """
+        Delete all the keys of the model with the given prefix, with its frozen completions and metadata.
+        progress, if given, is called with the number of keys deleted so far. Returns the number of deleted keys
+        """
+        raise NotImplementedError()
+
+    def prune(self, prefix, min_count=None, top_k=None, batch_size=1000, progress=None, terms_of=None):
+        """
+        Remove from every key of the model the completions with a weight lower than min_count and the ones beyond
+        the top_k heaviest, deleting the keys left empty with their frozen completions and index entries.
+        progress, if given, is called with the number of keys examined so far. terms_of gives the tokens of a key
+        for the term index, key_terms by default.
+        Returns the number of removed completions and the number of deleted keys
+        """
+        raise NotImplementedError()
+
+    def get_value(self, key):
+        """
+        The bytes stored at a key outside the model (frozen completions and metadata), None if not present
+        """
+        raise NotImplementedError()
+
+    def get_values(self, keys):
+        return [self.get_value(key) for key in keys]
+
+    def set_values(self, values):
+        """
+        Store a dictionary of {key: bytes} outside the model
+        """
+        raise NotImplementedError()
+
+    def delete_values(self, keys):
+        raise NotImplementedError()
+
+    def increment_value(self, key):
+        """
+        Increment the integer stored at a key outside the model, returning the new value
+        """
+        raise NotImplementedError()
+
+    def add_to_sets(self, additions):
+        """
+        Add members to sets stored outside the model, given as {set key: set of members}
+        """
+        raise NotImplementedError()
+
+    def are_members(self, set_key, members):
+        """
+        Whether each of the members is in a set, as a list of booleans
+        """
+        raise NotImplementedError()
+
+    def random_member(self, set_key):
+        """
+        A random member of a set, None if the set is empty
+        """
+        raise NotImplementedError()
+
+    def random_union_member(self, set_keys):
+        """
+        A random member of the union of some sets, None if they are all empty
+        """
+        raise NotImplementedError()
+
+    def intern_tokens(self, prefix, tokens):
+        """
+        The ids of the tokens in the vocabulary of a model, allocating them for the new ones
+        """
+        raise NotImplementedError()
+
+    def vocabulary_ids(self, prefix, tokens):
+        """
+        The ids of the tokens in the vocabulary of a model, None for the unknown ones
+        """
+        raise NotImplementedError()
+
+    def vocabulary_tokens(self, prefix, ids):
+        """
+        The tokens with the given ids in the vocabulary of a model, None for the unknown ones
+        """
+        raise NotImplementedError()
+
+    def memory_usage(self):
+        """
+        The memory used to store the models in bytes, None if not known
+        """
+        return None
+
+    def stats(self):
+        """
+        Statistics about the storage of the models, a dictionary for each node with its name, the number of keys
+        and the memory used in bytes
+        """
+        return []
+
+
+class RedisBackend(Backend):
+    """
+    Stores each key as a Redis sorted set of completions
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def increment(self, key, completion, amount=1):
+        self.client.zincrby(key, completion, amount)
+
+    def increment_many(self, increments, values=None, additions=None, counters=None):
+        # with values the pipeline is a MULTI/EXEC transaction, they are stored only with everything else
+        pipe = self.client.pipeline(transaction=bool(values))
+        for (key, completion), amount in increments.items():
+            pipe.zincrby(key, completion, amount)
+        for set_key, members in (additions or {}).items():
+            if len(members) > 0:
+                pipe.sadd(set_key, *members)
+        for key in counters or ():
+            pipe.incr(key)
+        if values:
+            pipe.mset(values)
+        pipe.execute()
+
+    def completions(self, key):
+        return [(c.decode('utf8'), w) for c, w in self.client.zrevrange(key, 0, -1, withscores=True)]
+
+    def completions_many(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrevrange(key, 0, -1, withscores=True)
+        return [[(c.decode('utf8'), w) for c, w in completions] for completions in pipe.execute()]
+
+    def score(self, key, completion):
+        return self.client.zscore(key, completion)
+
+    def score_many(self, pairs):
+        pipe = self.client.pipeline(transaction=False)
+        for key, completion in pairs:
+            pipe.zscore(key, completion)
+        return pipe.execute()
+
+    def max_score(self, key):
+        maximum = self.client.zrevrange(key, 0, 0, withscores=True)
+        if maximum:
+            return maximum[0][1]
+        else:
+            return 0
+
+    def max_score_many(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrevrange(key, 0, 0, withscores=True)
+        return [maximum[0][1] if maximum else 0 for maximum in pipe.execute()]
+
+    def min_score(self, key):
+        minimum = self.client.zrange(key, 0, 0, withscores=True)
+        if minimum:
+            return minimum[0][1]
+        else:
+            return 0
+
+    def random_key(self, prefix=None):
+        if prefix:
+            keys = self.client.keys("%s%s*" % (prefix, SEPARATOR))
+            if len(keys) == 0:
+                return None
+            key = random.choice(keys)
+        else:
+            key = self.client.randomkey()
+            if key is None:
+                return None
+        return key.decode('utf8')
+
+    def find_keys(self, term, prefix=None):
+        if prefix:
+            keys = self.client.keys("%s%s*%s*" % (prefix, SEPARATOR, term))
+        else:
+            keys = self.client.keys("*%s*" % term)
+        return [k.decode('utf8') for k in keys]
+
+    def iterate_keys(self, prefix):
+        for key in self.client.scan_iter(match="%s%s*" % (prefix, SEPARATOR), count=1000):
+            yield key.decode('utf8')
+
+    def flush(self, prefix, batch_size=1000, progress=None):
+        """
+        Delete the keys with SCAN and UNLINK in bounded batches, so Redis is never blocked for long.
+        The position is saved after each batch, an interrupted flush resumes from it when called again
+        """
+        # the metadata first, so the model is not considered frozen or indexed while it's being deleted
+        patterns = [SEPARATOR.join((META_PREFIX, prefix, '*')),
+                    SEPARATOR.join((FROZEN_PREFIX, prefix, '*')),
+                    SEPARATOR.join((prefix, '*'))]
+        state_key = SEPARATOR.join((META_PREFIX, 'flush', prefix))
+        state = self.client.get(state_key)
+        stage, cursor = 0, 0
+        if state is not None:
+            stage, cursor = [int(x) for x in state.decode('utf8').split(':')]
+        deleted_count = 0
+        while stage < len(patterns):
+            cursor, keys = self.client.scan(cursor, match=patterns[stage], count=batch_size)
+            if cursor == 0:
+                stage += 1
+            pipe = self.client.pipeline(transaction=False)
+            if len(keys) > 0:
+                pipe.execute_command('UNLINK', *keys)
+            pipe.set(state_key, '{0}:{1}'.format(stage, cursor))
+            pipe.execute()
+            if len(keys) > 0:
+                deleted_count += len(keys)
+                if progress is not None:
+                    progress(deleted_count)
+        self.client.delete(state_key)
+        return deleted_count
+
+    def prune(self, prefix, min_count=None, top_k=None, batch_size=1000, progress=None, terms_of=None):
+        """
+        Prune the keys found with SCAN in batches, each one a pipeline of ZREMRANGEBYSCORE and ZREMRANGEBYRANK.
+        Redis deletes the sorted sets left empty, their entries in the key indexes are removed afterwards
+        """
+        removed_count, deleted_keys, _ = self._prune_model_keys(prefix, min_count, top_k, batch_size, progress)
+        self._remove_from_indexes(prefix, deleted_keys, batch_size, terms_of)
+        return removed_count, len(deleted_keys)
+
+    def _prune_model_keys(self, prefix, min_count, top_k, batch_size, progress):
+        """
+        Prune the keys of the model, returning the number of removed completions, the keys left empty and the
+        number of examined keys
+        """
+        removed_count = 0
+        deleted_keys = []
+        examined_count = 0
+        keys = []
+        for key in self.client.scan_iter(match="%s%s*" % (prefix, SEPARATOR), count=batch_size):
+            keys.append(key.decode('utf8'))
+            if len(keys) >= batch_size:
+                removed_count += self._prune_keys(keys, min_count, top_k, deleted_keys)
+                examined_count += len(keys)
+                keys = []
+                if progress is not None:
+                    progress(examined_count)
+        removed_count += self._prune_keys(keys, min_count, top_k, deleted_keys)
+        examined_count += len(keys)
+        if progress is not None and len(keys) > 0:
+            progress(examined_count)
+        return removed_count, deleted_keys, examined_count
+
+    def _prune_keys(self, keys, min_count, top_k, deleted_keys):
+        if len(keys) == 0:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            if min_count is not None:
+                pipe.zremrangebyscore(key, '-inf', '({0}'.format(min_count))
+            if top_k is not None:
+                pipe.zremrangebyrank(key, 0, -top_k - 1)
+            pipe.zcard(key)
+        results = pipe.execute()
+        per_key = len(results) // len(keys)
+        removed_count = 0
+        for i, key in enumerate(keys):
+            key_results = results[i * per_key:(i + 1) * per_key]
+            removed_count += sum(key_results[:-1])
+            if key_results[-1] == 0:
+                deleted_keys.append(key)
+        return removed_count
+
+    def _remove_from_indexes(self, prefix, keys, batch_size=1000, terms_of=None):
+        terms_of = terms_of or key_terms
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            pipe = self.client.pipeline(transaction=False)
+            pipe.srem(meta_key(prefix, 'start_keys'), *batch)
+            pipe.srem(meta_key(prefix, 'keys'), *batch)
+            for key in batch:
+                for term in terms_of(key, prefix):
+                    pipe.srem(term_index_key(prefix, term), key)
+            pipe.delete(*[frozen_key(key) for key in batch])
+            pipe.execute()
+
+    def get_value(self, key):
+        return self.client.get(key)
+
+    def get_values(self, keys):
+        if len(keys) == 0:
+            return []
+        return self.client.mget(keys)
+
+    def set_values(self, values):
+        if len(values) > 0:
+            self.client.mset(values)
+
+    def delete_values(self, keys):
+        if len(keys) > 0:
+            self.client.delete(*keys)
+
+    def increment_value(self, key):
+        return self.client.incr(key)
+
+    def add_to_sets(self, additions):
+        pipe = self.client.pipeline(transaction=False)
+        for set_key, members in additions.items():
+            if len(members) > 0:
+                pipe.sadd(set_key, *members)
+        pipe.execute()
+
+    def are_members(self, set_key, members):
+        pipe = self.client.pipeline(transaction=False)
+        for member in members:
+            pipe.sismember(set_key, member)
+        return pipe.execute()
+
+    def set_sizes(self, set_keys):
+        pipe = self.client.pipeline(transaction=False)
+        for set_key in set_keys:
+            pipe.scard(set_key)
+        return pipe.execute()
+
+    def random_member(self, set_key):
+        member = self.client.srandmember(set_key)
+        if member is None:
+            return None
+        return member.decode('utf8')
+
+    def random_union_member(self, set_keys):
+        """
+        One of the sets is picked with probability proportional to its size, then a member of it, without
+        building the union on the server. A member of several sets is more likely than with a proper union
+        """
+        set_key = pick_weighted([(k, size) for k, size in zip(set_keys, self.set_sizes(set_keys)) if size > 0])
+        if set_key is None:
+            return None
+        return self.random_member(set_key)
+
+    def intern_tokens(self, prefix, tokens):
+        script = self.client.register_script(INTERN_SCRIPT)
+        fields = [vocabulary_field(token) for token in tokens]
+        keys = [meta_key(prefix, 'vocabulary_size'), meta_key(prefix, 'vocabulary_tokens')] + \
+            [vocabulary_bucket(prefix, field) for field in fields]
+        args = [arg for field, token in zip(fields, tokens) for arg in (field, token)]
+        return [to_id(number) for number in script(keys=keys, args=args)]
+
+    def vocabulary_ids(self, prefix, tokens):
+        pipe = self.client.pipeline(transaction=False)
+        for token in tokens:
+            field = vocabulary_field(token)
+            pipe.hget(vocabulary_bucket(prefix, field), field)
+        return [to_id(int(number)) if number is not None else None for number in pipe.execute()]
+
+    def vocabulary_tokens(self, prefix, ids):
+        pipe = self.client.pipeline(transaction=False)
+        for token_id in ids:
+            pipe.lindex(meta_key(prefix, 'vocabulary_tokens'), from_id(token_id))
+        return [t.decode('utf8') if t is not None else None for t in pipe.execute()]
+
+    def memory_usage(self):
+        return self.client.info('memory')['used_memory']
+
+    def name(self):
+        connection_kwargs = self.client.connection_pool.connection_kwargs
+        return '{0}:{1}'.format(connection_kwargs.get('host'), connection_kwargs.get('port'))
+
+    def stats(self):
+        return [{'node': self.name(), 'keys': self.client.dbsize(), 'memory': self.memory_usage()}]
+
+
+class HashRing(object):
+    """
+    Consistent hashing of the keys on some nodes: each node is placed on a ring of hashes in a number of points,
+    and a key belongs to the node of the first point after its hash. Adding a node moves only the keys that
+    belong to it
+    """
+    def __init__(self, names, replicas=160):
+        points = sorted((zlib.crc32('{0}#{1}'.format(name, i).encode('utf8')), node)
+                        for node, name in enumerate(names) for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key):
+        """
+        The index of the node of a key
+        """
+        position = bisect.bisect(self.hashes, zlib.crc32(key.encode('utf8')))
+        return self.nodes[position % len(self.nodes)]
+
+
+class ShardedRedisBackend(Backend):
+    """
+    Stores a model across several Redis nodes, each key of the model on the node chosen by consistent hashing
+    and its frozen completions with it. The values and the sets outside the model are placed by their own key,
+    the vocabulary of an interned model is on a single node.
+    The batched reads and writes send a pipeline to each node involved
+    """
+    def __init__(self, backends):
+        self.backends = backends
+        self.ring = HashRing([backend.name() for backend in backends])
+
+    def _node_index(self, key):
+        """
+        The index of the node of a key, the frozen completions of a key are on the node of the key
+        """
+        if key.startswith(FROZEN_PREFIX + SEPARATOR):
+            key = key[len(FROZEN_PREFIX) + len(SEPARATOR):]
+        return self.ring.node(key)
+
+    def node(self, key):
+        return self.backends[self._node_index(key)]
+
+    def _group(self, items, key=lambda item: item):
+        """
+        Group a list of items by node, as {node index: list of (position, item)}
+        """
+        groups = {}
+        for position, item in enumerate(items):
+            groups.setdefault(self._node_index(key(item)), []).append((position, item))
+        return groups
+
+    def _map_many(self, items, method, key=lambda item: item):
+        """
+        Call a *_many method of the nodes on the items belonging to each one, with the results in the order of items
+        """
+        results = [None] * len(items)
+        for node, group in self._group(items, key).items():
+            for (position, _), result in zip(group, method(self.backends[node], [item for _, item in group])):
+                results[position] = result
+        return results
+
+    def increment(self, key, completion, amount=1):
+        self.node(key).increment(key, completion, amount)
+
+    def increment_many(self, increments, values=None, additions=None, counters=None):
+        """
+        Each node stores its values with its increments, there's no transaction across the nodes
+        """
+        groups = {}
+        for (key, completion), amount in increments.items():
+            groups.setdefault(self._node_index(key), {})[(key, completion)] = amount
+        value_groups = {}
+        for key, value in (values or {}).items():
+            value_groups.setdefault(self._node_index(key), {})[key] = value
+        addition_groups = {}
+        for set_key, members in (additions or {}).items():
+            addition_groups.setdefault(self._node_index(set_key), {})[set_key] = members
+        counter_groups = {}
+        for key in counters or ():
+            counter_groups.setdefault(self._node_index(key), []).append(key)
+        for node in set(groups) | set(value_groups) | set(addition_groups) | set(counter_groups):
+            self.backends[node].increment_many(groups.get(node, {}), value_groups.get(node),
+                                               addition_groups.get(node), counter_groups.get(node))
+
+    def completions(self, key):
+        return self.node(key).completions(key)
+
+    def completions_many(self, keys):
+        return self._map_many(keys, lambda backend, items: backend.completions_many(items))
+
+    def score(self, key, completion):
+        return self.node(key).score(key, completion)
+
+    def score_many(self, pairs):
+        return self._map_many(pairs, lambda backend, items: backend.score_many(items), key=lambda pair: pair[0])
+
+    def max_score(self, key):
+        return self.node(key).max_score(key)
+
+    def max_score_many(self, keys):
+        return self._map_many(keys, lambda backend, items: backend.max_score_many(items))
+
+    def min_score(self, key):
+        return self.node(key).min_score(key)
+
+    def random_key(self, prefix=None):
+        # a node with probability proportional to its number of keys, then a key of it
+        backends = list(self.backends)
+        sizes = [backend.client.dbsize() for backend in backends]
+        while len(backends) > 0 and sum(sizes) > 0:
+            i = pick_weighted(list(zip(range(len(backends)), sizes)))
+            key = backends[i].random_key(prefix)
+            if key is not None:
+                return key
+            del backends[i]
+            del sizes[i]
+        return None
+
+    def find_keys(self, term, prefix=None):
+        return [key for backend in self.backends for key in backend.find_keys(term, prefix)]
+
+    def iterate_keys(self, prefix):
+        return itertools.chain.from_iterable(backend.iterate_keys(prefix) for backend in self.backends)
+
+    def flush(self, prefix, batch_size=1000, progress=None):
+        deleted_count = 0
+        for backend in self.backends:
+            deleted_count += backend.flush(prefix, batch_size=batch_size,
+                                           progress=offset_progress(progress, deleted_count))
+        return deleted_count
+
+    def prune(self, prefix, min_count=None, top_k=None, batch_size=1000, progress=None, terms_of=None):
+        terms_of = terms_of or key_terms
+        removed_count = 0
+        examined_count = 0
+        deleted_keys = []
+        for backend in self.backends:
+            node_removed_count, node_deleted_keys, node_examined_count = backend._prune_model_keys(
+                prefix, min_count, top_k, batch_size, offset_progress(progress, examined_count))
+            removed_count += node_removed_count
+            deleted_keys += node_deleted_keys
+            examined_count += node_examined_count
+        # the indexes of the deleted keys can be on any node
+        for i in range(0, len(deleted_keys), batch_size):
+            batch = deleted_keys[i:i + batch_size]
+            removals = {}
+            for key in batch:
+                for set_key in [meta_key(prefix, 'start_keys'), meta_key(prefix, 'keys')] + \
+                        [term_index_key(prefix, term) for term in terms_of(key, prefix)]:
+                    removals.setdefault(set_key, []).append(key)
+            pipes = [backend.client.pipeline(transaction=False) for backend in self.backends]
+            for set_key, members in removals.items():
+                pipes[self._node_index(set_key)].srem(set_key, *members)
+            for node, group in self._group([frozen_key(key) for key in batch]).items():
+                pipes[node].delete(*[key for _, key in group])
+            for pipe in pipes:
+                pipe.execute()
+        return removed_count, len(deleted_keys)
+
+    def get_value(self, key):
+        return self.node(key).get_value(key)
+
+    def get_values(self, keys):
+        return self._map_many(keys, lambda backend, items: backend.get_values(items))
+
+    def set_values(self, values):
+        for node, group in self._group(list(values)).items():
+            self.backends[node].set_values({key: values[key] for _, key in group})
+
+    def delete_values(self, keys):
+        for node, group in self._group(keys).items():
+            self.backends[node].delete_values([key for _, key in group])
+
+    def increment_value(self, key):
+        return self.node(key).increment_value(key)
+
+    def add_to_sets(self, additions):
+        groups = {}
+        for set_key, members in additions.items():
+            groups.setdefault(self._node_index(set_key), {})[set_key] = members
+        for node, node_additions in groups.items():
+            self.backends[node].add_to_sets(node_additions)
+
+    def are_members(self, set_key, members):
+        return self.node(set_key).are_members(set_key, members)
+
+    def random_member(self, set_key):
+        return self.node(set_key).random_member(set_key)
+
+    def random_union_member(self, set_keys):
+        """
+        The sets can be on different nodes: one of them is picked with probability proportional to its size,
+        then a member of it. A member of several sets is more likely than with a proper union
+        """
+        sizes = self._map_many(list(set_keys), lambda backend, items: backend.set_sizes(items))
+        set_key = pick_weighted([(k, size) for k, size in zip(set_keys, sizes) if size > 0])
+        if set_key is None:
+            return None
+        return self.random_member(set_key)
+
+    def intern_tokens(self, prefix, tokens):
+        return self.node(meta_key(prefix, 'vocabulary')).intern_tokens(prefix, tokens)
+
+    def vocabulary_ids(self, prefix, tokens):
+        return self.node(meta_key(prefix, 'vocabulary')).vocabulary_ids(prefix, tokens)
+
+    def vocabulary_tokens(self, prefix, ids):
+        return self.node(meta_key(prefix, 'vocabulary')).vocabulary_tokens(prefix, ids)
+
+    def memory_usage(self):
+        return sum(backend.memory_usage() for backend in self.backends)
+
+    def stats(self):
+        return [stats for backend in self.backends for stats in backend.stats()]
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps the model in the memory of the process, without Redis.
+    The tokens of the keys and the completions are interned as integer ids, and the completions are stored
+    in CSR-style arrays: the completions of the key in row r are the elements of completion_ids and weights
+    from completion_offsets[r] to completion_offsets[r + 1], by decreasing weight.
+    Increments are buffered and merged into the arrays before the next read
+    """
+    def __init__(self):
+        self.tokens = []
+        self.token_ids = {}
+        # the token ids of the key in row r are key_tokens[key_offsets[r]:key_offsets[r + 1]]
+        self.key_rows = {}
+        self.key_tokens = array('l')
+        self.key_offsets = array('l', [0])
+        self.completion_offsets = array('l', [0])
+        self.completion_ids = array('l')
+        self.weights = array('d')
+        # {row: {completion id: amount}} not yet merged into the arrays
+        self.pending = {}
+        # the values and sets stored outside the model, like frozen completions and key indexes
+        self.values = {}
+        self.sets = {}
+        # {prefix: [id to token list, {token: id}]} for interned models
+        self.vocabularies = {}
+
+    def _intern(self, token):
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.tokens.append(token)
+            self.token_ids[token] = token_id
+        return token_id
+
+    def _row(self, key, create=False):
+        """
+        The row of a key, None if the key is not in the model
+        """
+        if create:
+            key_ids = tuple(self._intern(t) for t in key.split(SEPARATOR))
+        else:
+            key_ids = tuple(self.token_ids.get(t, -1) for t in key.split(SEPARATOR))
+        row = self.key_rows.get(key_ids)
+        if row is None and create:
+            row = len(self.key_rows)
+            self.key_rows[key_ids] = row
+            self.key_tokens.extend(key_ids)
+            self.key_offsets.append(len(self.key_tokens))
+        return row
+
+    def _key(self, row):
+        return SEPARATOR.join(self.tokens[t] for t in self.key_tokens[self.key_offsets[row]:self.key_offsets[row + 1]])
+
+    def _row_range(self, row):
+        if len(self.pending) > 0:
+            self.compact()
+        return self.completion_offsets[row], self.completion_offsets[row + 1]
+
+    def compact(self):
+        """
+        Merge the buffered increments into the completion arrays
+        """
+        completion_offsets = array('l', [0])
+        completion_ids = array('l')
+        weights = array('d')
+        merged_rows = len(self.completion_offsets) - 1
+        for row in range(len(self.key_rows)):
+            start, end = 0, 0
+            if row < merged_rows:
+                start, end = self.completion_offsets[row], self.completion_offsets[row + 1]
+            increments = self.pending.get(row)
+            if increments is None:
+                completion_ids.extend(self.completion_ids[start:end])
+                weights.extend(self.weights[start:end])
+            else:
+                merged = dict(zip(self.completion_ids[start:end], self.weights[start:end]))
+                for completion_id, amount in increments.items():
+                    merged[completion_id] = merged.get(completion_id, 0) + amount
+                for completion_id, weight in sorted(merged.items(), key=lambda c: c[1], reverse=True):
+                    completion_ids.append(completion_id)
+                    weights.append(weight)
+            completion_offsets.append(len(completion_ids))
+        self.completion_offsets = completion_offsets
+        self.completion_ids = completion_ids
+        self.weights = weights
+        self.pending = {}
+
+    def increment(self, key, completion, amount=1):
+        increments = self.pending.setdefault(self._row(key, create=True), {})
+        completion_id = self._intern(completion)
+        increments[completion_id] = increments.get(completion_id, 0) + amount
+
+    def completions(self, key):
+        row = self._row(key)
+        if row is None:
+            return []
+        start, end = self._row_range(row)
+        return [(self.tokens[c], w) for c, w in zip(self.completion_ids[start:end], self.weights[start:end])]
+
+    def score(self, key, completion):
+        row = self._row(key)
+        completion_id = self.token_ids.get(completion)
+        if row is None or completion_id is None:
+            return None
+        start, end = self._row_range(row)
+        for i in range(start, end):
+            if self.completion_ids[i] == completion_id:
+                return self.weights[i]
+        return None
+
+    def max_score(self, key):
+        row = self._row(key)
+        if row is None:
+            return 0
+        start, end = self._row_range(row)
+        return self.weights[start] if end > start else 0
+
+    def min_score(self, key):
+        row = self._row(key)
+        if row is None:
+            return 0
+        start, end = self._row_range(row)
+        return self.weights[end - 1] if end > start else 0
+
+    def random_key(self, prefix=None):
+        if prefix:
+            prefix_id = self.token_ids.get(prefix)
+            rows = [r for r in range(len(self.key_rows)) if self.key_tokens[self.key_offsets[r]] == prefix_id]
+        else:
+            rows = range(len(self.key_rows))
+        if len(rows) == 0:
+            return None
+        return self._key(random.choice(rows))
+
+    def find_keys(self, term, prefix=None):
+        keys = []
+        for row in range(len(self.key_rows)):
+            key = self._key(row)
+            if prefix:
+                if key.startswith(prefix + SEPARATOR) and term in key[len(prefix) + len(SEPARATOR):]:
+                    keys.append(key)
+            elif term in key:
+                keys.append(key)
+        return keys
+
+    def iterate_keys(self, prefix):
+        prefix_id = self.token_ids.get(prefix)
+        for row in range(len(self.key_rows)):
+            if self.key_tokens[self.key_offsets[row]] == prefix_id:
+                yield self._key(row)
+
+    def get_value(self, key):
+        return self.values.get(key)
+
+    def set_values(self, values):
+        self.values.update(values)
+
+    def delete_values(self, keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def increment_value(self, key):
+        value = int(self.values.get(key, b'0')) + 1
+        self.values[key] = str(value).encode('utf8')
+        return value
+
+    def add_to_sets(self, additions):
+        for set_key, members in additions.items():
+            self.sets.setdefault(set_key, set()).update(members)
+
+    def are_members(self, set_key, members):
+        stored = self.sets.get(set_key, ())
+        return [member in stored for member in members]
+
+    def random_member(self, set_key):
+        members = self.sets.get(set_key)
+        if not members:
+            return None
+        return random.choice(tuple(members))
+
+    def random_union_member(self, set_keys):
+        members = set().union(*(self.sets.get(set_key, ()) for set_key in set_keys))
+        if len(members) == 0:
+            return None
+        return random.choice(tuple(members))
+
+    def intern_tokens(self, prefix, tokens):
+        id_tokens, token_ids = self.vocabularies.setdefault(prefix, ([], {}))
+        ids = []
+        for token in tokens:
+            if token not in token_ids:
+                token_ids[token] = to_id(len(id_tokens))
+                id_tokens.append(token)
+            ids.append(token_ids[token])
+        return ids
+
+    def vocabulary_ids(self, prefix, tokens):
+        id_tokens, token_ids = self.vocabularies.get(prefix, ([], {}))
+        return [token_ids.get(t) for t in tokens]
+
+    def vocabulary_tokens(self, prefix, ids):
+        id_tokens, token_ids = self.vocabularies.get(prefix, ([], {}))
+        return [id_tokens[from_id(i)] if from_id(i) < len(id_tokens) else None for i in ids]
+
+    def flush(self, prefix, batch_size=1000, progress=None):
+        if len(self.pending) > 0:
+            self.compact()
+        prefix_id = self.token_ids.get(prefix)
+        kept = [r for r in range(len(self.key_rows)) if self.key_tokens[self.key_offsets[r]] != prefix_id]
+        deleted_count = len(self.key_rows) - len(kept)
+        self._keep_rows(kept)
+        outside = (SEPARATOR.join((META_PREFIX, prefix, '')), SEPARATOR.join((FROZEN_PREFIX, prefix, '')))
+        for stored in (self.values, self.sets):
+            for key in [k for k in stored if k.startswith(outside)]:
+                del stored[key]
+                deleted_count += 1
+        if progress is not None:
+            progress(deleted_count)
+        return deleted_count
+
+    def prune(self, prefix, min_count=None, top_k=None, batch_size=1000, progress=None, terms_of=None):
+        if len(self.pending) > 0:
+            self.compact()
+        prefix_id = self.token_ids.get(prefix)
+        # the completions of a row are sorted by decreasing weight, the pruned ones are at the end of the row
+        ends = array('l', self.completion_offsets[1:])
+        removed_count = 0
+        kept = []
+        deleted_keys = []
+        for row in range(len(self.key_rows)):
+            start, end = self.completion_offsets[row], ends[row]
+            if self.key_tokens[self.key_offsets[row]] == prefix_id:
+                if top_k is not None:
+                    end = min(end, start + top_k)
+                if min_count is not None:
+                    while end > start and self.weights[end - 1] < min_count:
+                        end -= 1
+                removed_count += ends[row] - end
+                ends[row] = end
+            if end > start:
+                kept.append(row)
+            else:
+                deleted_keys.append(self._key(row))
+        examined_count = len(self.key_rows)
+        self._keep_rows(kept, ends)
+        self._remove_from_indexes(prefix, deleted_keys, terms_of or key_terms)
+        if progress is not None:
+            progress(examined_count)
+        return removed_count, len(deleted_keys)
+
+    def _remove_from_indexes(self, prefix, keys, terms_of):
+        index_keys = [meta_key(prefix, 'start_keys'), meta_key(prefix, 'keys')]
+        for key in keys:
+            for set_key in index_keys + [term_index_key(prefix, term) for term in terms_of(key, prefix)]:
+                members = self.sets.get(set_key)
+                if members is not None:
+                    members.discard(key)
+                    if len(members) == 0:
+                        del self.sets[set_key]
+            self.values.pop(frozen_key(key), None)
+
+    def _keep_rows(self, kept, ends=None):
+        """
+        Rebuild the arrays keeping only the given rows, and for each row the completions before ends[row] if given
+        """
+        key_tokens = array('l')
+        key_offsets = array('l', [0])
+        completion_offsets = array('l', [0])
+        completion_ids = array('l')
+        weights = array('d')
+        for row in kept:
+            key_tokens.extend(self.key_tokens[self.key_offsets[row]:self.key_offsets[row + 1]])
+            key_offsets.append(len(key_tokens))
+            start, end = self.completion_offsets[row], self.completion_offsets[row + 1]
+            if ends is not None:
+                end = ends[row]
+            completion_ids.extend(self.completion_ids[start:end])
+            weights.extend(self.weights[start:end])
+            completion_offsets.append(len(completion_ids))
+        self.key_tokens = key_tokens
+        self.key_offsets = key_offsets
+        self.completion_offsets = completion_offsets
+        self.completion_ids = completion_ids
+        self.weights = weights
+        self._index_rows()
+
+    def _index_rows(self):
+        self.key_rows = {}
+        for row in range(len(self.key_offsets) - 1):
+            self.key_rows[tuple(self.key_tokens[self.key_offsets[row]:self.key_offsets[row + 1]])] = row
+
+    def memory_usage(self):
+        """
+        The size of the arrays of the model, the tokens and the values outside the model are not counted
+        """
+        if len(self.pending) > 0:
+            self.compact()
+        return sum(a.itemsize * len(a) for a in (self.key_tokens, self.key_offsets, self.completion_offsets,
+                                                 self.completion_ids, self.weights))
+
+    def save(self, path):
+        """
+        Write the model on disk, it can be read back with MemoryBackend.load
+        """
+        if len(self.pending) > 0:
+            self.compact()
+        with open(path, 'wb') as f:
+            pickle.dump({'tokens': self.tokens,
+                         'key_tokens': self.key_tokens,
+                         'key_offsets': self.key_offsets,
+                         'completion_offsets': self.completion_offsets,
+                         'completion_ids': self.completion_ids,
+                         'weights': self.weights,
+                         'values': self.values,
+                         'sets': self.sets,
+                         'vocabularies': self.vocabularies}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        backend = cls()
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+        backend.tokens = model['tokens']
+        backend.token_ids = {t: i for i, t in enumerate(backend.tokens)}
+        backend.key_tokens = model['key_tokens']
+        backend.key_offsets = model['key_offsets']
+        backend.completion_offsets = model['completion_offsets']
+        backend.completion_ids = model['completion_ids']
+        backend.weights = model['weights']
+        backend.values = model.get('values', {})
+        backend.sets = model.get('sets', {})
+        backend.vocabularies = model.get('vocabularies', {})
+        backend._index_rows()
+        return backend
+
+
+class FrozenCompletions(object):
+    """
+    The completions of a key compiled for sampling, see freeze().
+    The completions are sorted, with their cumulative weights: a draw is a binary search on the cumulative
+    weights and the score of a completion a binary search on the completions.
+    The serialized form is a header with the number of completions and the maximum weight, the cumulative
+    weights, the offsets of the completions in the UTF-8 data and the data itself
+    """
+    HEADER = struct.Struct('<Id')
+
+    def __init__(self, cumulative, offsets, data, maximum):
+        self.cumulative = cumulative
+        self.offsets = offsets
+        self.data = data
+        self.maximum = maximum
+
+    @classmethod
+    def from_completions(cls, completions):
+        completions = sorted((c.encode('utf8'), w) for c, w in completions)
+        cumulative = array('d', itertools.accumulate(w for _, w in completions))
+        offsets = array('I', itertools.accumulate(itertools.chain([0], (len(c) for c, _ in completions))))
+        maximum = max((w for _, w in completions), default=0)
+        return cls(cumulative, offsets, b''.join(c for c, _ in completions), maximum)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        count, maximum = cls.HEADER.unpack_from(blob)
+        position = cls.HEADER.size
+        cumulative = array('d')
+        cumulative.frombytes(blob[position:position + 8 * count])
+        position += 8 * count
+        offsets = array('I')
+        offsets.frombytes(blob[position:position + 4 * (count + 1)])
+        position += 4 * (count + 1)
+        if sys.byteorder == 'big':
+            cumulative.byteswap()
+            offsets.byteswap()
+        return cls(cumulative, offsets, blob[position:], maximum)
+
+    def to_bytes(self):
+        cumulative = array('d', self.cumulative)
+        offsets = array('I', self.offsets)
+        if sys.byteorder == 'big':
+            cumulative.byteswap()
+            offsets.byteswap()
+        return self.HEADER.pack(len(self), self.maximum) + cumulative.tobytes() + offsets.tobytes() + self.data
+
+    def __len__(self):
+        return len(self.cumulative)
+
+    def completion(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf8')
+
+    def weight(self, i):
+        return self.cumulative[i] - (self.cumulative[i - 1] if i > 0 else 0)
+
+    def completions(self):
+        return sorted(((self.completion(i), self.weight(i)) for i in range(len(self))),
+                      key=lambda c: c[1], reverse=True)
+
+    def sample(self):
+        if len(self) == 0:
+            return None
+        position = bisect.bisect_left(self.cumulative, random.uniform(0, self.cumulative[-1]))
+        return self.completion(min(position, len(self) - 1))
+
+    def score(self, completion):
+        target = completion.encode('utf8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.data[self.offsets[middle]:self.offsets[middle + 1]] < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.data[self.offsets[low]:self.offsets[low + 1]] == target:
+            return self.weight(low)
+        return None
+
+
+class BackendWrapper(Backend):
+    """
+    A backend adding some behaviour on top of another one, everything not overridden is delegated to it
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def increment(self, key, completion, amount=1):
+        self.backend.increment(key, completion, amount)
+
+    def increment_many(self, increments, values=None, additions=None, counters=None):
+        self.backend.increment_many(increments, values, additions, counters)
+
+    def completions(self, key):
+        return self.backend.completions(key)
+
+    def completions_many(self, keys):
+        return self.backend.completions_many(keys)
+
+    def sample_completion(self, key):
+        return self.backend.sample_completion(key)
+
+    def distributions_many(self, keys):
+        return self.backend.distributions_many(keys)
+
+    def score(self, key, completion):
+        return self.backend.score(key, completion)
+
+    def score_many(self, pairs):
+        return self.backend.score_many(pairs)
+
+    def max_score(self, key):
+        return self.backend.max_score(key)
+
+    def max_score_many(self, keys):
+        return self.backend.max_score_many(keys)
+
+    def min_score(self, key):
+        return self.backend.min_score(key)
+
+    def random_key(self, prefix=None):
+        return self.backend.random_key(prefix)
+
+    def find_keys(self, term, prefix=None):
+        return self.backend.find_keys(term, prefix)
+
+    def iterate_keys(self, prefix):
+        return self.backend.iterate_keys(prefix)
+
+    def flush(self, prefix, batch_size=1000, progress=None):
+        return self.backend.flush(prefix, batch_size=batch_size, progress=progress)
+
+    def prune(self, prefix, min_count=None, top_k=None, batch_size=1000, progress=None, terms_of=None):
+        return self.backend.prune(prefix, min_count=min_count, top_k=top_k, batch_size=batch_size,
+                                  progress=progress, terms_of=terms_of)
+
+    def get_value(self, key):
+        return self.backend.get_value(key)
+
+    def get_values(self, keys):
+        return self.backend.get_values(keys)
+
+    def set_values(self, values):
+        self.backend.set_values(values)
+
+    def delete_values(self, keys):
+        self.backend.delete_values(keys)
+
+    def increment_value(self, key):
+        return self.backend.increment_value(key)
+
+    def add_to_sets(self, additions):
+        self.backend.add_to_sets(additions)
+
+    def are_members(self, set_key, members):
+        return self.backend.are_members(set_key, members)
+
+    def random_member(self, set_key):
+        return self.backend.random_member(set_key)
+
+    def random_union_member(self, set_keys):
+        return self.backend.random_union_member(set_keys)
+
+    def intern_tokens(self, prefix, tokens):
+        return self.backend.intern_tokens(prefix, tokens)
+
+    def vocabulary_ids(self, prefix, tokens):
+        return self.backend.vocabulary_ids(prefix, tokens)
+
+    def vocabulary_tokens(self, prefix, ids):
+        return self.backend.vocabulary_tokens(prefix, ids)
+
+    def memory_usage(self):
+        return self.backend.memory_usage()
+
+    def stats(self):
+        return self.backend.stats()
+
+
+class FrozenBackend(BackendWrapper):
+    """
+    Reads the completions of a model frozen with freeze(), with a single GET per key. The keys without frozen
+    completions, e.g. while another process unfreezes the model, are read from the model itself.
+    Writes and key lookups are delegated to the backend of the model
+    """
+    def __init__(self, backend):
+        super().__init__(backend)
+        # scoring reads the same key twice in a row (score and maximum), keep the last one
+        self._last = (None, None)
+
+    def frozen_completions(self, key):
+        if self._last[0] != key:
+            blob = self.backend.get_value(frozen_key(key))
+            if blob is not None:
+                frozen = FrozenCompletions.from_bytes(blob)
+            else:
+                frozen = FrozenCompletions.from_completions(self.backend.completions(key))
+            self._last = (key, frozen)
+        return self._last[1]
+
+    def _frozen_many(self, keys):
+        frozen = [FrozenCompletions.from_bytes(blob) if blob is not None else None
+                  for blob in self.backend.get_values([frozen_key(key) for key in keys])]
+        missing = [i for i, f in enumerate(frozen) if f is None]
+        if len(missing) > 0:
+            for i, completions in zip(missing, self.backend.completions_many([keys[i] for i in missing])):
+                frozen[i] = FrozenCompletions.from_completions(completions)
+        return frozen
+
+    def completions(self, key):
+        return self.frozen_completions(key).completions()
+
+    def completions_many(self, keys):
+        return [f.completions() for f in self._frozen_many(keys)]
+
+    def sample_completion(self, key):
+        return self.frozen_completions(key).sample()
+
+    def distributions_many(self, keys):
+        return self._frozen_many(keys)
+
+    def score(self, key, completion):
+        return self.frozen_completions(key).score(completion)
+
+    def score_many(self, pairs):
+        keys = list({key for key, _ in pairs})
+        frozen = dict(zip(keys, self._frozen_many(keys)))
+        return [frozen[key].score(completion) for key, completion in pairs]
+
+    def max_score(self, key):
+        return self.frozen_completions(key).maximum
+
+    def max_score_many(self, keys):
+        return [f.maximum for f in self._frozen_many(keys)]
+
+    def min_score(self, key):
+        frozen = self.frozen_completions(key)
+        if len(frozen) == 0:
+            return 0
+        return min(frozen.weight(i) for i in range(len(frozen)))
+
+
+class CachedBackend(BackendWrapper):
+    """
+    Keeps in a bounded LRU cache the completions and the maximum weight of the keys read from the backend.
+    The Markov using it empties it with clear() when the model changes, see Markov.check_version()
+    """
+    def __init__(self, backend, max_size=10000):
+        super().__init__(backend)
+        self.max_size = max_size
+        # {key: FrozenCompletions} and {key: maximum weight}
+        self.distributions = OrderedDict()
+        self.maxima = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.distributions.clear()
+        self.maxima.clear()
+
+    def _lookup(self, cache, key):
+        value = cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            cache.move_to_end(key)
+        return value
+
+    def _store(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def distribution(self, key):
+        distribution = self._lookup(self.distributions, key)
+        if distribution is None:
+            if isinstance(self.backend, FrozenBackend):
+                distribution = self.backend.frozen_completions(key)
+            if distribution is None:
+                distribution = FrozenCompletions.from_completions(self.backend.completions(key))
+            self._store(self.distributions, key, distribution)
+        return distribution
+
+    def completions(self, key):
+        return self.distribution(key).completions()
+
+    def sample_completion(self, key):
+        return self.distribution(key).sample()
+
+    def distributions_many(self, keys):
+        distributions = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            distributions[i] = self._lookup(self.distributions, key)
+            if distributions[i] is None:
+                missing.append(i)
+        for i, distribution in zip(missing, self.backend.distributions_many([keys[i] for i in missing])):
+            distributions[i] = distribution
+            self._store(self.distributions, keys[i], distribution)
+        return distributions
+
+    def score(self, key, completion):
+        distribution = self.distributions.get(key)
+        if distribution is not None:
+            return distribution.score(completion)
+        return self.backend.score(key, completion)
+
+    def score_many(self, pairs):
+        scores = [None] * len(pairs)
+        missing = []
+        for i, (key, completion) in enumerate(pairs):
+            distribution = self.distributions.get(key)
+            if distribution is not None:
+                scores[i] = distribution.score(completion)
+            else:
+                missing.append(i)
+        for i, score in zip(missing, self.backend.score_many([pairs[i] for i in missing])):
+            scores[i] = score
+        return scores
+
+    def max_score(self, key):
+        distribution = self.distributions.get(key)
+        if distribution is not None:
+            return distribution.maximum
+        maximum = self._lookup(self.maxima, key)
+        if maximum is None:
+            maximum = self.backend.max_score(key)
+            self._store(self.maxima, key, maximum)
+        return maximum
+
+    def max_score_many(self, keys):
+        maxima = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            distribution = self.distributions.get(key)
+            if distribution is not None:
+                maxima[i] = distribution.maximum
+            else:
+                maxima[i] = self._lookup(self.maxima, key)
+                if maxima[i] is None:
+                    missing.append(i)
+        for i, maximum in zip(missing, self.backend.max_score_many([keys[i] for i in missing])):
+            maxima[i] = maximum
+            self._store(self.maxima, keys[i], maximum)
+        return maxima
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'distributions': len(self.distributions),
+                'maxima': len(self.maxima), 'max_size': self.max_size}
+
+
+class PackedBackend(BackendWrapper):
+    """
+    Stores the keys and completions of interned models without separators: their ids are single characters (see
+    to_id), so they are concatenated and split back by character. The rest of the code sees the keys built by
+    make_key. The models with other prefixes, e.g. sharing a writer, are passed through unchanged
+    """
+    def __init__(self, backend, prefixes):
+        super().__init__(backend)
+        self.prefixes = set(prefixes)
+
+    def is_packed(self, key):
+        return key.partition(SEPARATOR)[0] in self.prefixes
+
+    def pack(self, key):
+        prefix, separator, ids = key.partition(SEPARATOR)
+        if prefix == FROZEN_PREFIX:
+            return prefix + separator + self.pack(ids)
+        if prefix not in self.prefixes:
+            return key
+        return prefix + separator + pack_ids(ids.split(SEPARATOR))
+
+    def unpack(self, key):
+        prefix, separator, ids = key.partition(SEPARATOR)
+        if prefix not in self.prefixes:
+            return key
+        return prefix + separator + SEPARATOR.join(split_ids(ids))
+
+    def pack_completion(self, key, completion):
+        if not self.is_packed(key):
+            return completion
+        return pack_ids(completion.split(SEPARATOR))
+
+    def unpack_completions(self, key, completions):
+        if not self.is_packed(key):
+            return completions
+        return [(SEPARATOR.join(split_ids(completion)), weight) for completion, weight in completions]
+
+    def packed_terms(self, key, prefix=None):
+        return key_terms(self.unpack(key), prefix)
+
+    def increment(self, key, completion, amount=1):
+        self.backend.increment(self.pack(key), self.pack_completion(key, completion), amount)
+
+    def increment_many(self, increments, values=None, additions=None, counters=None):
+        packed = {(self.pack(key), self.pack_completion(key, completion)): amount
+                  for (key, completion), amount in increments.items()}
+        self.backend.increment_many(packed, {self.pack(key): value for key, value in values.items()}
+                                    if values else values, self.pack_additions(additions or {}), counters)
+
+    def completions(self, key):
+        return self.unpack_completions(key, self.backend.completions(self.pack(key)))
+
+    def completions_many(self, keys):
+        return [self.unpack_completions(key, completions)
+                for key, completions in zip(keys, self.backend.completions_many([self.pack(k) for k in keys]))]
+
+    def sample_completion(self, key):
+        completion = self.backend.sample_completion(self.pack(key))
+        if completion is None:
+            return None
+        return self.unpack_completions(key, [(completion, None)])[0][0]
+
+    def distributions_many(self, keys):
+        return [FrozenCompletions.from_completions(completions) for completions in self.completions_many(keys)]
+
+    def score(self, key, completion):
+        return self.backend.score(self.pack(key), self.pack_completion(key, completion))
+
+    def score_many(self, pairs):
+        return self.backend.score_many([(self.pack(key), self.pack_completion(key, completion))
+                                        for key, completion in pairs])
+
+    def max_score(self, key):
+        return self.backend.max_score(self.pack(key))
+
+    def max_score_many(self, keys):
+        return self.backend.max_score_many([self.pack(key) for key in keys])
+
+    def min_score(self, key):
+        return self.backend.min_score(self.pack(key))
+
+    def random_key(self, prefix=None):
+        key = self.backend.random_key(prefix)
+        return self.unpack(key) if key is not None else None
+
+    def find_keys(self, term, prefix=None):
+        return [self.unpack(key) for key in self.backend.find_keys(term, prefix)]
+
+    def iterate_keys(self, prefix):
+        return (self.unpack(key) for key in self.backend.iterate_keys(prefix))
+
+    def prune(self, prefix, min_count=None, top_k=None, batch_size=1000, progress=None, terms_of=None):
+        return self.backend.prune(prefix, min_count=min_count, top_k=top_k, batch_size=batch_size,
+                                  progress=progress, terms_of=self.packed_terms)
+
+    def get_value(self, key):
+        return self.backend.get_value(self.pack(key))
+
+    def get_values(self, keys):
+        return self.backend.get_values([self.pack(key) for key in keys])
+
+    def set_values(self, values):
+        self.backend.set_values({self.pack(key): value for key, value in values.items()})
+
+    def delete_values(self, keys):
+        self.backend.delete_values([self.pack(key) for key in keys])
+
+    def pack_additions(self, additions):
+        return {set_key: {self.pack(member) for member in members} for set_key, members in additions.items()}
+
+    def add_to_sets(self, additions):
+        self.backend.add_to_sets(self.pack_additions(additions))
+
+    def are_members(self, set_key, members):
+        return self.backend.are_members(set_key, [self.pack(member) for member in members])
+
+    def random_member(self, set_key):
+        member = self.backend.random_member(set_key)
+        return self.unpack(member) if member is not None else None
+
+    def random_union_member(self, set_keys):
+        member = self.backend.random_union_member(set_keys)
+        return self.unpack(member) if member is not None else None
+
+
+class Vocabulary(object):
+    """
+    The mapping between tokens and compact ids of a model in interned mode, where keys and completions are built
+    from the ids instead of the tokens. The ids are the numbers allocated by the backend written with to_id, the
+    mapping already seen is kept in memory. STOP and the empty token, which ends a line like in a plain model, are never
+    interned
+    """
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+        self.ids = {STOP: STOP, '': ''}
+        self.tokens = {STOP: STOP, '': ''}
+
+    def intern(self, tokens, create=True):
+        """
+        The ids of the tokens. When create is False the tokens not in the vocabulary are marked as unknown,
+        so they never match a key of the model
+        """
+        missing = [t for t in set(tokens) if t not in self.ids]
+        if len(missing) > 0:
+            if create:
+                ids = self.backend.intern_tokens(self.prefix, missing)
+            else:
+                ids = self.backend.vocabulary_ids(self.prefix, missing)
+            for token, token_id in zip(missing, ids):
+                if token_id is not None:
+                    self.ids[token] = token_id
+                    self.tokens[token_id] = token
+        return [self.ids.get(t, UNKNOWN + t) for t in tokens]
+
+    def lookup(self, ids):
+        """
+        The tokens corresponding to the ids
+        """
+        missing = [i for i in set(ids) if i not in self.tokens and not i.startswith(UNKNOWN)]
+        if len(missing) > 0:
+            for token_id, token in zip(missing, self.backend.vocabulary_tokens(self.prefix, missing)):
+                if token is not None:
+                    self.ids[token] = token_id
+                    self.tokens[token_id] = token
+        return [self.tokens.get(i, i[len(UNKNOWN):] if i.startswith(UNKNOWN) else i) for i in ids]
+
+
+# the ids of an interned model are single characters, so they are stored without separators (see PackedBackend).
+# They start after STOP and UNKNOWN and skip the separator, the wildcards of the Redis patterns and the surrogates,
+# the ids beyond the first million have two characters, the first one being a lead from U+100000
+ID_START = 4
+ID_EXCLUDED = sorted(ord(c) for c in '*?[\\]' + SEPARATOR)
+ID_SURROGATES = (0xD800, 0xE000)
+ID_LEAD = 0x100000
+ID_RANGE = ID_LEAD - ID_START - len(ID_EXCLUDED) - (ID_SURROGATES[1] - ID_SURROGATES[0])
+# stands for the empty token in a packed key, where it would otherwise leave no character
+EMPTY_ID = '\x01'
+
+
+def id_char(number):
+    code = number + ID_START
+    for excluded in ID_EXCLUDED:
+        if code >= excluded:
+            code += 1
+    if code >= ID_SURROGATES[0]:
+        code += ID_SURROGATES[1] - ID_SURROGATES[0]
+    return chr(code)
+
+
+def char_number(char):
+    code = ord(char)
+    if code >= ID_SURROGATES[1]:
+        code -= ID_SURROGATES[1] - ID_SURROGATES[0]
+    return code - bisect.bisect_left(ID_EXCLUDED, code) - ID_START
+
+
+def to_id(number):
+    """
+    The id of the token with the given number in the vocabulary
+    """
+    if number < ID_RANGE:
+        return id_char(number)
+    lead, number = divmod(number - ID_RANGE, ID_RANGE)
+    return chr(ID_LEAD + lead) + id_char(number)
+
+
+def from_id(token_id):
+    """
+    The number of a token in the vocabulary from its id
+    """
+    if len(token_id) == 1:
+        return char_number(token_id)
+    return (ord(token_id[0]) - ID_LEAD + 1) * ID_RANGE + char_number(token_id[1])
+
+
+def pack_ids(ids):
+    return ''.join(token_id or EMPTY_ID for token_id in ids)
+
+
+def split_ids(packed):
+    """
+    The ids packed in a string by pack_ids
+    """
+    ids = []
+    i = 0
+    while i < len(packed):
+        width = 2 if ord(packed[i]) >= ID_LEAD else 1
+        token_id = packed[i:i + width]
+        ids.append(token_id if token_id != EMPTY_ID else '')
+        i += width
+    return ids
+
+
+def vocabulary_field(token):
+    """
+    The field of a token in the vocabulary hashes, a digest for the long tokens so the hashes stay compact
+    """
+    field = token.encode('utf8')
+    if len(field) > 16:
+        field = hashlib.blake2b(field, digest_size=16).digest()
+    return field
+
+
+def vocabulary_bucket(prefix, field):
+    return meta_key(prefix, SEPARATOR.join(('vocabulary', str(zlib.crc32(field) % VOCABULARY_BUCKETS))))
+
+
+class BulkWriter(object):
+    """
+    Buffers the increments of the model and sends them to the backend in batches, for Redis in pipelines, which are
+    transactional when commit_values is set. Repeated (key, completion) pairs in the same batch are merged into a single ZINCRBY.
+    The batches are committed by the caller when full, between lines, so a line is never split across commits
+    """
+    def __init__(self, backend, batch_size=10000):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.pending = {}
+        # {set key: members} to add to the key indexes
+        self.pending_members = {}
+        # the version counters of the models written, bumped at every commit
+        self.version_keys = set()
+        # counters to measure how many round trips were avoided
+        self.increments_count = 0
+        self.commands_count = 0
+        self.round_trips = 0
+        # called at each commit for a {key: bytes} stored with the increments, in the same transaction with Redis
+        self.commit_values = None
+        # called after each commit, when everything added so far is in the backend
+        self.on_commit = None
+
+    def add(self, key, completion, amount=1):
+        pair = (key, completion)
+        self.pending[pair] = self.pending.get(pair, 0) + amount
+        self.increments_count += 1
+
+    def commit_if_full(self):
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def add_member(self, set_key, member):
+        self.pending_members.setdefault(set_key, set()).add(member)
+
+    def commit(self):
+        """
+        Send the pending increments to the backend with the index members and the version bumps, for Redis in
+        a single pipeline, a MULTI/EXEC transaction when values are committed with them
+        """
+        if len(self.pending) == 0 and len(self.pending_members) == 0:
+            return
+        self.backend.increment_many(self.pending, self.commit_values() if self.commit_values is not None else None,
+                                    additions=self.pending_members, counters=self.version_keys)
+        self.commands_count += len(self.pending)
+        self.round_trips += 1
+        self.pending = {}
+        self.pending_members = {}
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def round_trips_saved(self):
+        """
+        How many round trips were avoided compared to one ZINCRBY per n-gram
+        """
+        return self.increments_count - self.round_trips
 
 
 class Markov(object):
     """
     Wrapper for markov functions
     """
-    def __init__(self, prefix=None, key_length=2, completion_length=1, db=0, host='localhost', port=6379, password=None):
-        self.client = redis.Redis(db=db, host=host, port=port, password=password)
+    def __init__(self, prefix=None, key_length=2, completion_length=1, db=0, host='localhost', port=6379, password=None,
+                 bulk=False, batch_size=10000, backend=None, frozen=None, cache_size=0, version_check_interval=1.0,
+                 key_index='start', term_index=False, interned=None, nodes=None, writer=None):
+        if backend is None and nodes:
+            # the model is sharded on a list of (host, port) Redis nodes
+            backend = ShardedRedisBackend([RedisBackend(redis.Redis(db=db, host=node_host, port=node_port,
+                                                                    password=password))
+                                           for node_host, node_port in nodes])
+        elif backend is None:
+            backend = RedisBackend(redis.Redis(db=db, host=host, port=port, password=password))
         self.prefix = prefix or PREFIX
+        # in interned mode keys and completions are made of token ids, by default detect it from the model
+        if interned is None:
+            interned = backend.get_value(meta_key(self.prefix, 'interned')) is not None
+        elif interned:
+            backend.set_values({meta_key(self.prefix, 'interned'): b'1'})
+        self.vocabulary = Vocabulary(backend, self.prefix) if interned else None
+        # the keys of an interned model are packed, except in memory where their tokens are already integers
+        if interned and isinstance(backend, PackedBackend):
+            backend.prefixes.add(self.prefix)
+        elif interned and not isinstance(backend, MemoryBackend):
+            backend = PackedBackend(backend, [self.prefix])
+        self.backend = backend
         self.key_length = key_length
         self.completion_length = completion_length
+        # which keys are indexed to pick random seeds: None, 'start' (the first key of each line) or 'all'
+        self.key_index = key_index
+        # whether to maintain the index from each token to the keys containing it, to find relevant seeds
+        self.term_index = term_index
+        # in bulk mode the increments are buffered and sent in pipelines, call close() when done.
+        # The writer can be shared with other models, to send their increments in the same pipelines
+        self.writer = writer
+        if writer is None and bulk:
+            self.writer = BulkWriter(self.backend, batch_size=batch_size)
+        if self.writer is not None:
+            self.writer.version_keys.add(meta_key(self.prefix, 'version'))
+        # without a writer the version is bumped once by commit(), for all the lines added since the last one
+        self.version_pending = False
+        if term_index:
+            backend.set_values({meta_key(self.prefix, 'term_index'): b'1'})
+        # an optional LRU cache of the completions read to generate and score, 0 to disable it
+        self.cache_size = cache_size
+        # the version counter of the model, bumped every time it is written, is checked at most once every
+        # version_check_interval seconds to notice the changes made by other processes
+        self.version_check_interval = version_check_interval
+        self.version = backend.get_value(meta_key(self.prefix, 'version'))
+        self.version_checked_at = time.time()
+        if frozen is None:
+            frozen = is_frozen(self.backend, self.prefix)
+        self._set_reader(frozen)
+
+    def _set_reader(self, frozen):
+        """
+        Prepare the backend used to generate and score, reading the frozen completions when the model has them
+        """
+        self.frozen = frozen
+        self.reader = self.backend
+        if frozen:
+            self.reader = FrozenBackend(self.backend)
+        self.cache = None
+        if self.cache_size > 0:
+            self.cache = CachedBackend(self.reader, max_size=self.cache_size)
+            self.reader = self.cache
+
+    def check_version(self):
+        """
+        When the model changed since the last check, empty the cache and follow a freeze or an unfreeze done
+        by another process by switching to or from the frozen completions
+        """
+        now = time.time()
+        if now - self.version_checked_at < self.version_check_interval:
+            return
+        self.version_checked_at = now
+        version = self.backend.get_value(meta_key(self.prefix, 'version'))
+        if version == self.version:
+            return
+        self.version = version
+        if self.cache is not None:
+            self.cache.clear()
+        frozen = is_frozen(self.backend, self.prefix)
+        if frozen != self.frozen:
+            self._set_reader(frozen)
+
+    def cache_info(self):
+        """
+        The hit and miss counts of the completions cache, None if there's no cache
+        """
+        if self.cache is None:
+            return None
+        info = self.cache.info()
+        info['version'] = int(self.version) if self.version is not None else 0
+        return info
+
+    def to_ids(self, tokens, create=False):
+        """
+        Translate tokens to the symbols stored in the model, the token ids for an interned model
+        """
+        if self.vocabulary is None:
+            return tokens
+        return self.vocabulary.intern(tokens, create=create)
+
+    def to_tokens(self, ids):
+        if self.vocabulary is None:
+            return ids
+        return self.vocabulary.lookup(ids)
+
+    def add_line_to_index(self, line, commit=True):
+        """
+        Add the n-grams of a line to the model. In bulk mode the batch is sent when full, unless commit is False
+        because the line has to be sent together with the next ones, e.g. to other models sharing the writer
+        """
+        line = self.to_ids(line, create=True)
+        if self.writer is None:
+            add_line_to_index(line, self.backend, self.key_length, self.completion_length, self.prefix,
+                              key_index=self.key_index, term_index=self.term_index)
+            self.version_pending = True
+        else:
+            first = True
+            for key, completion in iterate_keys_and_completions(line, self.key_length, self.completion_length,
+                                                                self.prefix):
+                self.writer.add(key, completion)
+                if first and self.key_index is not None:
+                    self.writer.add_member(meta_key(self.prefix, 'start_keys'), key)
+                if self.key_index == 'all':
+                    self.writer.add_member(meta_key(self.prefix, 'keys'), key)
+                if self.term_index:
+                    for term in key_terms(key, self.prefix):
+                        self.writer.add_member(term_index_key(self.prefix, term), key)
+                first = False
+            if commit:
+                self.writer.commit_if_full()
+
+    def add_key(self, key_tokens, completions, start=False):
+        """
+        Add the completions of a key, as a list of (completion tokens, weight), e.g. read from a snapshot.
+        start tells whether the key begins a line, for the index used to pick random seeds
+        """
+        key = make_key(self.to_ids(key_tokens, create=True), prefix=self.prefix)
+        increments = {}
+        for completion_tokens, weight in completions:
+            completion = make_key(self.to_ids(completion_tokens, create=True))
+            increments[(key, completion)] = increments.get((key, completion), 0) + weight
+        members = {}
+        if start and self.key_index is not None:
+            members[meta_key(self.prefix, 'start_keys')] = {key}
+        if self.key_index == 'all':
+            members[meta_key(self.prefix, 'keys')] = {key}
+        if self.term_index:
+            for term in key_terms(key, self.prefix):
+                members[term_index_key(self.prefix, term)] = {key}
+        if self.writer is None:
+            self.backend.increment_many(increments, additions=members)
+            self.version_pending = True
+        else:
+            for (_, completion), weight in increments.items():
+                self.writer.add(key, completion, weight)
+            for set_key in members:
+                self.writer.add_member(set_key, key)
+            self.writer.commit_if_full()
+
+    def commit(self):
+        """
+        Send the buffered increments to the backend in bulk mode, otherwise bump the version of the model if lines
+        were added since the last commit
+        """
+        if self.writer is not None:
+            self.writer.commit()
+        elif self.version_pending:
+            bump_version(self.backend, self.prefix)
+            self.version_pending = False
 
-    def add_line_to_index(self, line):
-        add_line_to_index(line, self.client, self.key_length, self.completion_length, self.prefix)
+    def close(self):
+        self.commit()
 
     def score_for_line(self, line):
-        return score_for_line(line, self.client, self.key_length, self.completion_length, self.prefix)
+        self.check_version()
+        return score_for_line(self.to_ids(line), self.reader, self.key_length, self.completion_length, self.prefix)
 
-    def generate(self, seed=None, max_words=1000):
-        return generate(self.client, seed=seed, prefix=self.prefix, max_words=max_words, key_length=self.key_length)
+    def score_lines(self, lines, batch_size=1000):
+        self.check_version()
+        return score_lines((self.to_ids(line) for line in lines), self.reader, self.key_length, self.completion_length, self.prefix,
+                           batch_size=batch_size)
 
-    def flush(self, prefix=None):
-        if prefix is not None:
-            keys = self.client.keys("%s*" % self.prefix)
-            for key in keys:
-                self.client.delete(key)
-    
+    def generate(self, seed=None, max_words=1000, server_side=False, random_seed=None, relevant_terms=None):
+        if seed is not None:
+            seed = self.to_ids(seed)
+        if relevant_terms is not None:
+            relevant_terms = self.to_ids(relevant_terms)
+        if server_side:
+            return self.to_tokens(generate_server_side(self.backend, seed=seed, prefix=self.prefix,
+                                                       max_words=max_words, key_length=self.key_length,
+                                                       random_seed=random_seed, relevant_terms=relevant_terms))
+        self.check_version()
+        return self.to_tokens(generate(self.reader, seed=seed, prefix=self.prefix, max_words=max_words,
+                                       key_length=self.key_length, relevant_terms=relevant_terms))
+
+    def generate_many(self, number, seed=None, max_words=1000, relevant_terms=None):
+        """
+        Generate a number of utterances at once, see generate_many()
+        """
+        if seed is not None:
+            seed = self.to_ids(seed)
+        if relevant_terms is not None:
+            relevant_terms = self.to_ids(relevant_terms)
+        self.check_version()
+        return [self.to_tokens(tokens) for tokens in
+                generate_many(self.reader, [seed] * number, prefix=self.prefix, max_words=max_words,
+                              key_length=self.key_length, relevant_terms=relevant_terms)]
+
+    def iterate_generation(self, seed=None, max_words=1000, relevant_terms=None):
+        """
+        Generate the tokens one at a time as they are picked, e.g. to stream them, see iterate_generation()
+        """
+        if seed is not None:
+            seed = self.to_ids(seed)
+        if relevant_terms is not None:
+            relevant_terms = self.to_ids(relevant_terms)
+        self.check_version()
+        for token in iterate_generation(self.reader, seed=seed, prefix=self.prefix, max_words=max_words,
+                                        key_length=self.key_length, relevant_terms=relevant_terms):
+            yield self.to_tokens([token])[0]
 
-def add_line_to_index(line, client, key_length=2, completion_length=1, prefix = PREFIX):
+    def freeze(self):
+        """
+        Compile the model for faster sampling, see freeze()
+        """
+        frozen_count = freeze(self.backend, self.prefix)
+        self._set_reader(True)
+        return frozen_count
+
+    def unfreeze(self):
+        unfreeze(self.backend, self.prefix)
+        self._set_reader(False)
+
+    def flush(self, prefix=None, batch_size=1000, progress=None):
+        """
+        Delete the model with its frozen completions and metadata, by default the one with the prefix of this
+        instance. With Redis it doesn't block the server, and an interrupted flush resumes when called again
+        """
+        deleted_count = self.backend.flush(prefix or self.prefix, batch_size=batch_size, progress=progress)
+        if self.cache is not None:
+            self.cache.clear()
+        return deleted_count
+
+    def prune(self, min_count=None, top_k=None, batch_size=1000, progress=None):
+        """
+        Drop the completions seen less than min_count times and keep at most the top_k heaviest ones for each key,
+        see Backend.prune. A frozen model is unfrozen, its frozen completions would still include the pruned ones.
+        Returns the number of removed completions and the number of deleted keys
+        """
+        self.commit()
+        if self.frozen:
+            self.unfreeze()
+        counts = self.backend.prune(self.prefix, min_count=min_count, top_k=top_k, batch_size=batch_size,
+                                    progress=progress)
+        bump_version(self.backend, self.prefix)
+        return counts
+
+
+def add_line_to_index(line, backend, key_length=2, completion_length=1, prefix = PREFIX, key_index=None,
+                      term_index=False):
     """
     Add a line to our index of markov chains
 
     @param line: a list of words
     @param key_length: the desired length for our keys
     @param prefix: the prefix to use when saving the key on Redis
-    @param client: Redis client
+    @param backend: the storage of the model, e.g. a RedisBackend
     @param completion_length: the desired completion length
+    @param key_index: which keys to add to the sets used to pick random seeds, None, 'start' or 'all'
+    @param term_index: whether to add the keys to the index from each token to the keys containing it
+    """
+    keys = []
+    increments = {}
+    for key, completion in iterate_keys_and_completions(line, key_length, completion_length, prefix):
+        increments[(key, completion)] = increments.get((key, completion), 0) + 1
+        keys.append(key)
+    additions = {}
+    if key_index is not None and len(keys) > 0:
+        additions[meta_key(prefix, 'start_keys')] = {keys[0]}
+        if key_index == 'all':
+            additions[meta_key(prefix, 'keys')] = set(keys)
+    if term_index:
+        for key in keys:
+            for term in key_terms(key, prefix):
+                additions.setdefault(term_index_key(prefix, term), set()).add(key)
+    # with Redis the n-grams and the index entries of the line are sent in a single pipeline
+    backend.increment_many(increments, additions=additions)
+
+
+def iterate_keys_and_completions(line, key_length=2, completion_length=1, prefix=PREFIX):
+    """
+    Generate all the (key, completion) pairs of a line, in order
     """
+    start = 0
     key, completion = get_key_and_completion(line, key_length, completion_length, prefix)
     while key and completion:
-        completion = make_key(completion)
-        client.zincrby(key, completion)
-        line = line[1:]
-        key, completion = get_key_and_completion(line, key_length, completion_length, prefix)
+        yield key, make_key(completion)
+        start += 1
+        key, completion = get_key_and_completion(line, key_length, completion_length, prefix, start)
 
 
 def make_key(key, prefix=None):
@@ -67,87 +2125,171 @@ def make_key(key, prefix=None):
     return key
 
 
-def max_for_key(key, client):
+def max_for_key(key, backend):
     """
     Get the maximum score for a completion on this key
     """
-    maximum = client.zrevrange(key, 0, 0, withscores=True)
-    if maximum:
-        return maximum[0][1]
-    else:
-        return 0
+    return backend.max_score(key)
 
 
-def min_for_key(key, client):
+def min_for_key(key, backend):
     """
     Get the minimum score for a completion on this key
     """
-    minimum = client.zrange(key, 0, 0, withscores=True)
-    if minimum:
-        return minimum[0][1]
-    else:
-        return 0
+    return backend.min_score(key)
 
 
-def score_for_completion(key, completion, client, normalize_to=100):
+def score_for_completion(key, completion, backend, normalize_to=100):
     """
     Get the normalized score for a completion
     """
-    raw_score = client.zscore(key, make_key(completion)) or 0
-    maximum = max_for_key(key, client) or 1
+    raw_score = backend.score(key, make_key(completion)) or 0
+    maximum = max_for_key(key, backend) or 1
     return (raw_score/maximum) * normalize_to
 
 
-def _score_for_line(line, client, key_length, completion_length, prefix, count=0):
+def score_for_line(line, backend, key_length=2, completion_length=1, prefix=PREFIX):
     """
-    Recursive function for iterating over all possible key/completion sets in a line
-    and scoring them
+    Score a line of text for fit based on our markov model
     """
     score = 0
-    key, completion = get_key_and_completion(line, key_length, completion_length, prefix)
-    if key and completion:
-        score = score_for_completion(key, completion, client)
-        new_score, count = _score_for_line(line[1:], client, key_length, completion_length, prefix, count+1)
-        score += new_score
+    count = 0
+    for key, completion in iterate_keys_and_completions(line, key_length, completion_length, prefix):
+        score += score_for_completion(key, completion, backend)
+        count += 1
+    if count > 0:
+        return score/count
     else:
-        score = 0
-    return score, count
+        return 0
 
 
-def score_for_line(line, client, key_length=2, completion_length=1, prefix=PREFIX):
+def score_lines(lines, backend, key_length=2, completion_length=1, prefix=PREFIX, batch_size=1000, normalize_to=100):
     """
-    Score a line of text for fit based on our markov model
+    Score many lines like score_for_line, generating the scores in the same order.
+    The lines are processed in batches, for each one the scores of the distinct (key, completion) pairs and
+    the maximum score of the distinct keys are fetched only once, with a pipeline
     """
-    score, count = _score_for_line(line, client, key_length, completion_length, prefix)
-    if count > 0:
-        return score/count
-    else:
-        return 0
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield from _score_batch(batch, backend, key_length, completion_length, prefix, normalize_to)
+            batch = []
+    yield from _score_batch(batch, backend, key_length, completion_length, prefix, normalize_to)
+
+
+def _score_batch(lines, backend, key_length, completion_length, prefix, normalize_to):
+    lines_pairs = [list(iterate_keys_and_completions(line, key_length, completion_length, prefix)) for line in lines]
+    pairs = list(set(itertools.chain.from_iterable(lines_pairs)))
+    keys = list({key for key, _ in pairs})
+    scores = dict(zip(pairs, backend.score_many(pairs)))
+    maxima = dict(zip(keys, backend.max_score_many(keys)))
+    for line_pairs in lines_pairs:
+        if len(line_pairs) == 0:
+            yield 0
+            continue
+        score = 0
+        for pair in line_pairs:
+            score += ((scores[pair] or 0) / (maxima[pair[0]] or 1)) * normalize_to
+        yield score / len(line_pairs)
 
 
-def generate(client, seed=None, prefix=None, max_words=1000, key_length=2):
+def generate(backend, seed=None, prefix=None, max_words=1000, key_length=2, relevant_terms=None):
     """
     Generate some text based on our model
     """
+    return list(iterate_generation(backend, seed=seed, prefix=prefix, max_words=max_words, key_length=key_length,
+                                   relevant_terms=relevant_terms))
+
+
+def generate_many(backend, seeds, prefix=None, max_words=1000, key_length=2, relevant_terms=None):
+    """
+    Generate an utterance for each of the seeds, None for a random or relevant one, like generate.
+    The chains advance in lockstep: at each step the completions of the keys of all the chains not over yet are
+    read at once, with a single round trip for Redis, and a chain sharing its key with others samples from the
+    same distribution. The cost is about max_words round trips instead of max_words for each utterance
+    """
+    chains = []
+    for seed in seeds:
+        if seed is None:
+            key, seed = get_key_and_seed(backend, prefix, relevant_terms)
+        chains.append(seed[:])
+    live = list(range(len(chains)))
+    while len(live) > 0:
+        keys = [make_key(chains[i][-key_length:], prefix=prefix) for i in live]
+        distinct_keys = list(OrderedDict.fromkeys(keys))
+        distributions = dict(zip(distinct_keys, backend.distributions_many(distinct_keys)))
+        still_live = []
+        for i, key in zip(live, keys):
+            completion = distributions[key].sample()
+            if not completion:
+                continue
+            completion = completion.split(SEPARATOR)
+            words_count = count_tokens(chains[i]) + count_tokens(completion)
+            if words_count > max_words:
+                continue
+            chains[i] += completion
+            # no key contains STOP, the line is over
+            if words_count < max_words and STOP not in completion:
+                still_live.append(i)
+        live = still_live
+    return [[token for token in chain if token != STOP] for chain in chains]
+
+
+def iterate_generation(backend, seed=None, prefix=None, max_words=1000, key_length=2, relevant_terms=None):
+    """
+    Generate the tokens of some text based on our model one at a time, as soon as they are picked.
+    The tokens of the seed come first
+    """
     if seed is None:
-        key, seed = get_key_and_seed(client, prefix)
+        key, seed = get_key_and_seed(backend, prefix, relevant_terms)
     partial = seed[:]
+    for token in seed:
+        yield token
     #infinite while to avoid recursion which easily exceeded the stack
     while True:
         key = make_key(partial[-key_length:], prefix=prefix)
-        completion = get_completion(client, key)
-        if completion:
-            completion = completion.decode('utf8').split(SEPARATOR)
-            if count_tokens(partial) + count_tokens(completion) < max_words:
-                partial += completion
-            elif count_tokens(partial) + count_tokens(completion) == max_words:
-                if STOP in completion:
-                    completion.remove(STOP)
-                return partial + completion
-        else:
-            if STOP in partial:
-                partial.remove(STOP)
-            return partial
+        completion = get_completion(backend, key)
+        if not completion:
+            return
+        completion = completion.split(SEPARATOR)
+        words_count = count_tokens(partial) + count_tokens(completion)
+        if words_count > max_words:
+            return
+        partial += completion
+        for token in completion:
+            if token != STOP:
+                yield token
+        # no key contains STOP, the line is over
+        if words_count == max_words or STOP in completion:
+            return
+
+
+def generate_server_side(backend, seed=None, prefix=None, max_words=1000, key_length=2, random_seed=None,
+                         relevant_terms=None):
+    """
+    Generate some text like generate(), but running the whole walk in a Lua script on Redis, so it takes a
+    single round trip and only the resulting tokens are transferred.
+    The random_seed makes the generation reproducible on the same model, a random one is used if not given.
+    When the last completion would exceed max_words the generation stops, instead of sampling again.
+    Only available with a RedisBackend, possibly packed
+    """
+    redis_backend = backend.backend if isinstance(backend, PackedBackend) else backend
+    if not isinstance(redis_backend, RedisBackend):
+        raise ValueError('server side generation requires a RedisBackend')
+    if seed is None:
+        key, seed = get_key_and_seed(backend, prefix, relevant_terms)
+    if random_seed is None:
+        random_seed = random.randrange(2 ** 31)
+    packed = isinstance(backend, PackedBackend) and prefix in backend.prefixes
+    if packed:
+        seed = [pack_ids([token_id]) for token_id in seed]
+    script = redis_backend.client.register_script(GENERATE_SCRIPT)
+    tokens = script(args=[prefix or '', '' if packed else SEPARATOR, key_length, max_words, random_seed] + list(seed))
+    tokens = [t.decode('utf8') for t in tokens]
+    if packed:
+        tokens = [t if t != EMPTY_ID else '' for t in tokens]
+    return tokens
 
 
 def count_tokens(seed):
@@ -157,48 +2299,93 @@ def count_tokens(seed):
     return len(seed)
 
 
-def get_key_and_seed(client, prefix=None, relevant_terms=None):
+def get_key_and_seed(backend, prefix=None, relevant_terms=None):
     """
     Wraps get_random_key_and_seed and get_relevant_key_and_seed
     """
     if relevant_terms and len(relevant_terms) > 0:
-        return get_relevant_key_and_seed(client, relevant_terms, prefix)
+        return get_relevant_key_and_seed(backend, relevant_terms, prefix)
     else:
-        return get_random_key_and_seed(client, prefix)
+        return get_random_key_and_seed(backend, prefix)
 
 
-def get_random_key_and_seed(client, prefix=None):
+def get_random_key_and_seed(backend, prefix=None):
     """
     Get a random key from the data set and split it into a seed for sequence generation.
     """
     key = None
     seed = []
     while len(seed) == 0:
+        key = None
         if prefix:
-            key = random.choice(client.keys("%s%s*" % (prefix, SEPARATOR)))
-        else:
-            key = client.randomkey()
-        seed = key.decode('utf8').split(SEPARATOR)
+            key = get_indexed_random_key(backend, prefix)
+        if key is None:
+            # no index for this model, scan the keys
+            key = backend.random_key(prefix)
+        if key is None:
+            # the model is empty
+            return None, []
+        seed = key.split(SEPARATOR)
     if prefix in seed:
         seed.remove(prefix) 
     return key, seed
 
 
-def get_relevant_key_and_seed(client, relevant_terms, prefix=None, tries=10):
+def get_indexed_random_key(backend, prefix):
+    """
+    Pick a random key from the sets of indexed keys of the model, preferring the one with all the keys.
+    None if the model has no index
+    """
+    for index_name in ('keys', 'start_keys'):
+        key = backend.random_member(meta_key(prefix, index_name))
+        if key is not None:
+            return key
+    return None
+
+
+def index_keys(backend, prefix, start_keys=(), batch_size=1000):
+    """
+    Add all the keys of an existing model to the set used to pick random seeds, and the given start keys
+    to the set of the start keys when they exist. Returns the number of indexed keys
+    """
+    indexed_count = 0
+    keys = set()
+    start_keys = set(start_keys)
+    found_start_keys = set()
+    for key in backend.iterate_keys(prefix):
+        keys.add(key)
+        if key in start_keys:
+            found_start_keys.add(key)
+        if len(keys) >= batch_size:
+            backend.add_to_sets({meta_key(prefix, 'keys'): keys})
+            indexed_count += len(keys)
+            keys = set()
+    backend.add_to_sets({meta_key(prefix, 'keys'): keys, meta_key(prefix, 'start_keys'): found_start_keys})
+    return indexed_count + len(keys)
+
+
+def get_relevant_key_and_seed(backend, relevant_terms, prefix=None, tries=10):
     """
     Get a key that contains one of the terms from relevant_terms.
+    When the model has a term index the key contains one of the terms as a token, otherwise the keys are
+    scanned looking for the terms as substrings, or as whole tokens for an interned model.
     Limit the number of tries to avoid an infinite loop.
     """
     tried = 0
     key = None
     seed = []
+    # the ids of an interned model are short, as substrings they would match parts of other ids
+    interned = prefix and backend.get_value(meta_key(prefix, 'interned')) is not None
+    if prefix and backend.get_value(meta_key(prefix, 'term_index')) is not None:
+        key = backend.random_union_member([term_index_key(prefix, term) for term in relevant_terms])
+        if key is not None:
+            seed = key.split(SEPARATOR)
+        # the scan would not find anything more
+        tried = tries
     while len(seed) == 0 and tried < tries:
         keys = []
         for term in relevant_terms:
-            if prefix:
-                keys += client.keys("%s%s*%s*" % (prefix, SEPARATOR, term))
-            else:
-                keys += client.keys("*%s*" % term)
+            keys += [k for k in backend.find_keys(term, prefix) if not interned or term in k.split(SEPARATOR)[1:]]
         try:
             key = random.choice(list(set(keys)))
             seed = key.split(SEPARATOR)
@@ -211,11 +2398,17 @@ def get_relevant_key_and_seed(client, relevant_terms, prefix=None, tries=10):
     return key, seed
         
     
-def get_completion(client, key):
+def get_completion(backend, key):
     """
     Get a possible completion for some key
     """
-    completions = client.zrevrange(key, 0, -1, withscores=True)
+    return backend.sample_completion(key)
+
+
+def pick_weighted(completions):
+    """
+    Pick one of the (completion, weight) with probability proportional to its weight
+    """
     if len(completions) > 0:
         total = random.uniform(0, sum(w for c, w in completions))
         for candidate in completions:
@@ -225,17 +2418,112 @@ def get_completion(client, key):
     return None
 
 
-def get_key_and_completion(line, key_length, completion_length, prefix):
+def offset_progress(progress, offset):
+    """
+    A progress callback adding an offset to the counts, for an operation made of several ones
+    """
+    if progress is None:
+        return None
+    return lambda count: progress(offset + count)
+
+
+def frozen_key(key):
+    """
+    The key holding the frozen completions of a key of the model
+    """
+    return SEPARATOR.join((FROZEN_PREFIX, key))
+
+
+def meta_key(prefix, name):
+    """
+    The key holding some metadata about the model with the given prefix
+    """
+    return SEPARATOR.join((META_PREFIX, prefix, name))
+
+
+def freeze(backend, prefix, batch_size=1000):
+    """
+    Compile the completions of every key of a model into FrozenCompletions stored in a parallel keyspace,
+    and mark the model as frozen. Returns the number of frozen keys
+    """
+    frozen_count = 0
+    keys = []
+    for key in backend.iterate_keys(prefix):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            frozen_count += _freeze_keys(backend, keys)
+            keys = []
+    frozen_count += _freeze_keys(backend, keys)
+    backend.set_values({meta_key(prefix, 'frozen'): str(time.time()).encode('utf8')})
+    bump_version(backend, prefix)
+    return frozen_count
+
+
+def _freeze_keys(backend, keys):
+    blobs = {}
+    for key, completions in zip(keys, backend.completions_many(keys)):
+        blobs[frozen_key(key)] = FrozenCompletions.from_completions(completions).to_bytes()
+    backend.set_values(blobs)
+    return len(blobs)
+
+
+def is_frozen(backend, prefix):
+    return backend.get_value(meta_key(prefix, 'frozen')) is not None
+
+
+def unfreeze(backend, prefix, batch_size=1000):
+    """
+    Mark the model as not frozen, so the completions are read again from the model itself, and delete its
+    frozen completions
+    """
+    backend.delete_values([meta_key(prefix, 'frozen')])
+    bump_version(backend, prefix)
+    keys = []
+    for key in backend.iterate_keys(prefix):
+        keys.append(frozen_key(key))
+        if len(keys) >= batch_size:
+            backend.delete_values(keys)
+            keys = []
+    if len(keys) > 0:
+        backend.delete_values(keys)
+
+
+def bump_version(backend, prefix):
+    """
+    Increment the version counter of a model, invalidating the caches of the processes reading it
+    """
+    return backend.increment_value(meta_key(prefix, 'version'))
+
+
+def term_index_key(prefix, term):
+    """
+    The key of the set of keys containing a term
+    """
+    return meta_key(prefix, SEPARATOR.join(('terms', term)))
+
+
+def key_terms(key, prefix=None):
+    """
+    The tokens of a key, without the prefix
+    """
+    terms = key.split(SEPARATOR)
+    if prefix:
+        terms = terms[1:]
+    return terms
+
+
+def get_key_and_completion(line, key_length, completion_length, prefix, start=0):
     """
-    Get a key and completion from the given list of words
+    Get a key and completion from the given list of words, the key beginning at the index start
     """
-    if len(line) >= key_length and STOP not in line[0:key_length]:
-        key = make_key(line[0:key_length], prefix=prefix)
+    end = start + key_length
+    if len(line) >= end and STOP not in line[start:end]:
+        key = make_key(line[start:end], prefix=prefix)
         if completion_length > 1:
-            completion = line[key_length:key_length+completion_length]
+            completion = line[end:end+completion_length]
         else:
             try:
-                completion = line[key_length]
+                completion = line[end]
             except IndexError:
                 completion = STOP
         completion = make_key(completion)
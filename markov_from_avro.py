@@ -1,111 +1,647 @@
-from markov import Markov
+from markov import Markov, MemoryBackend, index_keys, make_key, meta_key
+import avro_blocks
+import markov_mmap
+import markov_snapshot
+import tag_index
+import tokenizers
+import utterance_decoder
 
-from avro.datafile import DataFileReader
 from avro.io import DatumReader
+import functools
+import json
+import os
+import random
 import time
 import argparse
 
 
-# parameters from CLI
-parser = argparse.ArgumentParser(description="build and store a Markov model in Redis, use it to generate text")
-parser.add_argument("operation", type=str, help="what to do", default="build", choices=['build', 'generate'])
-parser.add_argument("-keylen", type=int, help="the N-gram size", default=3)
-parser.add_argument("-input_file", type=str, help="the input avro file", default="utterances.avro")
-parser.add_argument("-skip_to", type=int, help="ignore the first N utterances (used to resume importing)", default=0)
-parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
-                    choices=['split', 'char', 'nltk'])
-parser.add_argument("-markov_prefix", type=str, help="the prefix for redis keys", default="mkv")
-parser.add_argument("-tags", type=str, help="the tags, if any, to be filtered in the corpus", default="")
-parser.add_argument("-number", type=int, help="the number of utterances to generate", default=1)
-parser.add_argument("-max_length", type=int, help="the maximum numbers of token per utterences to generate", default=1000)
-parser.add_argument("-seed", type=str, help="the seed generate utterances")
+def make_markov(args, key_length, model_prefix, redis_nodes, backend=None, writer=None):
+    return Markov(key_length=key_length, prefix=model_prefix, bulk=args.batch_size > 0,
+                  batch_size=args.batch_size, backend=backend, cache_size=args.cache_size,
+                  key_index=None if args.key_index == 'none' else args.key_index,
+                  term_index=args.term_index and args.operation == 'build',
+                  interned=True if args.interned and args.operation == 'build' else None, nodes=redis_nodes,
+                  writer=writer)
 
-args = parser.parse_args()
 
-keylen = args.keylen
-prefix = args.markov_prefix
+def make_models(args, key_lengths, redis_nodes, backend=None):
+    """
+    The models to build, one for each key length. With several key lengths they are stored with the prefix
+    markov_prefix_N and share the backend and the pipelines of the first one
+    """
+    prefix = args.markov_prefix
+    if len(key_lengths) == 1:
+        return [make_markov(args, key_lengths[0], prefix, redis_nodes, backend)]
+    models = [make_markov(args, key_lengths[0], '{0}_{1}'.format(prefix, key_lengths[0]), redis_nodes, backend)]
+    for key_length in key_lengths[1:]:
+        models.append(make_markov(args, key_length, '{0}_{1}'.format(prefix, key_length), redis_nodes,
+                                  models[0].backend, writer=models[0].writer))
+    return models
 
-start_seq = list('°' * keylen)
 
+def add_utterance(models, tokens):
+    """
+    Add the tokens of an utterance to every model, with the starting sequence of its length.
+    The n-grams of all the models are committed together, so a checkpoint never splits an utterance
+    """
+    for i, model in enumerate(models):
+        model.add_line_to_index(['°'] * model.key_length + tokens, commit=i == len(models) - 1)
 
-# pick the joiner and splitter functions, mapping plain text to sequences markov states labels
-splitter = None
-joiner = None
 
-if args.tokenizer == 'char':
+def is_selected(utterance, tags):
+    """
+    Whether the utterance has to be imported, given the set of tags to filter
+    """
+    return len(tags) == 0 or tag_index.has_tags(utterance, tags)
 
-    def splitter(x): return list(x)
 
-    def joiner(x): return ''.join(x)
+def build_block_range(args, key_lengths, redis_nodes, tags, index, block_range):
+    """
+    Import the utterances in a range of Avro blocks, used by the worker processes.
+    Each worker has its own Redis connection and counts the n-grams locally before sending them
+    """
+    start, end, first_record_index = block_range
+    splitter, joiner = tokenizers.get_tokenizer(args.tokenizer)
+    selected_tags = set(tags)
+    worker_models = make_models(args, key_lengths, redis_nodes)
+    worker_mm = worker_models[0]
+    utterances_count = 0
+    tokens_count = 0
+    if index is not None and args.skip_to == 0:
+        # only the tagged utterances are read, they can't be counted to skip the first ones
+        utterances = tag_index.iterate_records(args.input_file, tags, start, end, index=index, fields=('text',))
+    else:
+        utterances = utterance_decoder.iterate_utterances(args.input_file, ('text', 'tags'), start, end)
+    for utterance in utterances:
+        utterances_count += 1
+        if first_record_index + utterances_count <= args.skip_to:
+            continue
+        if not is_selected(utterance, selected_tags):
+            continue
+        tokens = splitter(utterance['text'])
+        tokens_count += key_lengths[-1] + len(tokens)
+        add_utterance(worker_models, tokens)
+    for model in worker_models:
+        model.close()
+    writer_counts = (0, 0, 0)
+    if worker_mm.writer is not None:
+        writer_counts = (worker_mm.writer.increments_count, worker_mm.writer.commands_count,
+                         worker_mm.writer.round_trips)
+    return (utterances_count, tokens_count) + writer_counts
 
-if args.tokenizer == 'split':
-    def splitter(x): return x.split(' ')
 
-    def joiner(x): return ' '.join(x)
+def main():
+    # parameters from CLI
+    parser = argparse.ArgumentParser(description="build and store a Markov model in Redis, use it to generate text")
+    parser.add_argument("operation", type=str, help="what to do", default="build",
+                        choices=['build', 'generate', 'freeze', 'index', 'score', 'flush', 'prune', 'export', 'import',
+                                 'merge', 'compile', 'stats'])
+    parser.add_argument("-keylen", type=str, default='3',
+                        help="the N-gram size, to build also a range like 1-4 that builds every size in one pass, "
+                             "each one with the key prefix markov_prefix_N")
+    parser.add_argument("-input_file", type=str, help="the input avro file", default="utterances.avro")
+    parser.add_argument("-skip_to", type=int, help="ignore the first N utterances (used to resume importing)",
+                        default=0)
+    parser.add_argument("-checkpoint_file", type=str,
+                        help="where the build saves its position in the input file after each commit to Redis, "
+                             "by default markov_prefix.checkpoint.json")
+    parser.add_argument("-resume", action='store_true',
+                        help="continue an interrupted build from the position in checkpoint_file")
+    parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
+                        choices=tokenizers.NAMES)
+    parser.add_argument("-markov_prefix", type=str, help="the prefix for redis keys", default="mkv")
+    parser.add_argument("-tags", type=str, help="the tags, if any, to be filtered in the corpus", default="")
+    parser.add_argument("-number", type=int, help="the number of utterances to generate", default=1)
+    parser.add_argument("-max_length", type=int, help="the maximum numbers of token per utterences to generate",
+                        default=1000)
+    parser.add_argument("-seed", type=str, help="the seed generate utterances")
+    parser.add_argument("-batch_size", type=int, default=10000,
+                        help="how many distinct n-grams to buffer before sending them to Redis, 0 to disable batching")
+    parser.add_argument("-server_side", action='store_true',
+                        help="generate running the whole walk in a Lua script on Redis, with a single round trip")
+    parser.add_argument("-random_seed", type=int, help="the seed of the random generator, for reproducible generation")
+    parser.add_argument("-workers", type=int, default=1,
+                        help="the number of processes building the model, each one on a different range of Avro blocks")
+    parser.add_argument("-tokenizer_processes", type=int, default=1,
+                        help="the number of processes tokenizing the utterances of a sequential build, for costly "
+                             "tokenizers")
+    parser.add_argument("-cache_size", type=int, default=0,
+                        help="how many completion distributions to keep in a LRU cache while generating, 0 to "
+                             "disable it")
+    parser.add_argument("-key_index", type=str, default='start', choices=['none', 'start', 'all'],
+                        help="which keys to index while building, to pick random seeds without scanning the model")
+    parser.add_argument("-term_index", action='store_true',
+                        help="while building, index the keys containing each token, to seed the generation by topic")
+    parser.add_argument("-topic", type=str,
+                        help="comma separated terms, the generation starts from a key containing one of them")
+    parser.add_argument("-scores_file", type=str,
+                        help="where to write the score of each utterance, as index, score and source separated by "
+                             "tabs. If not given they are printed")
+    parser.add_argument("-interned", action='store_true',
+                        help="build the model with compact token ids instead of the tokens, to use less memory with "
+                             "keys of 3 tokens or more. Generation and scoring detect it")
+    parser.add_argument("-backend", type=str, default='redis', choices=['redis', 'memory', 'mmap'],
+                        help="where to store the model, memory keeps it in this process and saves it in model_file, "
+                             "mmap reads a model_file written by compile, to generate and score")
+    parser.add_argument("-model_file", type=str, help="the model file used by the memory backend", default="model.mkv")
+    parser.add_argument("-min_count", type=int, default=0,
+                        help="when pruning, drop the completions seen less than this number of times, 0 to keep them")
+    parser.add_argument("-top_k", type=int, default=0,
+                        help="when pruning, keep only the K most frequent completions of each key, 0 to keep them all")
+    parser.add_argument("-prune_every", type=int, default=0,
+                        help="while building, prune the model with min_count and top_k every N utterances and at the "
+                             "end, 0 to disable it. Counts dropped early are lost, keep the thresholds low")
+    parser.add_argument("-snapshot_file", type=str, default="model_snapshot.avro",
+                        help="the snapshot written by export and merge and read by import")
+    parser.add_argument("-mmap_file", type=str, default="model.mmap",
+                        help="the binary model written by compile, read with -backend mmap -model_file")
+    parser.add_argument("-merge_files", type=str, help="comma separated snapshots to be merged into snapshot_file")
+    parser.add_argument("-benchmark", type=int, default=20,
+                        help="how many utterances to generate before and after pruning to measure the latency, 0 to "
+                             "skip it")
+    parser.add_argument("-redis_nodes", type=str,
+                        help="comma separated host:port of the Redis nodes to shard the model on, instead of the "
+                             "local one")
 
+    args = parser.parse_args()
+    if args.backend == 'memory' and args.workers > 1:
+        parser.error('the memory backend cannot be built by multiple workers')
+    if (args.operation == 'prune' or args.prune_every > 0) and args.min_count <= 0 and args.top_k <= 0:
+        parser.error('pruning requires -min_count or -top_k')
+    if args.backend == 'mmap' and args.operation not in ('generate', 'score', 'export'):
+        parser.error('the mmap backend is read-only, it can only generate, score and export')
+    if args.operation == 'merge' and args.merge_files is None:
+        parser.error('merge requires -merge_files')
+    if args.workers > 1 and args.tokenizer_processes > 1:
+        parser.error('the workers tokenize their own utterances, -tokenizer_processes is for sequential builds')
+    if args.resume and (args.backend != 'redis' or args.workers > 1):
+        parser.error('only a build with the redis backend and a single worker can be resumed')
+    if args.resume and args.batch_size <= 0:
+        parser.error('only a batched build can be resumed, without batching the position is not committed with the '
+                     'increments')
+    if args.resume and args.redis_nodes is not None:
+        parser.error('a sharded build cannot be resumed, its commits are not atomic across the nodes')
+    if args.redis_nodes is not None and args.server_side:
+        parser.error('the generation cannot run server side on a sharded model')
 
-if args.tokenizer == 'nltk':
-    from nltk.tokenize import RegexpTokenizer
+    redis_nodes = None
+    if args.redis_nodes is not None:
+        redis_nodes = []
+        for node in args.redis_nodes.split(','):
+            host, _, port = node.strip().rpartition(':')
+            if host == '' or not port.isdigit():
+                parser.error('the Redis nodes must be given as host:port, not {0}'.format(node))
+            redis_nodes.append((host, int(port)))
 
-    tokenizer = RegexpTokenizer('\w+|\$[\d\.]+|\S+')
+    try:
+        first_keylen, _, last_keylen = args.keylen.partition('-')
+        key_lengths = list(range(int(first_keylen), int(last_keylen or first_keylen) + 1))
+    except ValueError:
+        key_lengths = []
+    if len(key_lengths) == 0 or key_lengths[0] < 1:
+        parser.error('the key length must be a positive number or a range like 1-4, not {0}'.format(args.keylen))
+    if len(key_lengths) > 1 and args.operation != 'build':
+        parser.error('only build accepts a range of key lengths, use the prefix of one of them for {0}'
+                     .format(args.operation))
 
+    keylen = key_lengths[-1]
+    prefix = args.markov_prefix
+    checkpoint_file = args.checkpoint_file or '{0}.checkpoint.json'.format(prefix)
+    # the checkpoint is also stored in Redis in the transaction of each commit, it's the one used to resume
+    checkpoint_key = meta_key(prefix, 'checkpoint')
+    tags = list(filter(lambda x: x != '',  args.tags.split(',')))
+    selected_tags = set(tags)
 
-    def splitter(x): return tokenizer.tokenize(x)
+    start_seq = list('°' * keylen)
 
 
-    def joiner(x): return ' '.join(x)
+    # pick the joiner and splitter functions, mapping plain text to sequences markov states labels
+    splitter, joiner = tokenizers.get_tokenizer(args.tokenizer)
 
-mm = Markov(key_length=keylen, prefix=prefix)
+    backend = None
+    if args.backend == 'memory':
+        if os.path.exists(args.model_file):
+            print('loading model from {0}'.format(args.model_file))
+            backend = MemoryBackend.load(args.model_file)
+        else:
+            backend = MemoryBackend()
 
-if args.operation == 'build':
-    tags = list(filter(lambda x: x != '',  args.tags.split(',')))
-    input_file = args.input_file
-    skip_to = args.skip_to
-    if len(tags) > 0:
-        print('will import file {0} using key prefix {1}, filtering tags {2}'.format(input_file, prefix, tags))
-    else:
-        print('will import all utterances in file {0} using key prefix {1}'.format(input_file, prefix))
-    reader = DataFileReader(open(input_file, "rb"), DatumReader())
-    # counters to log performances
-    start_time = time.time()
-    utterances_count = 0
-    tokens_count = 0
 
-    for utterance in reader:
-        utterances_count += 1
-        if utterances_count < skip_to:
-            continue
+    # merging snapshots doesn't need a model
+    mm = None
+    if args.backend == 'mmap':
+        mm = markov_mmap.MmapMarkov(args.model_file, cache_size=args.cache_size)
+        keylen = mm.key_length
+        prefix = mm.prefix
+        start_seq = list('°' * keylen)
+    elif args.operation != 'merge':
+        # mm is the model of the first key length, its writer counts the increments of all of them
+        models = make_models(args, key_lengths, redis_nodes, backend)
+        mm = models[0]
+
+
+    def prune_model():
+        """
+        Prune the model with the thresholds from the CLI, returning the number of removed completions and deleted keys
+        """
+        removed_count = deleted_count = 0
+        for model in models:
+            model_removed_count, model_deleted_count = model.prune(
+                min_count=args.min_count if args.min_count > 0 else None, top_k=args.top_k if args.top_k > 0 else None)
+            removed_count += model_removed_count
+            deleted_count += model_deleted_count
+        return removed_count, deleted_count
+
+
+    def save_checkpoint(checkpoint):
+        """
+        Write the checkpoint of a build atomically: after a crash the file holds either this checkpoint or the
+        previous one
+        """
+        temporary_file = checkpoint_file + '.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_file, checkpoint_file)
+
+
+    def load_checkpoint(header):
+        """
+        Read the checkpoint of an interrupted build, checking that it's for the same input file and model.
+        The one in Redis is committed with the increments, the file is used only for the builds without it.
+        None if there's no checkpoint
+        """
+        stored = mm.backend.get_value(checkpoint_key)
+        if stored is not None:
+            checkpoint = json.loads(stored.decode('utf8'))
+        elif os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                checkpoint = json.load(f)
+        else:
+            return None
+        if checkpoint['sync_marker'] != header.sync_marker.hex():
+            parser.error('the checkpoint {0} is for another input file, {1}'.format(checkpoint_file,
+                                                                                   checkpoint['input_file']))
+        if checkpoint['prefix'] != prefix or checkpoint['key_lengths'] != key_lengths or checkpoint['tags'] != tags:
+            parser.error('the checkpoint {0} is for the model with prefix {1}, key lengths {2} and tags {3}'
+                         .format(checkpoint_file, checkpoint['prefix'], checkpoint['key_lengths'], checkpoint['tags']))
+        return checkpoint
+
+
+    def committed_checkpoint():
+        """
+        The checkpoint of the sequential build, called when all the utterances before next_position are in Redis
+        """
+        checkpoint = dict(resumed_checkpoint)
+        checkpoint['block_offset'], checkpoint['record_index'] = next_position
+        checkpoint['utterances_count'] += utterances_count
+        checkpoint['tokens_count'] += tokens_count
+        if mm.writer is not None:
+            checkpoint['increments_count'] += mm.writer.increments_count
+            checkpoint['commands_count'] += mm.writer.commands_count
+            checkpoint['round_trips'] += mm.writer.round_trips
+        checkpoint['time'] = time.time()
+        return checkpoint
+
+
+    if args.operation == 'build':
+        input_file = args.input_file
+        skip_to = args.skip_to
+        index = None
         if len(tags) > 0:
-            # the utterance has no tags, ignore it
-            if utterance['tags'] is None:
-                continue
-            # check that at least one of the required tags is present
-            if not any(filter(lambda t: t in tags, utterance['tags'])):
+            print('will import file {0} using key prefix {1}, filtering tags {2}'.format(input_file, prefix, tags))
+            index = tag_index.load_index(input_file)
+            if index is None:
+                print('there is no tag index for {0}, all the utterances will be decoded to filter them. '
+                      'Build it with tag_index.py to read only the blocks containing the tags'.format(input_file))
+            else:
+                print('reading only the blocks containing the tags, from {0}'.format(tag_index.index_path(input_file)))
+        else:
+            print('will import all utterances in file {0} using key prefix {1}'.format(input_file, prefix))
+        if len(models) > 1:
+            print('building the key lengths {0} with the prefixes {1}'.format(key_lengths, [m.prefix for m in models]))
+        for model in models:
+            if model.frozen:
+                # the frozen completions would not include the new n-grams
+                model.unfreeze()
+                print('the model {0} was frozen, generation will use the updated model until it is frozen again'
+                      .format(model.prefix))
+        memory_before = mm.backend.memory_usage()
+        # counters to log performances
+        start_time = time.time()
+        utterances_count = 0
+        tokens_count = 0
+
+        if args.workers > 1:
+            block_ranges = avro_blocks.split_for_workers(input_file, args.workers)
+            # the ranges ending before skip_to are not read at all
+            block_ranges = [r for r, following in zip(block_ranges, block_ranges[1:] + [None])
+                            if following is None or following[2] > skip_to]
+            print('split the file in {0} block ranges for {1} workers'.format(len(block_ranges), args.workers))
+            increments_count = commands_count = round_trips = 0
+            pruned_at = 0
+            # the counts are added, so the results are taken as soon as they are ready
+            # the workers get the settings with the function, they don't run main()
+            build_range = functools.partial(build_block_range, args, key_lengths, redis_nodes, tags, index)
+            for result in avro_blocks.map_block_ranges(build_range, block_ranges, args.workers, ordered=False):
+                utterances_count += result[0]
+                tokens_count += result[1]
+                increments_count += result[2]
+                commands_count += result[3]
+                round_trips += result[4]
+                if args.prune_every > 0 and utterances_count - pruned_at >= args.prune_every:
+                    # the workers keep writing meanwhile, their increments are pruned the next time
+                    prune_model()
+                    pruned_at = utterances_count
+                elapsed = time.time() - start_time
+                print(' --- so far, processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
+                      .format(utterances_count, tokens_count, elapsed, utterances_count / elapsed))
+        else:
+            tokenizer_pool = tokenizers.make_pool(args.tokenizer_processes)
+            f = open(input_file, 'rb')
+            header = avro_blocks.read_header(f)
+            datum_reader = DatumReader(header.schema)
+            # the counts of this run are added to the ones of the resumed build
+            resumed_checkpoint = {'input_file': input_file, 'sync_marker': header.sync_marker.hex(), 'prefix': prefix,
+                                  'key_lengths': key_lengths, 'tags': tags, 'utterances_count': 0, 'tokens_count': 0,
+                                  'increments_count': 0, 'commands_count': 0, 'round_trips': 0}
+            checkpoint = load_checkpoint(header) if args.resume else None
+            if checkpoint is not None:
+                resumed_checkpoint = checkpoint
+                next_position = (resumed_checkpoint['block_offset'], resumed_checkpoint['record_index'])
+                print('resuming after {0} utterances, from the block at offset {1}'
+                      .format(resumed_checkpoint['utterances_count'], next_position[0]))
+            else:
+                if args.resume:
+                    print('no checkpoint found in {0}, starting from the beginning'.format(checkpoint_file))
+                next_position = avro_blocks.locate_record(input_file, skip_to)
+            # next_position is the block offset and the index in the block of the next utterance to read
+            if args.backend == 'redis' and mm.writer is not None:
+                # a commit never splits an utterance, so the ones before next_position are all in Redis
+                mm.writer.commit_values = lambda: {checkpoint_key: json.dumps(committed_checkpoint()).encode('utf8')}
+                mm.writer.on_commit = lambda: save_checkpoint(committed_checkpoint())
+                print('saving the position of the build in {0}'.format(checkpoint_file))
+            first_block_offset, first_record_index = next_position
+            if index is None:
+                blocks = ((offset, record_count, data, range(record_count)) for offset, record_count, data
+                          in avro_blocks.iterate_blocks(f, header, first_block_offset))
+            else:
+                # the positions of the tagged utterances in the blocks containing them
+                blocks = tag_index.iterate_tagged_blocks(f, header, index, tags, first_block_offset)
+            for block_offset, record_count, data, positions in blocks:
+                next_block_offset = f.tell()
+                records = utterance_decoder.decode_block(header, data, positions[-1] + 1 if len(positions) > 0 else 0,
+                                                         ('text', 'tags'), datum_reader)
+                if block_offset == first_block_offset:
+                    positions = [p for p in positions if p >= first_record_index]
+                selections = [is_selected(records[p], selected_tags) for p in positions]
+                # the selected utterances of the block are tokenized together
+                token_lists = iter(tokenizers.tokenize_batch([records[p]['text'] for p, s in zip(positions, selections) if s],
+                                                             args.tokenizer, pool=tokenizer_pool,
+                                                             processes=args.tokenizer_processes))
+                for record_index, selected in zip(positions, selections):
+                    utterances_count += 1
+                    if record_index + 1 < record_count:
+                        next_position = (block_offset, record_index + 1)
+                    else:
+                        next_position = (next_block_offset, 0)
+                    if selected:
+                        tokens = next(token_lists)
+                        tokens_count += keylen + len(tokens)
+                        add_utterance(models, tokens)
+                    if args.prune_every > 0 and utterances_count % args.prune_every == 0:
+                        prune_model()
+                    if utterances_count % 1000 == 0:
+                        elapsed = time.time() - start_time
+                        print(' --- so far, processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
+                              .format(utterances_count, tokens_count, elapsed, utterances_count / elapsed))
+            f.close()
+            if tokenizer_pool is not None:
+                tokenizer_pool.close()
+            for model in models:
+                model.close()
+            if args.backend == 'redis' and mm.writer is not None:
+                checkpoint = committed_checkpoint()
+                mm.backend.set_values({checkpoint_key: json.dumps(checkpoint).encode('utf8')})
+                save_checkpoint(checkpoint)
+            increments_count = commands_count = round_trips = 0
+            if mm.writer is not None:
+                increments_count = mm.writer.increments_count
+                commands_count = mm.writer.commands_count
+                round_trips = mm.writer.round_trips
+
+        if args.prune_every > 0:
+            removed_count, deleted_count = prune_model()
+            print('pruned the model, removed {0} completions and {1} keys'.format(removed_count, deleted_count))
+        elapsed = time.time() - start_time
+        print('processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
+              .format(utterances_count, tokens_count, elapsed, utterances_count/elapsed))
+        if args.backend == 'memory':
+            backend.save(args.model_file)
+            print('model saved in {0}'.format(args.model_file))
+        elif round_trips > 0:
+            print('sent {0} n-gram increments as {1} commands in {2} pipelines, saving {3} round trips'
+                  .format(increments_count, commands_count, round_trips, increments_count - round_trips))
+        if memory_before is not None:
+            print('the memory used by the model grew by {0} bytes'.format(mm.backend.memory_usage() - memory_before))
+
+    if args.operation == 'freeze':
+        print('freezing the model with key prefix {0}'.format(prefix))
+        start_time = time.time()
+        frozen_count = mm.freeze()
+        if args.backend == 'memory':
+            backend.save(args.model_file)
+        elapsed = time.time() - start_time
+        print('froze {0} keys, it took {1} seconds'.format(frozen_count, elapsed))
+
+    if args.operation == 'index':
+        # index the keys of a model built without them, to pick random seeds with SRANDMEMBER
+        print('indexing the keys of the model with key prefix {0}'.format(prefix))
+        start_time = time.time()
+        indexed_count = index_keys(mm.backend, prefix, start_keys=[make_key(mm.to_ids(start_seq), prefix)])
+        if args.backend == 'memory':
+            backend.save(args.model_file)
+        elapsed = time.time() - start_time
+        print('indexed {0} keys, it took {1} seconds'.format(indexed_count, elapsed))
+
+    if args.operation == 'score':
+        print('scoring the utterances in file {0} with the model with key prefix {1}'.format(args.input_file, prefix))
+        scores_file = open(args.scores_file, 'w', encoding='utf-8') if args.scores_file is not None else None
+        start_time = time.time()
+        utterances_count = 0
+        selected = []
+
+        def write_scores(batch):
+            token_lines = [start_seq + splitter(utterance['text']) for _, utterance in batch]
+            for (index, utterance), score in zip(batch, mm.score_lines(token_lines)):
+                line = '{0}\t{1}\t{2}'.format(index, score, utterance['source'])
+                if scores_file is not None:
+                    scores_file.write(line + '\n')
+                else:
+                    print(line)
+
+        for utterance in utterance_decoder.iterate_utterances(args.input_file, ('text', 'source', 'tags')):
+            utterances_count += 1
+            if not is_selected(utterance, selected_tags):
                 continue
-        tokens = start_seq + splitter(utterance['text'])
-        # print('processing {0} tokens in utterance {1}'.format(len(tokens), utterances_count))
-        tokens_count += len(tokens)
-        mm.add_line_to_index(tokens)
-        if utterances_count % 1000 == 0:
-            elapsed = time.time() - start_time
-            print(' --- so far, processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
-                  .format(utterances_count, tokens_count, elapsed, utterances_count / elapsed))
-
-    elapsed = time.time() - start_time
-    print('processed {0} utterances containing {1} tokens, it took {2} seconds [{3} utterances per second]'
-          .format(utterances_count, tokens_count, elapsed, utterances_count/elapsed))
-    reader.close()
-
-if args.operation == 'generate':
-    seed = start_seq
-    if args.seed is not None:
-        # if the seed is shorter than keylen, pad it with the starting sequence
-        seed = start_seq + splitter(args.seed)
-        seed = seed[:-keylen]
-    print('using seed {0}'.format(seed))
-    for i in range(args.number):
-        # use the starting sequence but remove it from the result
-        gen = mm.generate(seed=seed, max_words=args.max_length)[keylen:]
-        print(joiner(gen))
-
-# TODO add likelihood calculation
+            selected.append((utterances_count, utterance))
+            if len(selected) >= 1000:
+                write_scores(selected)
+                selected = []
+        write_scores(selected)
+        if scores_file is not None:
+            scores_file.close()
+        elapsed = time.time() - start_time
+        print('scored {0} utterances, it took {1} seconds [{2} utterances per second]'
+              .format(utterances_count, elapsed, utterances_count / elapsed))
+
+    if args.operation == 'flush':
+        print('deleting the model with key prefix {0}'.format(prefix))
+        start_time = time.time()
+
+        def report_flush(deleted_count):
+            if deleted_count % 100000 < 1000:
+                print(' --- so far, deleted {0} keys in {1} seconds'.format(deleted_count, time.time() - start_time))
+
+        deleted_count = mm.flush(progress=report_flush)
+        if args.backend == 'memory':
+            backend.save(args.model_file)
+        elapsed = time.time() - start_time
+        print('deleted {0} keys, it took {1} seconds'.format(deleted_count, elapsed))
+
+    if args.operation == 'stats':
+        nodes_stats = mm.backend.stats()
+        if len(nodes_stats) == 0:
+            print('the {0} backend has no nodes, the model uses {1} bytes'.format(args.backend,
+                                                                                  mm.backend.memory_usage()))
+        for node_stats in nodes_stats:
+            print('{0}: {1} keys, {2} bytes'.format(node_stats['node'], node_stats['keys'], node_stats['memory']))
+        if len(nodes_stats) > 1:
+            print('total: {0} keys, {1} bytes'.format(sum(n['keys'] for n in nodes_stats),
+                                                     sum(n['memory'] for n in nodes_stats)))
+
+    if args.operation == 'prune':
+
+        def generation_latency():
+            """
+            The average time to generate an utterance from the starting sequence, in seconds
+            """
+            random.seed(0)
+            generation_start = time.time()
+            for _ in range(args.benchmark):
+                mm.generate(seed=start_seq, max_words=args.max_length)
+            return (time.time() - generation_start) / args.benchmark
+
+        print('pruning the model with key prefix {0}'.format(prefix))
+        if mm.frozen:
+            print('the model is frozen, it will be unfrozen and has to be frozen again after pruning')
+        latency_before = generation_latency() if args.benchmark > 0 else None
+        memory_before = mm.backend.memory_usage()
+        start_time = time.time()
+        removed_count, deleted_count = prune_model()
+        elapsed = time.time() - start_time
+        print('removed {0} completions and {1} keys, it took {2} seconds'.format(removed_count, deleted_count, elapsed))
+        if memory_before is not None:
+            print('freed {0} bytes'.format(memory_before - mm.backend.memory_usage()))
+        if latency_before is not None:
+            latency_after = generation_latency()
+            print('generating an utterance took {0:.2f} ms before pruning and {1:.2f} ms after'
+                  .format(latency_before * 1000, latency_after * 1000))
+        if args.backend == 'memory':
+            backend.save(args.model_file)
+
+    if args.operation == 'export':
+        print('exporting the model with key prefix {0} to {1}'.format(prefix, args.snapshot_file))
+        start_time = time.time()
+
+        def report_export(exported_count):
+            if exported_count % 100000 < 1000:
+                print(' --- so far, exported {0} keys in {1} seconds'.format(exported_count, time.time() - start_time))
+
+        exported_count = markov_snapshot.export_snapshot(mm, args.snapshot_file, progress=report_export)
+        elapsed = time.time() - start_time
+        print('exported {0} keys in {1} bytes, it took {2} seconds'
+              .format(exported_count, os.path.getsize(args.snapshot_file), elapsed))
+
+    if args.operation == 'import':
+        snapshot_keylen = markov_snapshot.snapshot_info(args.snapshot_file)['key_length']
+        if snapshot_keylen != keylen:
+            parser.error('the snapshot has keys of length {0}, use -keylen {0}'.format(snapshot_keylen))
+        print('importing {0} in the model with key prefix {1}'.format(args.snapshot_file, prefix))
+        if mm.frozen:
+            # the frozen completions would not include the imported ones
+            mm.unfreeze()
+            print('the model was frozen, generation will use the updated model until it is frozen again')
+        start_time = time.time()
+
+        def report_import(imported_count):
+            if imported_count % 100000 < 1000:
+                print(' --- so far, imported {0} keys in {1} seconds'.format(imported_count, time.time() - start_time))
+
+        imported_count = markov_snapshot.import_snapshot(mm, args.snapshot_file, progress=report_import)
+        if args.backend == 'memory':
+            backend.save(args.model_file)
+        elapsed = time.time() - start_time
+        print('imported {0} keys, it took {1} seconds'.format(imported_count, elapsed))
+
+    if args.operation == 'merge':
+        merge_files = list(filter(lambda x: x != '', args.merge_files.split(',')))
+        print('merging {0} into {1}'.format(merge_files, args.snapshot_file))
+        start_time = time.time()
+        merged_count = markov_snapshot.merge_snapshots(merge_files, args.snapshot_file)
+        elapsed = time.time() - start_time
+        print('merged snapshot with {0} keys, it took {1} seconds'.format(merged_count, elapsed))
+
+    if args.operation == 'compile':
+        print('compiling the model with key prefix {0} to {1}'.format(prefix, args.mmap_file))
+        start_time = time.time()
+        compiled_count = markov_mmap.write_model(mm, args.mmap_file)
+        elapsed = time.time() - start_time
+        print('compiled {0} keys in {1} bytes, it took {2} seconds'
+              .format(compiled_count, os.path.getsize(args.mmap_file), elapsed))
+
+    if args.operation == 'generate':
+        seed = start_seq
+        if args.seed is not None:
+            # if the seed is shorter than keylen, pad it with the starting sequence
+            seed = start_seq + splitter(args.seed)
+            seed = seed[:-keylen]
+        relevant_terms = None
+        if args.topic is not None:
+            # the seed is a key of the model containing one of the terms
+            seed = None
+            relevant_terms = list(filter(lambda x: x != '', args.topic.split(',')))
+            print('using a seed relevant to {0}'.format(relevant_terms))
+        else:
+            print('using seed {0}'.format(seed))
+        if args.random_seed is not None:
+            random.seed(args.random_seed)
+        if args.number > 1 and not args.server_side:
+            # the utterances are generated together, reading the keys of all of them at each step
+            generated = mm.generate_many(args.number, seed=seed, max_words=args.max_length,
+                                         relevant_terms=relevant_terms)
+        else:
+            generated = []
+            for i in range(args.number):
+                random_seed = None
+                if args.random_seed is not None:
+                    random_seed = args.random_seed + i
+                generated.append(mm.generate(seed=seed, max_words=args.max_length, server_side=args.server_side,
+                                             random_seed=random_seed, relevant_terms=relevant_terms))
+        for gen in generated:
+            # use the starting sequence but remove it from the result
+            if seed is None:
+                # the key may be at the beginning of an utterance
+                while len(gen) > 0 and gen[0] == start_seq[0]:
+                    gen = gen[1:]
+            else:
+                gen = gen[keylen:]
+            print(joiner(gen))
+        cache_info = mm.cache_info()
+        if cache_info is not None:
+            print('completions cache: {0} hits, {1} misses'.format(cache_info['hits'], cache_info['misses']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Load test for markov_service.py: sends requests from many concurrent keep-alive connections and reports the
+throughput and the latency percentiles. For streamed generations the time to the first token is reported too
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import quote
+
+
+async def read_response(reader):
+    """
+    Read a response, returning the status, the body and the time when its first byte was received
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed by the service')
+    status = int(status_line.split(b' ')[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        chunks = []
+        first_chunk_at = None
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                # the service aborts a stream without the last chunk when the generation fails
+                raise ConnectionError('the response was interrupted by the service')
+            size = int(size_line.strip(), 16)
+            if first_chunk_at is None:
+                first_chunk_at = time.time()
+            chunks.append(await reader.readexactly(size + 2))
+            if size == 0:
+                break
+        return status, b''.join(c[:-2] for c in chunks), first_chunk_at
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, body, time.time()
+
+
+def percentile(values, p):
+    """
+    The value below which p percent of the sorted values are
+    """
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def client(host, port, requests, results, failures):
+    """
+    Send the requests one after the other on a single connection, appending (latency, first byte latency, ok).
+    When the connection breaks, e.g. on a streamed generation aborted by the service, the error is appended
+    to failures and the remaining requests are not sent
+    """
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        for request in requests:
+            start = time.time()
+            writer.write(request)
+            await writer.drain()
+            status, _, first_byte_at = await read_response(reader)
+            end = time.time()
+            results.append((end - start, first_byte_at - start, status == 200))
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+        failures.append(e)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_clients(clients):
+    await asyncio.gather(*clients)
+
+
+def make_request(args, host):
+    if args.endpoint == 'score':
+        body = '\n'.join([args.text] * args.lines).encode('utf8')
+        head = 'POST /score HTTP/1.1\r\nHost: {0}\r\nContent-Length: {1}\r\n\r\n'.format(host, len(body))
+        return head.encode('latin-1') + body
+    query = 'max_words={0}'.format(args.max_words)
+    if args.seed is not None:
+        query += '&seed=' + quote(args.seed)
+    if args.topic is not None:
+        query += '&topic=' + quote(args.topic)
+    if args.endpoint == 'stream':
+        query += '&stream=1'
+    return 'GET /generate?{0} HTTP/1.1\r\nHost: {1}\r\n\r\n'.format(query, host).encode('latin-1')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="measure the latency of markov_service.py under load")
+    parser.add_argument("-host", type=str, help="the host of the service", default="127.0.0.1")
+    parser.add_argument("-port", type=int, help="the port of the service", default=8080)
+    parser.add_argument("-endpoint", type=str, default='generate', choices=['generate', 'stream', 'score'])
+    parser.add_argument("-concurrency", type=int, help="how many connections send requests at the same time",
+                        default=32)
+    parser.add_argument("-requests", type=int, help="the total number of requests", default=2000)
+    parser.add_argument("-max_words", type=int, help="the maximum length of the generated utterances", default=100)
+    parser.add_argument("-seed", type=str, help="the seed of the generated utterances")
+    parser.add_argument("-topic", type=str, help="comma separated terms to seed the generation")
+    parser.add_argument("-text", type=str, help="the utterance to score", default="this is a test")
+    parser.add_argument("-lines", type=int, help="how many utterances to score in each request", default=10)
+    args = parser.parse_args()
+
+    results = []
+    failures = []
+    clients = []
+    for c in range(args.concurrency):
+        count = args.requests // args.concurrency + (1 if c < args.requests % args.concurrency else 0)
+        requests = [make_request(args, args.host)] * count
+        clients.append(client(args.host, args.port, requests, results, failures))
+    start_time = time.time()
+    asyncio.run(run_clients(clients))
+    elapsed = time.time() - start_time
+
+    latencies = sorted(r[0] for r in results)
+    first_bytes = sorted(r[1] for r in results)
+    errors_count = sum(1 for r in results if not r[2])
+    print('{0} requests to /{1} from {2} connections in {3:.2f} seconds [{4:.1f} requests per second], {5} errors'
+          .format(len(results), args.endpoint, args.concurrency, elapsed, len(results) / elapsed, errors_count))
+    if len(failures) > 0:
+        print('{0} connections broke, the first one with {1!r}'.format(len(failures), failures[0]))
+    if len(latencies) == 0:
+        print('no request got a response, there are no latencies to report')
+    else:
+        print('latency p50 {0:.2f} ms, p99 {1:.2f} ms, max {2:.2f} ms'
+              .format(percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, latencies[-1] * 1000))
+    if args.endpoint == 'stream' and len(first_bytes) > 0:
+        print('first token p50 {0:.2f} ms, p99 {1:.2f} ms'
+              .format(percentile(first_bytes, 50) * 1000, percentile(first_bytes, 99) * 1000))
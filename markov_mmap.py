@@ -0,0 +1,323 @@
+"""
+A read-only binary format for Markov models, used directly from a memory map of the file: opening a model only
+reads its header, and the processes serving the same file share its pages instead of each having a copy.
+
+The file is a header followed by sections aligned to 8 bytes, each one an array of a single type:
+ - key_table and string_table: open addressing hash tables (crc32, linear probing) with the index + 1 of each
+   key and completion string, 0 for the empty slots
+ - key_offsets and key_data: the UTF-8 keys without the prefix, key i is key_data[key_offsets[i]:key_offsets[i + 1]]
+ - completion_offsets, completion_ids and cumulative: the completions of key i are the elements from
+   completion_offsets[i] to completion_offsets[i + 1], by decreasing weight, as string ids and weights cumulated
+   from the first completion of the key
+ - string_offsets and string_data: the UTF-8 completions, like the keys
+ - start_keys: the ids of the keys at the beginning of a line, to pick random seeds
+The header is the magic, the format version, the length of a JSON description (prefix, key length and position
+of each section after the header) and the description itself. Numbers are little-endian
+"""
+from array import array
+import bisect
+import json
+import mmap
+import random
+import struct
+import sys
+import zlib
+
+from markov import Backend, Markov, SEPARATOR, meta_key
+
+MAGIC = b'MKVM'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+EMPTY_SLOT = 0
+
+
+def table_size(count):
+    """
+    The number of slots of a hash table for count items, a power of 2 at most half full
+    """
+    size = 8
+    while size < 2 * count:
+        size *= 2
+    return size
+
+
+def align(size):
+    return (size + 7) // 8 * 8
+
+
+def build_table(offsets, data):
+    """
+    The hash table of the strings in data delimited by offsets, see the module documentation
+    """
+    table = array('I', [EMPTY_SLOT]) * table_size(len(offsets) - 1)
+    mask = len(table) - 1
+    for i in range(len(offsets) - 1):
+        slot = zlib.crc32(data[offsets[i]:offsets[i + 1]]) & mask
+        while table[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & mask
+        table[slot] = i + 1
+    return table
+
+
+class ModelWriter(object):
+    """
+    Accumulates the keys of a model in arrays and writes them in the binary format
+    """
+    def __init__(self, prefix, key_length):
+        self.prefix = prefix
+        self.key_length = key_length
+        self.key_offsets = array('Q', [0])
+        self.key_data = bytearray()
+        self.completion_offsets = array('Q', [0])
+        self.completion_ids = array('I')
+        self.cumulative = array('d')
+        self.string_ids = {}
+        self.string_offsets = array('Q', [0])
+        self.string_data = bytearray()
+        self.start_keys = array('I')
+        # whether random seeds are picked from all the keys or just the start keys, like for the source model
+        self.all_keys = False
+
+    def add_key(self, key_tokens, completions, start=False):
+        """
+        Add a key, with its completions as a list of (completion, weight)
+        """
+        if start:
+            self.start_keys.append(len(self.key_offsets) - 1)
+        self.key_data += SEPARATOR.join(key_tokens).encode('utf8')
+        self.key_offsets.append(len(self.key_data))
+        total = 0
+        for completion, weight in sorted(completions, key=lambda c: c[1], reverse=True):
+            string_id = self.string_ids.get(completion)
+            if string_id is None:
+                string_id = len(self.string_ids)
+                self.string_ids[completion] = string_id
+                self.string_data += completion.encode('utf8')
+                self.string_offsets.append(len(self.string_data))
+            total += weight
+            self.completion_ids.append(string_id)
+            self.cumulative.append(total)
+        self.completion_offsets.append(len(self.completion_ids))
+
+    def write(self, path):
+        if sys.byteorder == 'big':
+            raise ValueError('the binary model format is little-endian and read without copies')
+        sections = [('key_table', build_table(self.key_offsets, self.key_data)),
+                    ('key_offsets', self.key_offsets),
+                    ('key_data', array('B', self.key_data)),
+                    ('completion_offsets', self.completion_offsets),
+                    ('completion_ids', self.completion_ids),
+                    ('cumulative', self.cumulative),
+                    ('string_table', build_table(self.string_offsets, self.string_data)),
+                    ('string_offsets', self.string_offsets),
+                    ('string_data', array('B', self.string_data)),
+                    ('start_keys', self.start_keys)]
+        description = {'prefix': self.prefix, 'key_length': self.key_length, 'all_keys': self.all_keys,
+                       'sections': {}}
+        # the positions are relative to the end of the header
+        position = 0
+        for name, values in sections:
+            description['sections'][name] = [position, len(values), values.typecode]
+            position += align(values.itemsize * len(values))
+        encoded = json.dumps(description).encode('utf8')
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(encoded)) + encoded)
+            f.write(b'\0' * (align(f.tell()) - f.tell()))
+            for name, values in sections:
+                values.tofile(f)
+                f.write(b'\0' * (align(f.tell()) - f.tell()))
+
+
+def write_model(markov, path, batch_size=1000, progress=None):
+    """
+    Write a model in the binary format, reading the completions of batch_size keys per round trip.
+    The keys and completions of an interned model are written as tokens.
+    progress, if given, is called with the number of keys written so far. Returns the number of keys
+    """
+    writer = ModelWriter(markov.prefix, markov.key_length)
+    writer.all_keys = markov.backend.random_member(meta_key(markov.prefix, 'keys')) is not None
+    keys = []
+    key_count = 0
+    for key in markov.backend.iterate_keys(markov.prefix):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            key_count += _add_keys(markov, keys, writer)
+            keys = []
+            if progress is not None:
+                progress(key_count)
+    key_count += _add_keys(markov, keys, writer)
+    writer.write(path)
+    return key_count
+
+
+def _add_keys(markov, keys, writer):
+    if len(keys) == 0:
+        return 0
+    added_count = 0
+    starts = markov.backend.are_members(meta_key(markov.prefix, 'start_keys'), keys)
+    for key, start, completions in zip(keys, starts, markov.backend.completions_many(keys)):
+        if len(completions) == 0:
+            continue
+        completions = [(SEPARATOR.join(markov.to_tokens(c.split(SEPARATOR))), w) for c, w in completions]
+        writer.add_key(markov.to_tokens(key.split(SEPARATOR)[1:]), completions, start=start)
+        added_count += 1
+    return added_count
+
+
+class MmapBackend(Backend):
+    """
+    Reads a model in the binary format from a memory map of the file. It's read-only, the writes are not
+    implemented
+    """
+    def __init__(self, path):
+        if sys.byteorder == 'big':
+            raise ValueError('the binary model format is little-endian and read without copies')
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        magic, version, description_size = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{0} is not a binary Markov model'.format(path))
+        description = json.loads(bytes(self.view[HEADER.size:HEADER.size + description_size]).decode('utf8'))
+        self.prefix = description['prefix']
+        self.key_length = description['key_length']
+        self.all_keys = description['all_keys']
+        self.sections = {}
+        data_start = align(HEADER.size + description_size)
+        for name, (position, count, typecode) in description['sections'].items():
+            position += data_start
+            size = array(typecode).itemsize * count
+            self.sections[name] = self.view[position:position + size].cast(typecode)
+        self.key_table = self.sections['key_table']
+        self.key_offsets = self.sections['key_offsets']
+        self.key_data = self.sections['key_data']
+        self.completion_offsets = self.sections['completion_offsets']
+        self.completion_ids = self.sections['completion_ids']
+        self.cumulative = self.sections['cumulative']
+        self.string_table = self.sections['string_table']
+        self.string_offsets = self.sections['string_offsets']
+        self.string_data = self.sections['string_data']
+        self.start_keys = self.sections['start_keys']
+        self.key_count = len(self.key_offsets) - 1
+
+    def close(self):
+        for section in self.sections.values():
+            section.release()
+        self.sections = {}
+        self.view.release()
+        self.mmap.close()
+
+    def _find(self, table, offsets, data, value):
+        """
+        The index of a string in one of the hash tables, None if not present
+        """
+        value = value.encode('utf8')
+        mask = len(table) - 1
+        slot = zlib.crc32(value) & mask
+        while table[slot] != EMPTY_SLOT:
+            i = table[slot] - 1
+            if data[offsets[i]:offsets[i + 1]] == value:
+                return i
+            slot = (slot + 1) & mask
+        return None
+
+    def _key_id(self, key):
+        if not key.startswith(self.prefix + SEPARATOR):
+            return None
+        return self._find(self.key_table, self.key_offsets, self.key_data, key[len(self.prefix) + len(SEPARATOR):])
+
+    def _key(self, key_id):
+        return SEPARATOR.join((self.prefix, bytes(self.key_data[self.key_offsets[key_id]:self.key_offsets[key_id + 1]])
+                               .decode('utf8')))
+
+    def _string(self, string_id):
+        return bytes(self.string_data[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]).decode('utf8')
+
+    def _weight(self, position, start):
+        return self.cumulative[position] - (self.cumulative[position - 1] if position > start else 0)
+
+    def _range(self, key):
+        key_id = self._key_id(key)
+        if key_id is None:
+            return 0, 0
+        return self.completion_offsets[key_id], self.completion_offsets[key_id + 1]
+
+    def completions(self, key):
+        start, end = self._range(key)
+        return [(self._string(self.completion_ids[i]), self._weight(i, start)) for i in range(start, end)]
+
+    def sample_completion(self, key):
+        start, end = self._range(key)
+        if end == start:
+            return None
+        position = bisect.bisect_left(self.cumulative, random.uniform(0, self.cumulative[end - 1]), start, end)
+        return self._string(self.completion_ids[min(position, end - 1)])
+
+    def score(self, key, completion):
+        start, end = self._range(key)
+        if end == start:
+            return None
+        string_id = self._find(self.string_table, self.string_offsets, self.string_data, completion)
+        for i in range(start, end):
+            if self.completion_ids[i] == string_id:
+                return self._weight(i, start)
+        return None
+
+    def max_score(self, key):
+        start, end = self._range(key)
+        return self.cumulative[start] if end > start else 0
+
+    def min_score(self, key):
+        start, end = self._range(key)
+        return self._weight(end - 1, start) if end > start else 0
+
+    def random_key(self, prefix=None):
+        if self.key_count == 0 or (prefix and prefix != self.prefix):
+            return None
+        return self._key(random.randrange(self.key_count))
+
+    def find_keys(self, term, prefix=None):
+        if prefix and prefix != self.prefix:
+            return []
+        return [key for key in self.iterate_keys(self.prefix) if term in key[len(self.prefix) + len(SEPARATOR):]]
+
+    def iterate_keys(self, prefix):
+        if prefix != self.prefix:
+            return
+        for key_id in range(self.key_count):
+            yield self._key(key_id)
+
+    def get_value(self, key):
+        return None
+
+    def random_member(self, set_key):
+        if set_key == meta_key(self.prefix, 'keys') and self.all_keys:
+            return self.random_key()
+        if set_key == meta_key(self.prefix, 'start_keys') and len(self.start_keys) > 0:
+            return self._key(self.start_keys[random.randrange(len(self.start_keys))])
+        return None
+
+    def are_members(self, set_key, members):
+        if set_key == meta_key(self.prefix, 'keys') and self.all_keys:
+            return [self._key_id(member) is not None for member in members]
+        if set_key == meta_key(self.prefix, 'start_keys'):
+            start_keys = set(self.start_keys)
+            return [self._key_id(member) in start_keys for member in members]
+        return [False] * len(members)
+
+    def memory_usage(self):
+        return len(self.mmap)
+
+
+class MmapMarkov(Markov):
+    """
+    A read-only Markov model, generating and scoring from a file in the binary format
+    """
+    def __init__(self, path, cache_size=0):
+        backend = MmapBackend(path)
+        super().__init__(prefix=backend.prefix, key_length=backend.key_length, backend=backend, frozen=False,
+                         cache_size=cache_size, key_index=None)
+
+    def close(self):
+        super().close()
+        self.backend.close()
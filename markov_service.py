@@ -0,0 +1,263 @@
+"""
+A long-running HTTP service generating and scoring with a Markov model, so that the clients don't pay the
+interpreter startup, the argument parsing and a new Redis connection at every call.
+
+ GET /generate?seed=...&topic=...&max_words=...&stream=1
+   generates an utterance, optionally from a seed or from a key containing one of the comma separated terms of
+   topic. The result is {"text": ...}, with stream=1 the tokens are sent as plain text as they are picked and
+   the connection is closed without the last chunk if the generation fails
+ POST /score
+   scores the utterances in the body, one per line. The result is {"scores": [...]}
+
+The pinned Redis client has no asyncio support, so the event loop only parses the requests and writes the
+responses while the model is used by a bounded pool of threads sharing a pool of Redis connections. Each thread
+has its own Markov instance, so their caches are not shared between threads
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import redis
+
+from markov import Markov, MemoryBackend, RedisBackend
+from markov_mmap import MmapBackend
+import tokenizers
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MarkovService(object):
+    """
+    Generates and scores with a model shared by a pool of threads, see the module documentation
+    """
+    def __init__(self, backend, prefix, key_length, tokenizer='split', pool_size=16, cache_size=0,
+                 version_check_interval=1.0):
+        self.backend = backend
+        self.prefix = prefix
+        self.key_length = key_length
+        self.cache_size = cache_size
+        self.version_check_interval = version_check_interval
+        self.start_seq = list('°' * key_length)
+        self.splitter, joiner = tokenizers.get_tokenizer(tokenizer)
+        # the text between two tokens, to stream them one at a time
+        self.separator = joiner(['', ''])
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.local = threading.local()
+
+    def markov(self):
+        """
+        The Markov instance of the current thread
+        """
+        markov = getattr(self.local, 'markov', None)
+        if markov is None:
+            markov = Markov(prefix=self.prefix, key_length=self.key_length, backend=self.backend,
+                            cache_size=self.cache_size, version_check_interval=self.version_check_interval,
+                            key_index=None)
+            self.local.markov = markov
+        return markov
+
+    def generation_tokens(self, seed=None, topic=None, max_words=1000):
+        """
+        Generate the tokens of an utterance without the starting sequence, one at a time
+        """
+        relevant_terms = None
+        if topic:
+            relevant_terms = [t for t in topic.split(',') if t != '']
+            seed = None
+        else:
+            seed = self.start_seq + (self.splitter(seed) if seed else [])
+        leading = True
+        for token in self.markov().iterate_generation(seed=seed, max_words=max_words,
+                                                      relevant_terms=relevant_terms):
+            if leading and token == self.start_seq[0]:
+                continue
+            leading = False
+            yield token
+
+    def generate(self, seed=None, topic=None, max_words=1000):
+        return self.separator.join(self.generation_tokens(seed, topic, max_words))
+
+    def stream_generation(self, loop, queue, seed=None, topic=None, max_words=1000):
+        """
+        Put the generated tokens in an asyncio queue as soon as they are picked, then None.
+        Runs in the thread pool, an exception is put in the queue instead of being raised
+        """
+        try:
+            for token in self.generation_tokens(seed, topic, max_words):
+                loop.call_soon_threadsafe(queue.put_nowait, token)
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+
+    def score(self, utterances):
+        return list(self.markov().score_lines([self.start_seq + self.splitter(u) for u in utterances]))
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests of a connection, keeping it open until the client closes it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(int(headers['content-length']))
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.handle_request(method, target, body, writer, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, target, body, writer, keep_alive):
+        url = urlsplit(target)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        loop = asyncio.get_event_loop()
+        try:
+            if url.path == '/generate':
+                if method != 'GET':
+                    raise ServiceError(405, 'use GET')
+                try:
+                    max_words = int(query.get('max_words', 1000))
+                except ValueError:
+                    raise ServiceError(400, 'max_words must be an integer')
+                arguments = (query.get('seed'), query.get('topic'), max_words)
+                if query.get('stream') == '1':
+                    await self.stream_response(writer, arguments, keep_alive)
+                    return
+                text = await loop.run_in_executor(self.executor, self.generate, *arguments)
+                result = {'text': text}
+            elif url.path == '/score':
+                if method != 'POST':
+                    raise ServiceError(405, 'use POST')
+                utterances = [u for u in body.decode('utf8').split('\n') if u != '']
+                result = {'scores': await loop.run_in_executor(self.executor, self.score, utterances)}
+            else:
+                raise ServiceError(404, 'unknown path {0}'.format(url.path))
+            status = 200
+        except ServiceError as e:
+            status, result = e.status, {'error': str(e)}
+        except ConnectionError:
+            # the connection is broken or a stream was aborted, no response can be sent
+            raise
+        except Exception as e:
+            status, result = 500, {'error': repr(e)}
+        content = json.dumps(result).encode('utf8')
+        writer.write(response_head(status, 'application/json', keep_alive, content_length=len(content)) + content)
+        await writer.drain()
+
+    async def stream_response(self, writer, arguments, keep_alive):
+        """
+        Send the tokens with the chunked transfer encoding as the thread generating them puts them in a queue
+        """
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        loop.run_in_executor(self.executor, self.stream_generation, loop, queue, *arguments)
+        writer.write(response_head(200, 'text/plain; charset=utf-8', keep_alive))
+        first = True
+        while True:
+            token = await queue.get()
+            if token is None:
+                break
+            if isinstance(token, Exception):
+                # the status is already sent, the connection is closed without the last chunk so the client
+                # sees an incomplete response instead of a truncated utterance
+                raise ConnectionAbortedError('the generation failed: {0!r}'.format(token))
+            chunk = ((self.separator if not first else '') + token).encode('utf8')
+            first = False
+            if len(chunk) > 0:
+                writer.write('{0:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+async def serve(service, host, port):
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print('serving the model with key prefix {0} on http://{1}:{2}'.format(service.prefix, host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def response_head(status, content_type, keep_alive, content_length=None):
+    """
+    The status line and the headers of a response, chunked when the length is not given
+    """
+    lines = ['HTTP/1.1 {0} {1}'.format(status, REASONS[status]),
+             'Content-Type: {0}'.format(content_type),
+             'Connection: {0}'.format('keep-alive' if keep_alive else 'close')]
+    if content_length is None:
+        lines.append('Transfer-Encoding: chunked')
+    else:
+        lines.append('Content-Length: {0}'.format(content_length))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="serve generation and scoring with a Markov model over HTTP")
+    parser.add_argument("-host", type=str, help="the address to listen on", default="127.0.0.1")
+    parser.add_argument("-port", type=int, help="the port to listen on", default=8080)
+    parser.add_argument("-markov_prefix", type=str, help="the prefix for redis keys", default="mkv")
+    parser.add_argument("-keylen", type=int, help="the N-gram size", default=3)
+    parser.add_argument("-tokenizer", type=str, help="the method to map text and tokens", default='split',
+                        choices=tokenizers.NAMES)
+    parser.add_argument("-backend", type=str, default='redis', choices=['redis', 'memory', 'mmap'],
+                        help="where the model is, memory and mmap read it from model_file")
+    parser.add_argument("-model_file", type=str, help="the model file of the memory and mmap backends",
+                        default="model.mkv")
+    parser.add_argument("-redis_host", type=str, help="the Redis host", default="localhost")
+    parser.add_argument("-redis_port", type=int, help="the Redis port", default=6379)
+    parser.add_argument("-pool_size", type=int, default=16,
+                        help="how many threads use the model, and how many connections to Redis they share")
+    parser.add_argument("-cache_size", type=int, default=0,
+                        help="how many completion distributions each thread keeps in a LRU cache, 0 to disable it")
+    parser.add_argument("-version_check_interval", type=float, default=1.0,
+                        help="how many seconds the threads wait before checking again if the model changed, "
+                             "e.g. was frozen or unfrozen")
+    args = parser.parse_args()
+
+    keylen = args.keylen
+    prefix = args.markov_prefix
+    if args.backend == 'mmap':
+        backend = MmapBackend(args.model_file)
+        keylen = backend.key_length
+        prefix = backend.prefix
+    elif args.backend == 'memory':
+        if not os.path.exists(args.model_file):
+            parser.error('model file {0} not found'.format(args.model_file))
+        backend = MemoryBackend.load(args.model_file)
+    else:
+        # threads waiting for a connection block instead of opening more than pool_size of them
+        pool = redis.BlockingConnectionPool(host=args.redis_host, port=args.redis_port,
+                                            max_connections=args.pool_size)
+        backend = RedisBackend(redis.Redis(connection_pool=pool))
+
+    service = MarkovService(backend, prefix, keylen, tokenizer=args.tokenizer, pool_size=args.pool_size,
+                            cache_size=args.cache_size, version_check_interval=args.version_check_interval)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,210 @@
+"""
+Snapshots of a Markov model in an Avro file with the schema in markov_snapshot.avsc, one record per key with its
+completions and their weights. They are used to move a model between Redis instances and to merge models built
+on different machines without the corpus.
+The keys and completions are stored as tokens without the prefix, so a snapshot can be imported with another
+prefix and an interned model is exported with its tokens and imported with the vocabulary of the destination.
+The records are encoded and decoded directly instead of with the generic DatumWriter and DatumReader, which are
+too slow for models with tens of millions of n-grams
+"""
+import os
+import struct
+
+import avro_blocks
+from markov import Markov, MemoryBackend, SEPARATOR, meta_key
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markov_snapshot.avsc')
+DOUBLE = struct.Struct('<d')
+
+
+def encode_tokens(buffer, tokens):
+    """
+    Append an array of strings to a bytearray, as a single Avro array block
+    """
+    if len(tokens) > 0:
+        avro_blocks.write_long(buffer, len(tokens))
+        for token in tokens:
+            avro_blocks.write_bytes(buffer, token.encode('utf8'))
+    avro_blocks.write_long(buffer, 0)
+
+
+def encode_record(buffer, tokens, start, completions):
+    """
+    Append a record to a bytearray, the completions are a list of (completion tokens, weight)
+    """
+    encode_tokens(buffer, tokens)
+    buffer.append(1 if start else 0)
+    if len(completions) > 0:
+        avro_blocks.write_long(buffer, len(completions))
+        for completion_tokens, weight in completions:
+            encode_tokens(buffer, completion_tokens)
+            buffer += DOUBLE.pack(weight)
+    avro_blocks.write_long(buffer, 0)
+
+
+def decode_long(data, position):
+    """
+    Decode a zig-zag variable length long, returning it with the position after it
+    """
+    b = data[position]
+    position += 1
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        b = data[position]
+        position += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1), position
+
+
+def decode_array(data, position, decode_item):
+    """
+    Decode an Avro array made of any number of blocks, returning the items with the position after it
+    """
+    items = []
+    count, position = decode_long(data, position)
+    while count != 0:
+        if count < 0:
+            # a negative count is followed by the size of the block in bytes
+            count = -count
+            _, position = decode_long(data, position)
+        for _ in range(count):
+            item, position = decode_item(data, position)
+            items.append(item)
+        count, position = decode_long(data, position)
+    return items, position
+
+
+def decode_string(data, position):
+    length, position = decode_long(data, position)
+    return data[position:position + length].decode('utf8'), position + length
+
+
+def decode_completion(data, position):
+    tokens, position = decode_array(data, position, decode_string)
+    return (tokens, DOUBLE.unpack_from(data, position)[0]), position + DOUBLE.size
+
+
+def decode_records(data, record_count):
+    """
+    Generate the (tokens, start, completions) records of a decompressed block
+    """
+    position = 0
+    for _ in range(record_count):
+        tokens, position = decode_array(data, position, decode_string)
+        start = data[position] != 0
+        position += 1
+        completions, position = decode_array(data, position, decode_completion)
+        yield tokens, start, completions
+
+
+def snapshot_info(path):
+    """
+    The prefix and the key length of the model in a snapshot, as a dictionary
+    """
+    with open(path, 'rb') as f:
+        header = avro_blocks.read_header(f)
+    if 'markov.key_length' not in header.metadata:
+        raise ValueError('{0} is not a snapshot of a Markov model'.format(path))
+    return {'prefix': header.metadata['markov.prefix'].decode('utf8'),
+            'key_length': int(header.metadata['markov.key_length'])}
+
+
+class SnapshotWriter(object):
+    """
+    Writes the records of a snapshot in deflate compressed blocks of about block_size bytes before compression
+    """
+    def __init__(self, f, prefix, key_length, block_size=65536):
+        with open(SCHEMA_FILE, 'rb') as schema_file:
+            schema_json = schema_file.read().decode('utf-8')
+        metadata = {'markov.prefix': prefix.encode('utf8'), 'markov.key_length': str(key_length).encode('utf8')}
+        self.writer = avro_blocks.BlockWriter(f, schema_json, codec='deflate', metadata=metadata)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.buffered_count = 0
+        self.record_count = 0
+
+    def append(self, tokens, start, completions):
+        encode_record(self.buffer, tokens, start, completions)
+        self.buffered_count += 1
+        self.record_count += 1
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        self.writer.write_block(self.buffer, self.buffered_count)
+        self.buffer = bytearray()
+        self.buffered_count = 0
+
+
+def export_snapshot(markov, path, batch_size=1000, block_size=65536, progress=None):
+    """
+    Write every key of the model to a snapshot, reading the completions of batch_size keys per round trip.
+    progress, if given, is called with the number of keys exported so far. Returns the number of exported keys
+    """
+    with open(path, 'wb') as f:
+        writer = SnapshotWriter(f, markov.prefix, markov.key_length, block_size=block_size)
+        keys = []
+        for key in markov.backend.iterate_keys(markov.prefix):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                _export_keys(markov, keys, writer)
+                keys = []
+                if progress is not None:
+                    progress(writer.record_count)
+        _export_keys(markov, keys, writer)
+        writer.flush()
+    return writer.record_count
+
+
+def _export_keys(markov, keys, writer):
+    if len(keys) == 0:
+        return
+    starts = markov.backend.are_members(meta_key(markov.prefix, 'start_keys'), keys)
+    for key, start, completions in zip(keys, starts, markov.backend.completions_many(keys)):
+        # the key was deleted after being listed
+        if len(completions) == 0:
+            continue
+        completions = [(markov.to_tokens(c.split(SEPARATOR)), w) for c, w in completions]
+        writer.append(markov.to_tokens(key.split(SEPARATOR)[1:]), start, completions)
+
+
+def import_snapshot(markov, path, progress=None):
+    """
+    Add the keys of a snapshot to a model, summing the weights of the completions already present.
+    Use a model in bulk mode to send them in pipelines. progress, if given, is called with the number of keys
+    imported so far. Returns the number of imported keys
+    """
+    info = snapshot_info(path)
+    if info['key_length'] != markov.key_length:
+        raise ValueError('the snapshot has keys of length {0}, the model {1}'.format(info['key_length'],
+                                                                                  markov.key_length))
+    imported_count = 0
+    with open(path, 'rb') as f:
+        header = avro_blocks.read_header(f)
+        for _, record_count, data in avro_blocks.iterate_blocks(f, header):
+            for tokens, start, completions in decode_records(avro_blocks.decompress_block(header, data),
+                                                             record_count):
+                markov.add_key(tokens, completions, start=start)
+            imported_count += record_count
+            if progress is not None:
+                progress(imported_count)
+    markov.commit()
+    return imported_count
+
+
+def merge_snapshots(paths, output_path, progress=None):
+    """
+    Sum the weights of the keys in several snapshots into a new one, the models are merged in memory without
+    Redis. Returns the number of keys in the merged snapshot
+    """
+    infos = [snapshot_info(path) for path in paths]
+    key_lengths = {info['key_length'] for info in infos}
+    if len(key_lengths) > 1:
+        raise ValueError('the snapshots have keys of different lengths {0}'.format(sorted(key_lengths)))
+    merged = Markov(prefix=infos[0]['prefix'], key_length=infos[0]['key_length'], backend=MemoryBackend(),
+                    bulk=True, frozen=False)
+    for path in paths:
+        import_snapshot(merged, path, progress=progress)
+    return export_snapshot(merged, output_path)
@@ -0,0 +1,173 @@
+"""
+Approximate counting of the tokens of a corpus in a fixed memory, for the corpora whose distinct tokens don't fit
+in a dict.
+ - CountMinSketch: depth rows of width counters, a token increments one counter per row and its estimate is the
+   minimum of them. It never underestimates, and overestimates by at most e / width of the total with probability
+   1 - e^-depth
+ - SpaceSaving: the heavy hitters, at most capacity tokens with their count and the maximum overestimation of it.
+   When it's full a new token replaces the one with the lowest count, inheriting it as the error, so every token
+   more frequent than total / capacity is kept
+The hashes don't depend on the process, so the sketches of separate runs with the same sizes can be merged
+"""
+from array import array
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import operator
+import struct
+
+MAGIC = b'MKCS'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+
+
+class CountMinSketch(object):
+    def __init__(self, width=262144, depth=4):
+        self.width = width
+        self.depth = depth
+        self.counters = array('Q', [0]) * (width * depth)
+        self.total = 0
+
+    def _positions(self, item):
+        # the positions in each row are derived from two 64 bits hashes
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        for position in self._positions(item):
+            self.counters[position] += count
+        self.total += count
+
+    def estimate(self, item):
+        return min(self.counters[position] for position in self._positions(item))
+
+    def error_bound(self):
+        """
+        The maximum overestimation of a count, and the probability that it holds
+        """
+        return math.e / self.width * self.total, 1 - math.exp(-self.depth)
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('only sketches with the same width and depth can be merged')
+        self.counters = array('Q', map(operator.add, self.counters, other.counters))
+        self.total += other.total
+
+
+class SpaceSaving(object):
+    def __init__(self, capacity=20000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def min_count(self):
+        """
+        The count of the least frequent token kept, the maximum count of the ones not kept
+        """
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def add_counts(self, counts):
+        """
+        Add a {token: count} of distinct tokens
+        """
+        # the heap is built at the first replacement, its entries lower than the current counts are stale
+        heap = None
+        for item, count in counts.items():
+            if item in self.counts:
+                self.counts[item] += count
+                continue
+            if len(self.counts) < self.capacity:
+                self.counts[item] = count
+                self.errors[item] = 0
+                continue
+            if heap is None:
+                heap = [(c, i) for i, c in self.counts.items()]
+                heapq.heapify(heap)
+            while self.counts[heap[0][1]] != heap[0][0]:
+                _, stale = heapq.heappop(heap)
+                heapq.heappush(heap, (self.counts[stale], stale))
+            lowest, replaced = heapq.heappop(heap)
+            del self.counts[replaced]
+            del self.errors[replaced]
+            self.counts[item] = lowest + count
+            self.errors[item] = lowest
+            heapq.heappush(heap, (lowest + count, item))
+
+    def merge(self, other):
+        """
+        Add the tokens of another summary. A token missing from a full summary may have had up to its minimum
+        count, which is added to both the count and the error
+        """
+        self_min = self.min_count()
+        other_min = other.min_count()
+        counts = {}
+        errors = {}
+        for item in itertools.chain(self.counts, other.counts):
+            if item not in counts:
+                counts[item] = self.counts.get(item, self_min) + other.counts.get(item, other_min)
+                errors[item] = self.errors.get(item, self_min) + other.errors.get(item, other_min)
+        kept = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = {item: counts[item] for item in kept}
+        self.errors = {item: errors[item] for item in kept}
+
+
+class FrequencySketch(object):
+    """
+    The count-min sketch of all the tokens and the Space-Saving summary of the most frequent ones
+    """
+    def __init__(self, width=262144, depth=4, capacity=20000):
+        self.count_min = CountMinSketch(width, depth)
+        self.heavy_hitters = SpaceSaving(capacity)
+
+    def add_counts(self, counts):
+        """
+        Add a {token: count}, hashing each distinct token once
+        """
+        for item, count in counts.items():
+            self.count_min.add(item, count)
+        self.heavy_hitters.add_counts(counts)
+
+    def merge(self, other):
+        self.count_min.merge(other.count_min)
+        self.heavy_hitters.merge(other.heavy_hitters)
+
+    def top(self, n):
+        """
+        The n most frequent tokens as (token, lower bound, upper bound), by decreasing upper bound. The upper bound
+        is the lowest of the two overestimates, the lower one holds for the Space-Saving count
+        """
+        heavy_hitters = self.heavy_hitters
+        bounded = [(item, max(0, count - heavy_hitters.errors[item]), min(count, self.count_min.estimate(item)))
+                   for item, count in heavy_hitters.counts.items()]
+        return heapq.nlargest(n, bounded, key=lambda b: b[2])
+
+    def save(self, path):
+        count_min = self.count_min
+        description = {'width': count_min.width, 'depth': count_min.depth, 'total': count_min.total,
+                       'capacity': self.heavy_hitters.capacity,
+                       'heavy_hitters': [[item, count, self.heavy_hitters.errors[item]]
+                                         for item, count in self.heavy_hitters.counts.items()]}
+        encoded = json.dumps(description).encode('utf8')
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(encoded)) + encoded)
+            count_min.counters.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, description_size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{0} is not a frequency sketch'.format(path))
+            description = json.loads(f.read(description_size).decode('utf8'))
+            sketch = cls(description['width'], description['depth'], description['capacity'])
+            sketch.count_min.counters = array('Q')
+            sketch.count_min.counters.fromfile(f, description['width'] * description['depth'])
+        sketch.count_min.total = description['total']
+        for item, count, error in description['heavy_hitters']:
+            sketch.heavy_hitters.counts[item] = count
+            sketch.heavy_hitters.errors[item] = error
+        return sketch
@@ -0,0 +1,139 @@
+"""
+A sidecar index of the tags of an Avro corpus, so that the tools filtering by tag read only the blocks containing
+them instead of decoding the whole file.
+The index is the JSON file input_file.tags.json, mapping each tag to the blocks where it occurs and the positions
+of the tagged records in each block, as {tag: {block offset: [positions]}}. It records the size and the sync
+marker of the corpus, an index not matching them is ignored
+"""
+import argparse
+import json
+import os
+import time
+
+from avro.io import DatumReader
+
+import avro_blocks
+import utterance_decoder
+
+
+def index_path(path):
+    return path + '.tags.json'
+
+
+def build_index(path, progress=None):
+    """
+    Index the tags of the records of a corpus. progress, if given, is called with the number of records
+    indexed so far
+    """
+    tags = {}
+    records_count = 0
+    with open(path, 'rb') as f:
+        header = avro_blocks.read_header(f)
+        datum_reader = DatumReader(header.schema)
+        for offset, record_count, data in avro_blocks.iterate_blocks(f, header):
+            records = utterance_decoder.decode_block(header, data, record_count, ('tags',), datum_reader)
+            for position, record in enumerate(records):
+                for tag in set(record['tags'] or ()):
+                    tags.setdefault(tag, {}).setdefault(str(offset), []).append(position)
+            records_count += record_count
+            if progress is not None:
+                progress(records_count)
+    return {'size': os.path.getsize(path), 'sync_marker': header.sync_marker.hex(), 'records_count': records_count,
+            'tags': tags}
+
+
+def write_index(path, index):
+    with open(index_path(path), 'w') as f:
+        json.dump(index, f)
+
+
+def load_index(path):
+    """
+    The tag index of a corpus, None if it was not built or the corpus changed since then
+    """
+    if not os.path.exists(index_path(path)):
+        return None
+    with open(index_path(path)) as f:
+        index = json.load(f)
+    with open(path, 'rb') as f:
+        header = avro_blocks.read_header(f)
+    if index['size'] != os.path.getsize(path) or index['sync_marker'] != header.sync_marker.hex():
+        return None
+    return index
+
+
+def tagged_blocks(index, tags, start=None, end=None):
+    """
+    The blocks starting at an offset in [start, end) with records having one of the tags, as a sorted list of
+    (offset, sorted positions of the records)
+    """
+    blocks = {}
+    for tag in tags:
+        for offset, positions in index['tags'].get(tag, {}).items():
+            blocks.setdefault(int(offset), set()).update(positions)
+    return sorted((offset, sorted(positions)) for offset, positions in blocks.items()
+                  if (start is None or offset >= start) and (end is None or offset < end))
+
+
+def iterate_tagged_blocks(f, header, index, tags, start=None, end=None):
+    """
+    Generate (offset, record_count, data, positions) for the blocks with records having one of the tags,
+    seeking to each one
+    """
+    for offset, positions in tagged_blocks(index, tags, start, end):
+        for _, record_count, data in avro_blocks.iterate_blocks(f, header, offset, offset + 1):
+            yield offset, record_count, data, positions
+
+
+def has_tags(record, tags):
+    """
+    Whether the record has at least one of a set of tags
+    """
+    return record['tags'] is not None and not tags.isdisjoint(record['tags'])
+
+
+def iterate_records(path, tags, start=None, end=None, index=None, fields=utterance_decoder.FIELDS):
+    """
+    Generate the records of the blocks starting at an offset in [start, end) having at least one of the tags,
+    all of them when tags is empty, with the given fields and the tags. With the tag index of the corpus only
+    the blocks containing the tags are decoded, up to the last tagged record
+    """
+    tags = set(tags)
+    if len(tags) == 0:
+        yield from utterance_decoder.iterate_utterances(path, fields, start, end)
+        return
+    fields = tuple(fields) + ('tags',)
+    if index is None:
+        index = load_index(path)
+    if index is None:
+        for record in utterance_decoder.iterate_utterances(path, fields, start, end):
+            if has_tags(record, tags):
+                yield record
+        return
+    with open(path, 'rb') as f:
+        header = avro_blocks.read_header(f)
+        datum_reader = DatumReader(header.schema)
+        for _, _, data, positions in iterate_tagged_blocks(f, header, index, tags, start, end):
+            records = utterance_decoder.decode_block(header, data, positions[-1] + 1, fields, datum_reader)
+            for position in positions:
+                yield records[position]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="index the blocks of a corpus file containing each tag")
+    parser.add_argument("-input_file", type=str, help="the input avro file", default="utterances.avro")
+    args = parser.parse_args()
+
+    print('indexing the tags of {0}'.format(args.input_file))
+    start_time = time.time()
+
+    def report(records_count):
+        if records_count % 100000 < 1000:
+            print(' --- so far, indexed {0} utterances in {1} seconds'.format(records_count, time.time() - start_time))
+
+    index = build_index(args.input_file, progress=report)
+    write_index(args.input_file, index)
+    elapsed = time.time() - start_time
+    blocks_count = len({offset for blocks in index['tags'].values() for offset in blocks})
+    print('indexed {0} tags in {1} blocks of {2} utterances, it took {3} seconds. The index is {4}'
+          .format(len(index['tags']), blocks_count, index['records_count'], elapsed, index_path(args.input_file)))
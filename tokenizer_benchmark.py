@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of the tokenizers: tokenizes the utterances of a corpus one at a time, as a batch and as a batch
+spread over a pool of processes, reporting the tokens per second of each mode
+"""
+import argparse
+import itertools
+import time
+
+import avro_blocks
+import tokenizers
+
+
+def measure(texts, tokenize, repeat):
+    """
+    The best time of repeat runs of tokenize on the texts, and the number of tokens
+    """
+    best = None
+    tokens_count = 0
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        token_lists = tokenize(texts)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+        tokens_count = sum(len(tokens) for tokens in token_lists)
+    return best, tokens_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compare the speed of the tokenizers")
+    parser.add_argument("-input_file", type=str, help="the input avro file", default="utterances.avro")
+    parser.add_argument("-limit", type=int, help="how many utterances to tokenize", default=100000)
+    parser.add_argument("-repeat", type=int, help="how many times each mode is run, the best one is kept",
+                        default=3)
+    parser.add_argument("-processes", type=int, help="the size of the pool for the parallel mode, 1 to skip it",
+                        default=4)
+    parser.add_argument("-tokenizers", type=str, help="comma separated tokenizers to measure",
+                        default=','.join(tokenizers.NAMES))
+    args = parser.parse_args()
+
+    texts = [u['text'] for u in itertools.islice(avro_blocks.iterate_records(args.input_file), args.limit)]
+    print('tokenizing {0} utterances of {1}'.format(len(texts), args.input_file))
+    pool = tokenizers.make_pool(args.processes)
+
+    for name in filter(lambda x: x != '', args.tokenizers.split(',')):
+        splitter, _ = tokenizers.get_tokenizer(name)
+        modes = [('one at a time', lambda t: [splitter(x) for x in t]),
+                 ('batch', lambda t: tokenizers.tokenize_batch(t, name))]
+        if name == 'nltk':
+            try:
+                from nltk.tokenize import RegexpTokenizer
+                nltk_tokenizer = RegexpTokenizer(tokenizers.NLTK_EXPRESSION.pattern)
+                modes.insert(0, ('nltk RegexpTokenizer', lambda t: [nltk_tokenizer.tokenize(x) for x in t]))
+            except ImportError:
+                print('nltk is not installed, its RegexpTokenizer is not measured')
+        if pool is not None:
+            modes.append(('batch, {0} processes'.format(args.processes),
+                          lambda t: tokenizers.tokenize_batch(t, name, pool=pool, processes=args.processes)))
+        for mode, tokenize in modes:
+            elapsed, tokens_count = measure(texts, tokenize, args.repeat)
+            print('{0:>6} {1:<24} {2} tokens in {3:.3f} seconds [{4:.0f} tokens per second]'
+                  .format(name, mode, tokens_count, elapsed, tokens_count / elapsed))
+
+    if pool is not None:
+        pool.close()
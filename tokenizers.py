@@ -0,0 +1,67 @@
+"""
+The methods mapping plain text to the tokens of the models and back, shared by the scripts:
+ - split: the tokens are separated by single spaces
+ - char: every character is a token
+ - nltk: words, amounts like $3.50 and runs of other characters. It's the expression of the nltk RegexpTokenizer
+   used before, compiled once and applied with findall, which gives the same tokens without nltk
+tokenize_batch tokenizes a list of utterances at once, optionally spreading them over a pool of processes
+"""
+from multiprocessing import Pool
+import re
+
+NAMES = ['split', 'char', 'nltk']
+# the flags of nltk.tokenize.RegexpTokenizer
+NLTK_EXPRESSION = re.compile(r'\w+|\$[\d\.]+|\S+', re.UNICODE | re.MULTILINE | re.DOTALL)
+
+
+def split_tokens(text):
+    return text.split(' ')
+
+
+def get_tokenizer(name):
+    """
+    The (splitter, joiner) functions of a tokenizer, mapping a text to its tokens and the tokens to a text
+    """
+    if name == 'split':
+        return split_tokens, ' '.join
+    if name == 'char':
+        return list, ''.join
+    if name == 'nltk':
+        return NLTK_EXPRESSION.findall, ' '.join
+    raise ValueError('unknown tokenizer {0}, use one of {1}'.format(name, NAMES))
+
+
+def _tokenize_chunk(arguments):
+    name, texts = arguments
+    return tokenize_batch(texts, name)
+
+
+def tokenize_batch(texts, name='split', pool=None, processes=None, chunk_size=None):
+    """
+    The tokens of each text of a list. With a pool of processes the texts are sent to them in chunks of
+    chunk_size, by default one chunk for each of the processes of the pool so that even the few utterances of a
+    block are spread over all of them. It pays off only when the tokenizer costs more than pickling the texts and
+    the tokens
+    """
+    if pool is not None and chunk_size is None:
+        if processes is None:
+            raise ValueError('give the number of processes of the pool, or the chunk size')
+        chunk_size = max(1, -(-len(texts) // processes))
+    if pool is not None and len(texts) > chunk_size:
+        chunks = [(name, texts[i:i + chunk_size]) for i in range(0, len(texts), chunk_size)]
+        return [tokens for chunk in pool.map(_tokenize_chunk, chunks) for tokens in chunk]
+    if name == 'split':
+        return [text.split(' ') for text in texts]
+    if name == 'char':
+        return list(map(list, texts))
+    splitter, _ = get_tokenizer(name)
+    return list(map(splitter, texts))
+
+
+def make_pool(processes):
+    """
+    A pool of processes for tokenize_batch, None to tokenize in the calling process when processes is 1
+    """
+    if processes <= 1:
+        return None
+    return Pool(processes)
@@ -0,0 +1,138 @@
+"""
+A decoder specialized to the Utterance records of corpus_utterance.avsc, much faster than the generic DatumReader
+which interprets the schema for each field of each record. It decodes whole blocks reading the varints and the
+strings directly from the bytes, and only the requested fields are put in the records: the others are skipped
+without decoding them.
+Files with a different schema are decoded with the DatumReader, so any corpus is accepted
+"""
+from avro.io import DatumReader
+
+import avro_blocks
+
+FIELDS = ('text', 'timestamp', 'source', 'tags')
+
+
+def is_utterance_schema(schema):
+    """
+    Whether a record schema has the fields of corpus_utterance.avsc, in the same order and with the same types
+    """
+    fields = getattr(schema, 'fields', None)
+    if fields is None or tuple(f.name for f in fields) != FIELDS:
+        return False
+
+    def is_optional(s, item_type):
+        return (s.type == 'union' and len(s.schemas) == 2 and s.schemas[0].type == item_type and
+                s.schemas[1].type == 'null')
+
+    text, timestamp, source, tags = [f.type for f in fields]
+    return (text.type == 'string' and is_optional(timestamp, 'string') and is_optional(source, 'string') and
+            is_optional(tags, 'array') and tags.schemas[0].items.type == 'string')
+
+
+def read_long(data, position):
+    """
+    Read a zig-zag encoded variable length long from bytes, returning it with the position after it
+    """
+    b = data[position]
+    position += 1
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        b = data[position]
+        position += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1), position
+
+
+def decode_utterances(data, record_count, fields=FIELDS):
+    """
+    Decode the records of an uncompressed block, with only the given fields
+    """
+    with_text = 'text' in fields
+    with_timestamp = 'timestamp' in fields
+    with_source = 'source' in fields
+    with_tags = 'tags' in fields
+    records = []
+    position = 0
+    for _ in range(record_count):
+        record = {}
+        # the lengths of short strings fit in a byte, the other varints are decoded by read_long
+        size = data[position]
+        if size < 0x80:
+            size >>= 1
+            position += 1
+        else:
+            size, position = read_long(data, position)
+        if with_text:
+            record['text'] = data[position:position + size].decode('utf-8')
+        position += size
+        # the index of the union branch is a single byte, 0 for the string and 2 (zig-zag 1) for null
+        if data[position] == 0:
+            size, position = read_long(data, position + 1)
+            if with_timestamp:
+                record['timestamp'] = data[position:position + size].decode('utf-8')
+            position += size
+        else:
+            position += 1
+            if with_timestamp:
+                record['timestamp'] = None
+        if data[position] == 0:
+            size, position = read_long(data, position + 1)
+            if with_source:
+                record['source'] = data[position:position + size].decode('utf-8')
+            position += size
+        else:
+            position += 1
+            if with_source:
+                record['source'] = None
+        if data[position] == 0:
+            position += 1
+            tags = []
+            # the array is a sequence of blocks of items terminated by an empty one
+            count, position = read_long(data, position)
+            while count != 0:
+                if count < 0:
+                    # a negative count is followed by the size of the block, to skip it
+                    count = -count
+                    size, position = read_long(data, position)
+                    if not with_tags:
+                        position += size
+                        count, position = read_long(data, position)
+                        continue
+                for _ in range(count):
+                    size, position = read_long(data, position)
+                    if with_tags:
+                        tags.append(data[position:position + size].decode('utf-8'))
+                    position += size
+                count, position = read_long(data, position)
+            if with_tags:
+                record['tags'] = tags
+        else:
+            position += 1
+            if with_tags:
+                record['tags'] = None
+        records.append(record)
+    return records
+
+
+def decode_block(header, data, record_count, fields=FIELDS, datum_reader=None):
+    """
+    Decode the records of a block of a file with the given fields, with the specialized decoder when the file
+    has the schema of the utterances and with a DatumReader otherwise
+    """
+    if is_utterance_schema(header.schema):
+        return decode_utterances(avro_blocks.decompress_block(header, data), record_count, fields)
+    records = avro_blocks.decode_block(header, data, record_count, datum_reader)
+    return [{field: record.get(field) for field in fields} for record in records]
+
+
+def iterate_utterances(path, fields=FIELDS, start=None, end=None):
+    """
+    Generate the records of the blocks starting at an offset in [start, end), with the given fields
+    """
+    with open(path, 'rb') as f:
+        header = avro_blocks.read_header(f)
+        datum_reader = None if is_utterance_schema(header.schema) else DatumReader(header.schema)
+        for _, record_count, data in avro_blocks.iterate_blocks(f, header, start, end):
+            yield from decode_block(header, data, record_count, fields, datum_reader)
@@ -0,0 +1,57 @@
+"""
+Benchmark of the utterance decoder against the stock avro reader: reads a corpus with DataFileReader, with the
+specialized decoder and with the specialized decoder reading only the text, reporting the records per second and
+checking that they decode the same records
+"""
+import argparse
+import time
+
+from avro.datafile import DataFileReader
+from avro.io import DatumReader
+
+import utterance_decoder
+
+
+def read_stock(path):
+    reader = DataFileReader(open(path, 'rb'), DatumReader())
+    records = list(reader)
+    reader.close()
+    return records
+
+
+def measure(read, path, repeat):
+    """
+    The best time of repeat runs of read on the file, and its records
+    """
+    best = None
+    records = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        records = read(path)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compare the utterance decoder with the stock avro reader")
+    parser.add_argument("-input_file", type=str, help="the input avro file",
+                        default="hackernews_utterances.avro.example")
+    parser.add_argument("-repeat", type=int, help="how many times each reader is run, the best one is kept",
+                        default=3)
+    args = parser.parse_args()
+
+    modes = [('DataFileReader', read_stock),
+             ('utterance decoder', lambda p: list(utterance_decoder.iterate_utterances(p))),
+             ('utterance decoder, text', lambda p: list(utterance_decoder.iterate_utterances(p, fields=('text',))))]
+    stock_elapsed = None
+    stock_records = None
+    for mode, read in modes:
+        elapsed, records = measure(read, args.input_file, args.repeat)
+        if stock_elapsed is None:
+            stock_elapsed, stock_records = elapsed, records
+        fields = records[0].keys() if len(records) > 0 else ()
+        same = all({f: s[f] for f in fields} == r for s, r in zip(stock_records, records))
+        print('{0:<24} {1} records in {2:.3f} seconds [{3:.0f} records per second], {4:.1f}x, {5}'
+              .format(mode, len(records), elapsed, len(records) / elapsed, stock_elapsed / elapsed,
+                      'same records' if same and len(records) == len(stock_records) else 'DIFFERENT RECORDS'))